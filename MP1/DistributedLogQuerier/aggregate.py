@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import re
+import collections
+
+# The asctime prefix of our log lines, down to the minute
+TIMESTAMP = re.compile(r'(\d{4}-\d{2}-\d{2}) (\d{2}):(\d{2})')
+
+# Each server sends this many times more top values than asked for,
+#   so the merged top values are exact unless their counts are spread very thin
+TOP_OVERFETCH = 10
+
+def compute(spec, query, lines):
+    """ Aggregate the lines a query selected on a server
+
+        spec -- {'type': 'count'}
+                {'type': 'top', 'k': k, 'group': captured group of the pattern to count}
+                {'type': 'histogram', 'minutes': minutes per bucket}
+    """
+    kind = spec.get('type')
+    if kind == 'count':
+        return sum(1 for _ in lines)
+
+    elif kind == 'top':
+        # Count the first captured group by default, or the whole match without any
+        group = int(spec.get('group', 1 if query.regex.groups else 0))
+        if group > query.regex.groups:
+            raise ValueError('Pattern has no group %d to count' % group)
+        counter = collections.Counter()
+        search = query.regex.search
+        for line in lines:
+            m = search(line)
+            # Lines selected by -v have no match, count them whole
+            value = m.group(group) if m else line
+            if value is not None:
+                counter[value] += 1
+        return counter.most_common(int(spec['k']) * TOP_OVERFETCH)
+
+    elif kind == 'histogram':
+        minutes = int(spec.get('minutes', 1))
+        counter = collections.Counter()
+        for line in lines:
+            m = TIMESTAMP.match(line)
+            # Lines without the timestamp prefix are continuations of the last one
+            if not m:
+                continue
+            date, hour, minute = m.groups()
+            slot = (int(hour) * 60 + int(minute)) / minutes * minutes
+            counter['%s %02d:%02d' % (date, slot / 60, slot % 60)] += 1
+        return dict(counter)
+
+    raise ValueError('Unknown aggregate (%s)' % kind)
+
+def merge(spec, results):
+    """ Merge the aggregates computed by each server """
+    kind = spec['type']
+    if kind == 'count':
+        return sum(results)
+
+    counter = collections.Counter()
+    if kind == 'top':
+        for result in results:
+            for value, count in result:
+                counter[value] += count
+        return counter.most_common(int(spec['k']))
+    else:
+        for result in results:
+            counter.update(result)
+        return sorted(counter.iteritems())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import yaml
+import socket
+import logging
+import argparse
+import subprocess
+import client
+import gen_testlog
+
+LOGGER = logging.getLogger('DLQ Bench')
+
+def percentile(values, p):
+    """ The p-th percentile of values by the nearest rank """
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+class LocalCluster(object):
+    """ Servers run as local processes on loopback ports, each querying a log of its own """
+
+    def __init__(self, conf, work_dir, server_num, base_port):
+        super(LocalCluster, self).__init__()
+        self.work_dir = work_dir
+        self.processes = []
+
+        self.conf = dict(conf)
+        self.conf['log_path'] = os.path.join(work_dir, '')
+        self.conf['server_list'] = [
+            {'id': i, 'ip': '127.0.0.1', 'port': base_port + i, 'logfile': 'vm%d.log' % i}
+            for i in xrange(1, server_num + 1)
+        ]
+        if 'index' in self.conf:
+            self.conf['index'] = dict(self.conf['index'], path=os.path.join(work_dir, 'index', ''))
+        self.conf_file = os.path.join(work_dir, 'conf.yaml')
+
+    def log_files(self):
+        return [self.conf['log_path'] + s['logfile'] for s in self.conf['server_list']]
+
+    def gen_logs(self, size, reuse):
+        for server_info, log_file in zip(self.conf['server_list'], self.log_files()):
+            if reuse and os.path.exists(log_file):
+                continue
+            LOGGER.info('Generating %d lines into %s' % (size, log_file))
+            gen_testlog.gen_testlog(log_file, size, server_info['id'])
+
+    def start(self):
+        with open(self.conf_file, 'w') as f:
+            yaml.safe_dump(self.conf, f, default_flow_style=False)
+        for server_info in self.conf['server_list']:
+            output = open(os.path.join(self.work_dir, 'server%d.out' % server_info['id']), 'w')
+            self.processes.append(subprocess.Popen([
+                sys.executable, 'server.py',
+                '--host', server_info['ip'],
+                '--port', str(server_info['port']),
+                '--conf', self.conf_file,
+            ], stdout=output, stderr=subprocess.STDOUT))
+
+        # Wait until every server takes connections
+        deadline = time.time() + 30
+        for server_info in self.conf['server_list']:
+            while True:
+                try:
+                    socket.create_connection((server_info['ip'], server_info['port'])).close()
+                    break
+                except socket.error, e:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.1)
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.wait()
+        self.processes = []
+
+def bench_query(cluster, grep_cmd, repeat, connections):
+    """ Run a query repeatedly, return the stats of its runs """
+    latencies = []
+    for i in xrange(repeat):
+        c = client.LogQueryClient(grep_cmd, connections)
+        c.conf.update(cluster.conf)
+
+        # The lines are printed as a real client would, but out of sight
+        sys.stdout = open(os.devnull, 'w')
+        tick = time.time()
+        try:
+            c.query()
+        finally:
+            tock = time.time()
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+
+        if c.timed_out or c.failed:
+            LOGGER.error('Servers timed out %s or failed %s' % (c.timed_out, c.failed))
+        latencies.append(tock - tick)
+
+    total_latency = sum(latencies)
+    return {
+        'lines': c.total_line,
+        'bytes': c.bytes_received,
+        'ratio': float(sum(c.raw_dict.values())) / c.bytes_received if c.bytes_received else 1.0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+        'queries_per_sec': repeat / total_latency,
+        'lines_per_sec': c.total_line * repeat / total_latency,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the distributed log querier on local servers')
+    parser.add_argument('--servers', type=int, default=3, help='number of local servers')
+    parser.add_argument('--size', type=int, default=1000000, help='number of lines in the log of each server')
+    parser.add_argument('--repeat', type=int, default=10, help='runs of each query')
+    parser.add_argument('--port', type=int, default=23300, help='servers listen on the ports after this one')
+    parser.add_argument('--dir', default='/tmp/dlqbench', help='directory of the logs and indexes')
+    parser.add_argument('--reuse', action='store_true', help='keep the logs generated by an earlier run')
+    parser.add_argument('--no-index', action='store_true', help='scan the logs in full')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache results')
+    parser.add_argument('--no-compress', action='store_true', help='send results uncompressed')
+    args = parser.parse_args()
+
+    # Only the results of the benchmark are of interest
+    logging.getLogger('DLQ Client').setLevel(logging.WARNING)
+
+    with open('conf.yaml') as f:
+        conf = yaml.safe_load(f)
+    if args.no_index:
+        conf.pop('index', None)
+    if args.no_cache:
+        conf.pop('cache', None)
+    if args.no_compress:
+        conf.pop('compress', None)
+    if not os.path.exists(args.dir):
+        os.makedirs(args.dir)
+
+    cluster = LocalCluster(conf, args.dir, args.servers, args.port)
+    cluster.gen_logs(args.size, args.reuse)
+    log_bytes = sum(os.path.getsize(f) for f in cluster.log_files())
+
+    # From a single line per server to a large share of the lines
+    queries = [('rare', ['grep', 'all_server'])]
+    for t, f in sorted(conf['test']['frequency'].iteritems(), key=lambda (t, f): float(f)):
+        queries.append((t, ['grep', '-E', conf['test']['pattern'][t]]))
+
+    cluster.start()
+    connections = client.ConnectionPool()
+    try:
+        print '%d servers, %d lines and %.1f MB of logs each, %d runs per query' % (
+            args.servers, args.size, log_bytes / float(args.servers) / (1 << 20), args.repeat)
+        print '%-8s %10s %12s %6s %8s %8s %8s %8s %10s %12s %10s' % (
+            'pattern', 'lines', 'bytes', 'ratio', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries/s', 'lines/s', 'MB/s')
+        for name, grep_cmd in queries:
+            stats = bench_query(cluster, grep_cmd, args.repeat, connections)
+            print '%-8s %10d %12d %6.2f %8.1f %8.1f %8.1f %8.1f %10.2f %12.0f %10.1f' % (
+                name, stats['lines'], stats['bytes'], stats['ratio'],
+                stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000, stats['max'] * 1000,
+                stats['queries_per_sec'], stats['lines_per_sec'],
+                # Log bytes searched per second
+                stats['queries_per_sec'] * log_bytes / (1 << 20))
+    finally:
+        connections.close()
+        cluster.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 
+import os
 import yaml
 import logging
 import socket
-import threading
+import select
+import errno
 import shlex
 import json
+import zlib
 import time
 import operator
 import string
+import protocol
+import aggregate
 
 logging.basicConfig(
     level=logging.DEBUG, 
@@ -19,87 +24,365 @@ logging.basicConfig(
 
 LOGGER = logging.getLogger('DLQ Client')
 
-class LogQueryThread(threading.Thread):
-    """ Worker thread to query the designated server """
-    
-    def __init__(self, client, server_info, grep_cmd):
-        super(LogQueryThread, self).__init__()
-        self.client = client
+class ServerConnection(object):
+    """ Non-blocking connection to a server, kept open across queries """
+
+    def __init__(self, server_info, port):
+        super(ServerConnection, self).__init__()
         self.server_info = server_info
-        self.grep_cmd = grep_cmd + [self.client.conf['log_path'] + server_info['logfile']]
-        self.buffer_size = 1024
+        self.address = (server_info['ip'], port)
+        self.sock = None
+        self.connecting = False
+        self.in_buffer = ''
+        self.out_buffer = ''
+        # Number of cancelled results whose rest is still to come, and be dropped
+        self.skip = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def is_open(self):
+        return self.sock is not None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(self.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.close()
+            raise socket.error(err, os.strerror(err))
+        # Connected once it becomes writable
+        self.connecting = err != 0
+        self.in_buffer = ''
+        self.out_buffer = ''
+        self.skip = 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
-    def run(self):
-        HOST, PORT = self.server_info['ip'], self.client.conf['port']
+    def send(self, kind, obj):
+        self.out_buffer += protocol.pack_frame(kind, json.dumps(obj))
 
+    def wants_write(self):
+        return self.connecting or bool(self.out_buffer)
+
+    def handle_write(self):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.connecting = False
+        if self.out_buffer:
+            sent = self.sock.send(self.out_buffer)
+            self.out_buffer = self.out_buffer[sent:]
+
+    def cancel(self):
+        """ Cancel the query in progress, without waiting for the server to stop """
+        if self.connecting:
+            self.close()
+            return
+        self.send(protocol.CANCEL, {})
+        self.skip += 1
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((HOST, PORT))
-            sock.sendall(json.dumps(self.grep_cmd))
-
-            # Store results of query as temporary files
-            #   so that a mathced line will not be cut into two results
-            with open('temp.result.server.%d' % self.server_info['id'], 'w+') as f:
-                while True:
-                    result = sock.recv(self.buffer_size)
-                    # Collect all the results from server
-                    if result:
-                        f.write(result)
-                    # Print the collected results
-                    else:
-                        # Print each line in a way the original grep does
-                        #   but add the log file info ahead it
-                        f.seek(0)
-                        for line in f.read().split('\n'):
-                            if line.strip():
-                               print 'From %s: %s' % (self.server_info['logfile'], line)
-                        # Report to client the number of matched lines
-                        f.seek(0)
-                        line_count = len([1 for l in f.read().split('\n') if l])
-                        if line_count:
-                            self.client.line_dict.setdefault(self.server_info['id'], line_count)
-                        break
+            self.handle_write()
         except socket.error, e:
-            LOGGER.error('Server-%s %s' % (self.server_info['id'], e)) 
-        else:
-            LOGGER.info('Done with Server-%s' % self.server_info['id'])
-        finally:
-            sock.close()   
+            pass
+        # A cancel which cannot go out at once would hold up the next query, drop the connection
+        if self.out_buffer:
+            self.close()
+
+    def handle_read(self):
+        """ Receive what has arrived, return the frames completed by it """
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if not data:
+            raise EOFError('Connection closed by server')
+        frames, self.in_buffer = protocol.split_frames(self.in_buffer + data)
+        return frames
+
+class ConnectionPool(object):
+    """ Connections to the servers, reused by the following queries """
+
+    def __init__(self):
+        super(ConnectionPool, self).__init__()
+        self.connections = {}
+
+    def get(self, server_info, port):
+        # Servers on one host still take queries of their own at once
+        key = server_info['id']
+        if key not in self.connections:
+            self.connections[key] = ServerConnection(server_info, port)
+        return self.connections[key]
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
 
 class LogQueryClient():
     """ Client end of log query """
 
-    def __init__(self, grep_cmd):
+    def __init__(self, grep_cmd, connections=None, aggregate=None, since=None, until=None, limit=None):
         with open('conf.yaml') as f:
             self.conf = yaml.safe_load(f)
 
         self.grep_cmd = grep_cmd
         self.line_dict = {}
+        # (server id, log file) -> number of matched lines
+        self.file_dict = {}
+        # Bytes of frames received from all the servers
+        self.bytes_received = 0
+        # Server id -> bytes of frames on the wire, and what they are uncompressed
+        self.wire_dict = {}
+        self.raw_dict = {}
+        # Optional aggregate to compute on the servers instead of fetching lines
+        self.aggregate = aggregate
+        self.aggregate_dict = {}
+        # Optional time window of the lines to query
+        self.since = since
+        self.until = until
+        # Optional number of lines to stop at, the servers still running are cancelled then
+        self.limit = limit
+        self.printed = 0
+        self.cancelled = []
+        # Ids of the servers which did not finish in time, or failed
+        self.timed_out = []
+        self.failed = []
+
+        # Without a pool to share, connections only live through one query
+        self.own_connections = connections is None
+        self.connections = connections or ConnectionPool()
+
+    def start(self, conn, state):
+        server_info = conn.server_info
+        # A kept connection may have been closed by the server since, allow a retry on it
+        state['reused'] = conn.is_open()
+        if not conn.is_open():
+            conn.open()
+        # Without a log file named, the server queries all the logs it has
+        logs = [self.conf['log_path'] + server_info['logfile']] if 'logfile' in server_info else []
+        request = {'cmd': self.grep_cmd + logs}
+        if self.aggregate:
+            request['aggregate'] = self.aggregate
+        if self.since:
+            request['since'] = self.since
+        if self.until:
+            request['until'] = self.until
+        if self.conf.get('compress'):
+            request['compress'] = protocol.CODECS
+        # Any server may have all the lines, so each is asked for as many as all
+        if self.limit is not None and not self.aggregate:
+            request['limit'] = self.limit
+        conn.send(protocol.QUERY, request)
+
+    def fail(self, conn, state, e):
+        conn.close()
+        if state['reused'] and not state['answered']:
+            try:
+                self.start(conn, state)
+                return False
+            except socket.error, e:
+                pass
+        LOGGER.error('Server-%s %s' % (conn.server_info['id'], e))
+        self.failed.append(conn.server_info['id'])
+        return True
+
+    def handle_frame(self, conn, state, kind, payload):
+        """ Handle a frame from a server, return whether its part of the query is done """
+        server_info = conn.server_info
+        state['answered'] = True
+        frame_size = protocol.HEADER.size + len(payload)
+        self.bytes_received += frame_size
+        self.wire_dict[server_info['id']] = self.wire_dict.get(server_info['id'], 0) + frame_size
+
+        if kind == protocol.COMPRESSED:
+            # A compressed stream starts with the first compressed frame of each query
+            if 'inflate' not in state:
+                state['inflate'] = zlib.decompressobj()
+                state['inflated'] = ''
+            frames, state['inflated'] = protocol.split_frames(state['inflated'] + state['inflate'].decompress(payload))
+            for inner_kind, inner_payload in frames:
+                self.handle_result(conn, state, inner_kind, inner_payload)
+            return False
+        return self.handle_result(conn, state, kind, payload)
+
+    def handle_result(self, conn, state, kind, payload):
+        server_info = conn.server_info
+        self.raw_dict[server_info['id']] = self.raw_dict.get(server_info['id'], 0) + protocol.HEADER.size + len(payload)
+        if kind == protocol.FILE:
+            state['file'] = os.path.basename(payload)
+            return False
+        elif kind == protocol.BATCH:
+            # Print each line in a way the original grep does
+            #   but add the log file info ahead it
+            for line in payload.split('\n'):
+                if line.strip():
+                    if self.printed == self.limit:
+                        break
+                    print 'From %s: %s' % (state.get('file', server_info.get('logfile')), line)
+                    self.printed += 1
+                    state['printed'] += 1
+            return False
+        elif kind == protocol.TRAILER:
+            # Report to client the number of matched lines
+            trailer = json.loads(payload)
+            if trailer['line_count']:
+                self.line_dict.setdefault(server_info['id'], trailer['line_count'])
+            for path, count in trailer.get('files', {}).iteritems():
+                self.file_dict[server_info['id'], path] = count
+            if 'aggregate' in trailer:
+                self.aggregate_dict[server_info['id']] = trailer['aggregate']
+            LOGGER.info('Done with Server-%s' % server_info['id'])
+        elif kind == protocol.ERROR:
+            LOGGER.error('Server-%s %s' % (server_info['id'], payload))
+            self.failed.append(server_info['id'])
+        else:
+            LOGGER.error('Server-%s sent unexpected frame (%s)' % (server_info['id'], kind))
+            conn.close()
+            self.failed.append(server_info['id'])
+        return True
 
     def query(self):
-        # Designate a seperate worker thread to query each server 
-        threads = []
+        # Every server has until the same deadline to finish its part
+        deadline = time.time() + float(self.conf['timeout'])
+
+        # Connection -> state of its part of the query
+        pending = {}
         for server_info in self.conf['server_list']:
-            worker_thread = LogQueryThread(self, server_info, self.grep_cmd)
-            worker_thread.start()
-            threads.append(worker_thread)
+            # A server may listen on a port of its own, as local ones for benchmarks do
+            conn = self.connections.get(server_info, server_info.get('port', self.conf['port']))
+            state = {'answered': False, 'printed': 0}
+            try:
+                self.start(conn, state)
+                pending[conn] = state
+            except socket.error, e:
+                self.fail(conn, state, e)
+
+        # Serve all the connections in one loop, printing results as they arrive
+        while pending:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            readers = [c for c in pending if not c.connecting]
+            writers = [c for c in pending if c.wants_write()]
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+
+            for conn in writable:
+                try:
+                    conn.handle_write()
+                except socket.error, e:
+                    if self.fail(conn, pending[conn], e):
+                        del pending[conn]
 
-        # Do not promot to next query until all threads in this one have finished
-        #   A.K.A. barrier
-        for t in threads:
-            t.join()
+            for conn in readable:
+                if conn not in pending or not conn.is_open():
+                    continue
+                try:
+                    for kind, payload in conn.handle_read():
+                        if conn.skip:
+                            # The rest of a result cancelled by an earlier query
+                            if kind in (protocol.TRAILER, protocol.ERROR):
+                                conn.skip -= 1
+                            continue
+                        if self.handle_frame(conn, pending[conn], kind, payload):
+                            del pending[conn]
+                            break
+                except (socket.error, EOFError), e:
+                    if self.fail(conn, pending[conn], e):
+                        del pending[conn]
+
+            # Enough lines are printed, the other servers need not go on
+            if self.printed == self.limit and pending:
+                for conn, state in pending.iteritems():
+                    conn.cancel()
+                    self.cancelled.append(conn.server_info['id'])
+                    if state['printed']:
+                        self.line_dict[conn.server_info['id']] = state['printed']
+                pending = {}
+
+        # The rest of a late result would mix into the next query, drop the connection
+        for conn in pending:
+            conn.close()
+            self.timed_out.append(conn.server_info['id'])
+        if self.own_connections:
+            self.connections.close()
 
         # Do statistics of the results
         self.total_line = reduce(operator.add, self.line_dict.values()) if self.line_dict else 0
         LOGGER.info('Totally found %d lines.' % self.total_line)
         LOGGER.info('Each server: ' + str(self.line_dict))
+        if len(self.file_dict) > len(self.line_dict):
+            LOGGER.info('Each file: ' + str(self.file_dict))
+        for server_id in sorted(self.wire_dict):
+            LOGGER.info('Server-%s sent %d bytes on the wire, compression ratio %.2f' % (
+                server_id, self.wire_dict[server_id], float(self.raw_dict.get(server_id, 0)) / self.wire_dict[server_id]))
+        if self.cancelled:
+            LOGGER.info('Cancelled servers after %d lines: %s' % (self.printed, sorted(self.cancelled)))
+        if self.timed_out:
+            LOGGER.error('Timed out servers: ' + str(sorted(self.timed_out)))
+        if self.failed:
+            LOGGER.error('Failed servers: ' + str(sorted(self.failed)))
+
+        if self.aggregate:
+            self.aggregate_result = aggregate.merge(self.aggregate, self.aggregate_dict.values())
+            self.print_aggregate()
+
+    def print_aggregate(self):
+        if self.aggregate['type'] == 'top':
+            for value, count in self.aggregate_result:
+                print '%10d %s' % (count, value)
+        elif self.aggregate['type'] == 'histogram':
+            for bucket, count in self.aggregate_result:
+                print '%s %10d' % (bucket, count)
+
+def parse_command(line):
+    """ Split a command into (grep command, options of LogQueryClient)
+
+        count grep ...         -- only count the matched lines
+        top K grep ...         -- the K most frequent values of the first captured group
+        hist [MINUTES] grep ...  -- number of matched lines per MINUTES (1 by default)
+
+        Any of them may be led by 'since TIME' and 'until TIME' to only query lines in
+        the time window, where TIME is like '2015-09-10 14:20' (quoted), both ends included,
+        and by 'limit N' to stop after N lines over all servers.
+    """
+    args = shlex.split(line)
+    options = {}
+    while len(args) > 1 and args[0] in ('since', 'until', 'limit'):
+        options[args[0]] = int(args[1]) if args[0] == 'limit' else args[1]
+        args = args[2:]
+    if not args:
+        return args, options
+    if args[0] == 'count':
+        options['aggregate'] = {'type': 'count'}
+        return args[1:], options
+    elif args[0] == 'top':
+        options['aggregate'] = {'type': 'top', 'k': int(args[1])}
+        return args[2:], options
+    elif args[0] == 'hist':
+        if len(args) > 1 and args[1].isdigit():
+            options['aggregate'] = {'type': 'histogram', 'minutes': int(args[1])}
+            return args[2:], options
+        options['aggregate'] = {'type': 'histogram', 'minutes': 1}
+        return args[1:], options
+    return args, options
 
 def main():
+    # Keep connections to the servers open between queries
+    connections = ConnectionPool()
     while True:
-        grep_cmd = shlex.split(raw_input('DLQ > '))
-        client = LogQueryClient(grep_cmd)
+        try:
+            grep_cmd, options = parse_command(raw_input('DLQ > '))
+        except (ValueError, IndexError):
+            print parse_command.__doc__
+            continue
+        client = LogQueryClient(grep_cmd, connections, **options)
         client.query()
 
 if __name__ == '__main__':
         main()    
-        
\ No newline at end of file
@@ -1,55 +1,69 @@
 #!/usr/bin/env python
 
+import sys
 import random
 import rstr
 import yaml
-import server 
+import server
 
-def gen_testlog():
+# Lines of a pattern are drawn from this many pre-generated samples,
+#   since rstr.xeger per line is far too slow for large logs
+SAMPLES = 4096
+# Lines are written out in batches of this many
+BATCH_LINES = 1 << 14
+
+def gen_lines(test_conf, local_id, total_size):
+    """ Yield total_size lines with exactly the configured number of each kind, in random order """
+    # Kind -> number of lines of it still to generate
+    remaining = {'server %d' % local_id: 1, 'all_server': 1}
+    if local_id in test_conf['hit_servers']:
+        remaining['hit_server'] = 1
+    for t, f in test_conf['frequency'].iteritems():
+        remaining[t] = int(total_size * float(f))
+    if sum(remaining.itervalues()) > total_size:
+        raise ValueError('Frequencies add up to more than %d lines' % total_size)
+
+    samples = {t: [rstr.xeger(p) for _ in xrange(SAMPLES)] for t, p in test_conf['pattern'].iteritems()}
+    random_samples = samples['random']
+    kinds = remaining.keys()
+
+    # Each kind comes next with the chance of its share of the lines left,
+    #   so the counts are exact and every order is equally likely
+    for lines_left in xrange(total_size, 0, -1):
+        r = int(random.random() * lines_left)
+        for t in kinds:
+            r -= remaining[t]
+            if r < 0:
+                remaining[t] -= 1
+                yield random.choice(samples[t]) if t in samples else t
+                break
+        else:
+            yield random.choice(random_samples)
+
+def gen_testlog(log_file=None, total_size=None, local_id=None):
     with open('conf.yaml') as f:
         test_conf = yaml.safe_load(f)['test']
-    total_size = test_conf['size']
-    size_dict = {t : int(total_size * float(f)) for t, f in test_conf['frequency'].iteritems()}
-    local_id = server.find_local_id()
-    
-    # Placeholder
-    log_list = ['' for i in xrange(total_size)]
- 
-    # Gen a line for only this server
-    random_idx = int(random.random() * total_size)
-    log_list[random_idx] = 'server %d' % local_id
-
-    # Gen a line for specified servers
-    if local_id in test_conf['hit_servers']:
-        random_idx = int(random.random() * total_size)
-        while log_list[random_idx]:
-            random_idx = int(random.random() * total_size)
-        log_list[random_idx] = 'hit_server'
-
-    # Gen a line for all servers
-    random_idx = int(random.random() * total_size)
-    while log_list[random_idx]:
-        random_idx = int(random.random() * total_size)
-    log_list[random_idx] = 'all_server'
-
-    # Gen lines for patterns with different frequencies
-    for t, s in size_dict.iteritems():
-        cnt = 0
-        while cnt < s:
-            random_idx = int(random.random() * total_size)
-            while log_list[random_idx]:
-                random_idx = int(random.random() * total_size)
-            log_list[random_idx] = rstr.xeger(test_conf['pattern'][t]) 
-            cnt += 1
-
-    # Gen randomly for the rest
-    for i in xrange(total_size):
-        if not log_list[i]:
-            log_list[i] = rstr.xeger(test_conf['pattern']['random']) 
-     
-    with open('%svm%d.log' % (test_conf['log_path'], local_id), 'w') as f:
-        for i in xrange(total_size):
-            f.write(log_list[i] + '\n')
-         
+    if total_size is None:
+        total_size = test_conf['size']
+    if local_id is None:
+        local_id = server.find_local_id()
+    if log_file is None:
+        log_file = '%svm%d.log' % (test_conf['log_path'], local_id)
+
+    # Stream the lines out, so the size of the log is not bound by memory
+    with open(log_file, 'w') as f:
+        batch = []
+        for line in gen_lines(test_conf, local_id, total_size):
+            batch.append(line)
+            if len(batch) >= BATCH_LINES:
+                f.write('\n'.join(batch) + '\n')
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+
 if __name__ == '__main__':
-    gen_testlog()
\ No newline at end of file
+    # Optionally the number of lines, then the log file
+    gen_testlog(
+        sys.argv[2] if len(sys.argv) > 2 else None,
+        int(sys.argv[1]) if len(sys.argv) > 1 else None,
+    )
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+import os
+import re
+import zlib
+import array
+import bisect
+import struct
+import hashlib
+import logging
+import threading
+import cPickle
+import sre_parse
+import sre_constants
+import query_engine
+
+LOGGER = logging.getLogger('DLQ Index')
+
+# Trigrams are taken from lowercased runs of word characters only,
+#   so a block is indexed with a few regex calls instead of a Python loop per byte
+WORD = re.compile(r'\w{3,}')
+
+# Max number of alternative strings tracked while analyzing a pattern
+MAX_STRINGS = 2048
+# Max size of a character class treated as a set of literals
+MAX_CLASS = 32
+# Repeats beyond this are only analyzed for their first copies
+MAX_REPEAT = 8
+
+# The index file is a series of records, each the length of a pickle and the pickle,
+#   of the blocks indexed since the record before
+RECORD_HEADER = struct.Struct('!I')
+
+def trigrams(s):
+    """ Trigrams of s that can be found in the index """
+    return set(t for w in WORD.findall(s) for t in (w[i:i + 3] for i in xrange(len(w) - 2)))
+
+class Info(object):
+    """ What the strings matched by a piece of regex are known to look like
+
+        exact    -- set of all strings it can match, or None if there are too many
+        prefix   -- set of strings one of which starts every match
+        suffix   -- set of strings one of which ends every match
+        required -- list of string sets, one string of each is in every match
+    """
+
+    def __init__(self, exact=None, prefix=None, suffix=None, required=None):
+        super(Info, self).__init__()
+        self.exact = exact
+        self.prefix = prefix if prefix is not None else set([''])
+        self.suffix = suffix if suffix is not None else set([''])
+        self.required = required or []
+
+UNKNOWN = Info()
+
+def concat(left, right):
+    """ Cross product of two sets of strings, or None if it is too large """
+    if len(left) * len(right) > MAX_STRINGS:
+        return None
+    return set(l + r for l in left for r in right)
+
+def analyze_sequence(infos):
+    """ Combine the infos of consecutive regex items """
+    run = set([''])
+    prefix = None
+    required = []
+
+    def close(run):
+        # A run is only useful when each of its strings has trigrams
+        if all(trigrams(s) for s in run):
+            required.append(run)
+
+    for info in infos:
+        if info.exact is not None:
+            joined = concat(run, info.exact)
+            if joined is None:
+                # Keep the tails of the run so trigrams crossing the cut are still seen
+                close(run)
+                if prefix is None:
+                    prefix = run
+                joined = concat(set(s[-2:] for s in run), info.exact) or info.exact
+            run = joined
+        else:
+            close(concat(run, info.prefix) or run)
+            if prefix is None:
+                prefix = concat(run, info.prefix) or run
+            required.extend(info.required)
+            run = info.suffix
+
+    if prefix is None:
+        return Info(exact=run)
+    return Info(prefix=prefix, suffix=run, required=required)
+
+def analyze_item(op, av):
+    if op == sre_constants.LITERAL:
+        return Info(exact=set([chr(av).lower()]))
+    elif op == sre_constants.AT:
+        # Anchors match no characters
+        return Info(exact=set(['']))
+    elif op == sre_constants.IN:
+        chars = set()
+        for item_op, item_av in av:
+            if item_op == sre_constants.LITERAL:
+                chars.add(chr(item_av).lower())
+            elif item_op == sre_constants.RANGE and item_av[1] - item_av[0] < MAX_CLASS:
+                chars.update(chr(c).lower() for c in xrange(item_av[0], item_av[1] + 1))
+            else:
+                return UNKNOWN
+        return Info(exact=chars) if len(chars) <= MAX_CLASS else UNKNOWN
+    elif op == sre_constants.SUBPATTERN:
+        return analyze_pattern(av[1])
+    elif op == sre_constants.BRANCH:
+        infos = [analyze_pattern(p) for p in av[1]]
+        if all(i.exact is not None for i in infos):
+            union = set().union(*[i.exact for i in infos])
+            if len(union) <= MAX_STRINGS:
+                return Info(exact=union)
+        return UNKNOWN
+    elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        low, high, item = av
+        if low == 0:
+            return UNKNOWN
+        info = analyze_pattern(item)
+        copies = [info] * min(low, MAX_REPEAT)
+        # Whatever follows the required copies is unknown
+        if high != low or low > MAX_REPEAT:
+            copies.append(UNKNOWN)
+        return analyze_sequence(copies)
+    else:
+        return UNKNOWN
+
+def analyze_pattern(pattern):
+    return analyze_sequence([analyze_item(op, av) for op, av in pattern])
+
+def trigram_query(regex):
+    """ Turn a Python regex into a trigram query
+
+        The query is a list of clauses which all have to be satisfied. A clause is a list
+        of alternatives, each a set of trigrams which all have to be present.
+        None is returned if nothing can be extracted, so a full scan is needed.
+    """
+    try:
+        info = analyze_pattern(sre_parse.parse(regex))
+    except (sre_constants.error, ValueError, OverflowError):
+        return None
+
+    if info.exact is not None:
+        string_sets = [info.exact]
+    else:
+        string_sets = [info.prefix] + info.required + [info.suffix]
+
+    query = []
+    for strings in string_sets:
+        alternatives = [trigrams(s) for s in strings]
+        # Any alternative without trigrams makes the whole clause always true
+        if alternatives and all(alternatives):
+            query.append(alternatives)
+    return query or None
+
+class TrigramIndex(object):
+    """ On-disk index of a log file, mapping each trigram to the blocks containing it,
+        and each block to the time its lines start from
+    """
+
+    # Blocks are the unit of narrowing, cut at line ends
+    block_size = 1 << 16
+    # Trailing bytes of the indexed part checked to detect rewritten logs
+    check_size = 1 << 12
+    # Blocks indexed between saves, so a long first build is not lost to a crash
+    save_blocks = 1 << 10
+    # Records appended to the index file before it is rewritten as one,
+    #   which is also done once they add up to the first, so each block is rewritten a few times at most
+    max_records = 1 << 12
+
+    def __init__(self, log_file, index_path, block_size=None):
+        super(TrigramIndex, self).__init__()
+        self.log_file = log_file
+        if block_size:
+            self.block_size = block_size
+        name = hashlib.md5(os.path.abspath(log_file)).hexdigest()
+        self.index_file = os.path.join(index_path, name + '.tri')
+        # Held while the index is read or a block is added to it
+        self.lock = threading.Lock()
+        # Held by the one update at a time, which only takes lock to add each block
+        self.update_lock = threading.Lock()
+        self.updater = None
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.inode = None
+        # The index covers log_file[:indexed_end], which ends with a whole line
+        self.indexed_end = 0
+        self.indexed_lines = 0
+        self.tail_crc = 0
+        # Start offset and the number of lines before it, per block
+        self.block_starts = array.array('L')
+        self.block_lines = array.array('L')
+        # Timestamp of the first line per block, so the blocks of a time window are found
+        #   without touching the log. Lines without a timestamp go with the line before them.
+        self.block_times = []
+        self.last_time = None
+        # Trigram -> ascending block numbers
+        self.postings = {}
+        # Postings of the blocks added since the last save, and the number of blocks saved
+        self.pending = {}
+        self.saved_blocks = 0
+        # Records in the index file, none to append to once reset, and the bytes of the first and the rest
+        self.records = 0
+        self.base_bytes = 0
+        self.appended_bytes = 0
+
+    def load(self):
+        try:
+            f = open(self.index_file, 'rb')
+        except IOError:
+            LOGGER.info('No index for %s yet, building one' % self.log_file)
+            return
+        with f:
+            pos = 0
+            try:
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+                    if len(header) != RECORD_HEADER.size:
+                        raise ValueError('Torn record')
+                    size, = RECORD_HEADER.unpack(header)
+                    data = f.read(size)
+                    if len(data) != size:
+                        raise ValueError('Torn record')
+                    self.add_record(cPickle.loads(data))
+                    if pos:
+                        self.appended_bytes += f.tell() - pos
+                    else:
+                        self.base_bytes = f.tell()
+                    self.records += 1
+                    pos = f.tell()
+            except Exception, e:
+                if not self.records:
+                    LOGGER.info('No usable index for %s, building a new one' % self.log_file)
+                    self.reset()
+                    return
+                # Only a save cut short by a crash leaves a bad record, the last one, after which the next is appended
+                LOGGER.info('Dropped the end of the index of %s (%s)' % (self.log_file, e))
+                with open(self.index_file, 'r+b') as out:
+                    out.truncate(pos)
+        self.saved_blocks = len(self.block_starts)
+
+    def add_record(self, record):
+        """ Add the blocks of a record of the index file """
+        if record['first_block'] != len(self.block_starts) or (self.records and record['inode'] != self.inode):
+            raise ValueError('Record out of order')
+        if len(record['block_times']) != len(record['block_starts']):
+            raise ValueError('Index without block times')
+        for k in ('inode', 'indexed_end', 'indexed_lines', 'tail_crc', 'last_time'):
+            setattr(self, k, record[k])
+        self.block_starts.extend(record['block_starts'])
+        self.block_lines.extend(record['block_lines'])
+        self.block_times.extend(record['block_times'])
+        for t, blocks in record['postings'].iteritems():
+            if t in self.postings:
+                self.postings[t].extend(blocks)
+            else:
+                self.postings[t] = blocks
+
+    def save(self):
+        """ Append the blocks added since the last save to the index file as a record,
+            or write the whole index as the one record of a new file, if the file is not to be appended to
+            or the records appended add up to the first
+        """
+        rewrite = not self.records or self.records >= self.max_records or self.appended_bytes >= self.base_bytes
+        first = 0 if rewrite else self.saved_blocks
+        record = {
+            'inode': self.inode,
+            'first_block': first,
+            'indexed_end': self.indexed_end,
+            'indexed_lines': self.indexed_lines,
+            'tail_crc': self.tail_crc,
+            'last_time': self.last_time,
+            'block_starts': self.block_starts[first:],
+            'block_lines': self.block_lines[first:],
+            'block_times': self.block_times[first:],
+            'postings': self.postings if rewrite else self.pending,
+        }
+        data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        data = RECORD_HEADER.pack(len(data)) + data
+        if not os.path.exists(os.path.dirname(self.index_file)):
+            os.makedirs(os.path.dirname(self.index_file))
+        if rewrite:
+            # Write aside and rename, so a crash never leaves a torn index
+            temp_file = self.index_file + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.rename(temp_file, self.index_file)
+            self.records, self.base_bytes, self.appended_bytes = 1, len(data), 0
+        else:
+            # A record torn by a crash is dropped on load, leaving the index as of the save before
+            with open(self.index_file, 'ab') as f:
+                f.write(data)
+            self.records += 1
+            self.appended_bytes += len(data)
+        self.saved_blocks = len(self.block_starts)
+        self.pending = {}
+
+    def refresh(self):
+        """ Have the index catch up with the log in a thread of its own, unless one is at it already,
+            while queries go on with what is indexed so far
+        """
+        with self.lock:
+            if self.updater is not None and self.updater.is_alive():
+                return
+            self.updater = threading.Thread(target=self.run_update, name='Indexer')
+            self.updater.daemon = True
+            self.updater.start()
+
+    def run_update(self):
+        try:
+            self.update()
+        except Exception:
+            LOGGER.exception('Failed to index %s' % self.log_file)
+
+    def update(self):
+        """ Index what has been appended to the log since the last update, saving it every save_blocks blocks
+
+            Only this changes the index, so it reads the index without the lock, and takes the lock
+            just to add each block, which is scanned for trigrams before.
+        """
+        with self.update_lock:
+            with open(self.log_file, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if not self.current(f):
+                    if self.inode is not None:
+                        LOGGER.info('%s is rotated or rewritten, reindexing' % self.log_file)
+                    with self.lock:
+                        self.reset()
+                        self.inode = stat.st_ino
+
+                added = 0
+                end = self.indexed_end
+                f.seek(end)
+                while stat.st_size - end >= self.block_size:
+                    block = f.read(self.block_size)
+                    cut = block.rfind('\n') + 1
+                    if not cut:
+                        # A single line longer than a block, take it whole
+                        rest = f.readline()
+                        if not rest.endswith('\n'):
+                            break
+                        block += rest
+                        cut = len(block)
+                    block = block[:cut]
+                    block_trigrams = trigrams(block.lower())
+                    end += cut
+                    tail_crc = self.read_crc(f, end)
+                    f.seek(end)
+                    with self.lock:
+                        self.add_block(block, block_trigrams, tail_crc)
+                    added += 1
+                    if added % self.save_blocks == 0:
+                        self.save()
+
+                if added:
+                    if added % self.save_blocks:
+                        self.save()
+                    LOGGER.info('Indexed %d new blocks of %s' % (added, self.log_file))
+
+    def current(self, f):
+        """ Whether the indexed part is still the start of the log open as f, not rotated or rewritten since """
+        stat = os.fstat(f.fileno())
+        return stat.st_ino == self.inode and stat.st_size >= self.indexed_end and self.read_crc(f, self.indexed_end) == self.tail_crc
+
+    def read_crc(self, f, end):
+        start = max(0, end - self.check_size)
+        f.seek(start)
+        return zlib.crc32(f.read(end - start))
+
+    def add_block(self, block, block_trigrams, tail_crc):
+        block_id = len(self.block_starts)
+        self.block_starts.append(self.indexed_end)
+        self.block_lines.append(self.indexed_lines)
+        self.block_times.append(query_engine.line_time(block, 0, self.last_time))
+        self.last_time = query_engine.line_time(block, block.rfind('\n', 0, len(block) - 1) + 1, self.last_time)
+        for t in block_trigrams:
+            for postings in (self.postings, self.pending):
+                if t not in postings:
+                    postings[t] = array.array('L')
+                postings[t].append(block_id)
+        self.indexed_end += len(block)
+        self.indexed_lines += block.count('\n')
+        self.tail_crc = tail_crc
+
+    def lookup(self, query):
+        """ Numbers of the blocks that may match a trigram query """
+        blocks = None
+        for clause in query:
+            clause_blocks = set()
+            for alternative in clause:
+                alternative_blocks = None
+                for t in alternative:
+                    posting = self.postings.get(t, ())
+                    alternative_blocks = set(posting) if alternative_blocks is None else alternative_blocks.intersection(posting)
+                    if not alternative_blocks:
+                        break
+                clause_blocks.update(alternative_blocks)
+            blocks = clause_blocks if blocks is None else blocks & clause_blocks
+            if not blocks:
+                break
+        return sorted(blocks)
+
+    def window_blocks(self, since, until):
+        """ Numbers of the blocks which may hold lines in a time window, as (first, last + 1) """
+        first, last = 0, len(self.block_times)
+        if since:
+            # A block ends at the time the next one starts from, and the last one at last_time
+            i = bisect.bisect_left(self.block_times, since)
+            if i == last and not self.last_time >= since:
+                first = last
+            else:
+                first = max(0, i - 1)
+        if until:
+            # Times past until at its precision are past until + any more digits
+            last = bisect.bisect_left(self.block_times, until + '\xff')
+        return first, last
+
+    def candidate_ranges(self, regex, since=None, until=None):
+        """ Byte ranges of the log which may match, as (start, end, number of the first line),
+            or None if the whole log needs scanning
+
+            regex        -- pattern the lines have to match, or None for any line
+            since, until -- optional time window the lines have to be in
+        """
+        query = trigram_query(regex) if regex is not None else None
+        if query is None and not (since or until):
+            return None
+
+        with self.lock:
+            with open(self.log_file, 'rb') as f:
+                if not self.current(f):
+                    return None
+            first, last = self.window_blocks(since, until)
+            if query is None:
+                blocks = xrange(first, last)
+            else:
+                blocks = [b for b in self.lookup(query) if first <= b < last]
+            ranges = []
+            for block_id in blocks:
+                start = self.block_starts[block_id]
+                end = self.block_starts[block_id + 1] if block_id + 1 < len(self.block_starts) else self.indexed_end
+                # Merge consecutive blocks into one range
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end, ranges[-1][2])
+                else:
+                    ranges.append((start, end, self.block_lines[block_id] + 1))
+            # The part not indexed yet is always scanned
+            ranges.append((self.indexed_end, None, self.indexed_lines + 1))
+        return ranges
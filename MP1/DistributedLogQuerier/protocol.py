@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import struct
+import json
+
+# Frame layout -- type (1 byte), payload length (4 bytes, big endian), payload
+HEADER = struct.Struct('!cI')
+
+# Codecs a client may offer for the result stream, the only one so far
+CODECS = ['zlib']
+
+# Frame types
+QUERY = 'Q'     # client -> server, JSON encoded query
+CANCEL = 'C'    # client -> server, cancels the queries sent before it
+BATCH = 'B'     # server -> client, a batch of '\n' terminated matched lines
+FILE = 'F'      # server -> client, path of the log the following batches are from
+COMPRESSED = 'Z'  # server -> client, frames of a result compressed as one zlib stream per query,
+                  #   flushed at the end of each so it can be decompressed as it arrives
+TRAILER = 'T'   # server -> client, JSON encoded stats, ends the result of a query
+ERROR = 'E'     # server -> client, error message, ends the result of a query
+
+def pack_frame(kind, payload=''):
+    return HEADER.pack(kind, len(payload)) + payload
+
+def send_frame(sock, kind, payload=''):
+    sock.sendall(pack_frame(kind, payload))
+
+def send_json(sock, kind, obj):
+    send_frame(sock, kind, json.dumps(obj))
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            raise EOFError('Connection closed in the middle of a frame')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_frame(sock):
+    """ Receive a frame as (type, payload), or (None, None) if the peer has closed """
+    header = sock.recv(HEADER.size)
+    if not header:
+        return None, None
+    if len(header) < HEADER.size:
+        header += recv_exactly(sock, HEADER.size - len(header))
+    kind, size = HEADER.unpack(header)
+    return kind, recv_exactly(sock, size)
+
+def split_frames(data):
+    """ Split received bytes into complete frames, return ([(type, payload)], the incomplete rest) """
+    frames = []
+    pos = 0
+    while len(data) - pos >= HEADER.size:
+        kind, size = HEADER.unpack_from(data, pos)
+        if len(data) - pos - HEADER.size < size:
+            break
+        frames.append((kind, data[pos + HEADER.size:pos + HEADER.size + size]))
+        pos += HEADER.size + size
+    return frames, data[pos:]
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+
+import os
+import re
+import mmap
+import gzip
+import getopt
+import itertools
+import logging
+import threading
+import collections
+import Queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = logging.getLogger('DLQ Engine')
+
+# mmap has no count(), newlines in it are counted window by window to bound copies
+COUNT_WINDOW = 1 << 22
+
+# The asctime prefix our loggers put at the start of each line
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', re.MULTILINE)
+# A time window bound is a prefix of the timestamp, down to the day at least
+TIME_BOUND = re.compile(r'\d{4}-\d{2}-\d{2}( \d{2}(:\d{2}(:\d{2})?)?)?$')
+# How far back to look for the timestamp of a line without one
+LOOKBACK = 1 << 16
+
+# POSIX character classes grep understands but Python's re does not
+POSIX_CLASSES = {
+    'alpha': 'a-zA-Z',
+    'digit': '0-9',
+    'alnum': '0-9a-zA-Z',
+    'upper': 'A-Z',
+    'lower': 'a-z',
+    'space': ' \\t\\n\\r\\f\\v',
+    'blank': ' \\t',
+    'punct': '!-/:-@\\[-`{-~',
+    'xdigit': '0-9A-Fa-f',
+    'cntrl': '\\x00-\\x1f\\x7f',
+    'print': ' -~',
+    'graph': '!-~',
+}
+
+def translate_bracket(pattern, i):
+    """ Translate the bracket expression starting at pattern[i], return (next index, regex) """
+    n = len(pattern)
+    j = i + 1
+    out = ['[']
+    if j < n and pattern[j] == '^':
+        out.append('^')
+        j += 1
+    # A leading ']' is a member rather than the end
+    if j < n and pattern[j] == ']':
+        out.append('\\]')
+        j += 1
+    while j < n and pattern[j] != ']':
+        if pattern.startswith('[:', j):
+            k = pattern.find(':]', j + 2)
+            if k != -1 and pattern[j + 2:k] in POSIX_CLASSES:
+                out.append(POSIX_CLASSES[pattern[j + 2:k]])
+                j = k + 2
+                continue
+        # Backslash is not an escape inside POSIX brackets
+        out.append('\\' + pattern[j] if pattern[j] in '\\[' else pattern[j])
+        j += 1
+    if j >= n:
+        raise ValueError('Unmatched [ in pattern')
+    out.append(']')
+    return j + 1, ''.join(out)
+
+def translate_pattern(pattern, extended):
+    """ Translate a grep basic/extended regex into the equivalent Python regex """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n:
+            escaped = pattern[i + 1]
+            i += 2
+            # Word boundaries of GNU grep
+            if escaped in '<>':
+                out.append(r'\b')
+            # In BRE the escaped form is the special one
+            elif not extended and escaped in '(){}|+?':
+                out.append(escaped)
+            else:
+                out.append('\\' + escaped)
+            continue
+
+        if c == '[':
+            i, bracket = translate_bracket(pattern, i)
+            out.append(bracket)
+            continue
+
+        if not extended and c in '(){}|+?':
+            out.append('\\' + c)
+        # A leading '*' has nothing to repeat, grep takes it literally
+        elif c == '*' and (not out or out[-1] in ('^', '(', '|')):
+            out.append('\\*')
+        else:
+            out.append(c)
+        i += 1
+    return ''.join(out)
+
+def is_compressed(path):
+    return path.endswith('.gz') or path.endswith('.zst')
+
+def open_compressed(path):
+    """ Open a compressed log as a stream of its decompressed content """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if zstandard is None:
+        raise ValueError('zstandard is not installed to read %s' % path)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+def map_file(path):
+    """ Map a plain file read-only, or return None if it is empty """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        # The mapping stays valid after the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def count_newlines(buf, start, end):
+    if isinstance(buf, str):
+        return buf.count('\n', start, end)
+    return sum(buf[i:min(i + COUNT_WINDOW, end)].count('\n') for i in xrange(start, end, COUNT_WINDOW))
+
+def line_time(buf, pos, default=None):
+    """ Timestamp of the line starting at pos, or of the closest line before it with one """
+    m = TIMESTAMP.match(buf, pos)
+    if m:
+        return m.group()
+    # Lines without a timestamp, such as those of a traceback, go with the line before them
+    floor = max(0, pos - LOOKBACK)
+    while pos > 0:
+        prev = buf.rfind('\n', floor, pos - 1)
+        if prev == -1 and floor:
+            break
+        pos = prev + 1
+        m = TIMESTAMP.match(buf, pos)
+        if m:
+            return m.group()
+    return default
+
+def find_time(buf, start, end, past):
+    """ Offset of the first line in buf[start:end] with a timestamp past(), or end
+
+        Lines are in time order, so it is found by binary search.
+    """
+    lo, hi, found = start, end, end
+    while lo < hi:
+        mid = (lo + hi) / 2
+        # A timestamp may run over hi, so search on to the end
+        m = TIMESTAMP.search(buf, mid, end)
+        if m is None or m.start() >= hi:
+            hi = mid
+        elif past(m.group()):
+            found, hi = m.start(), mid
+        else:
+            lo = m.end()
+    return found
+
+def scan_part(args):
+    """ Scan a part of a file in a pool worker, return (selected lines, number of lines in it) """
+    query, path, start, end = args
+    buf = map_file(path)
+    try:
+        lines = list(query.scan(buf, start, end))
+        return lines, count_newlines(buf, start, end) if query.line_number else 0
+    finally:
+        buf.close()
+
+class GrepQuery(object):
+    """ A grep command line compiled into an in-process line matcher """
+
+    # Read files in large chunks to amortize the per-chunk overhead of scanning
+    chunk_size = 1 << 22
+    # Large files are cut into parts of about this size to be scanned in parallel
+    part_size = 1 << 24
+    # Files scanned at once by a query over several files
+    file_workers = 8
+    # While other files keep the pool busy too, ranges from this size on are scanned by it
+    min_part_size = 1 << 20
+    # Lines handed over at a time from the threads scanning files at once
+    batch_lines = 1 << 12
+    # Parts of a file handed to the pool at a time, so no more results than this pile up
+    #   while the lines are taken slowly
+    max_parts = 8
+
+    def __init__(self, grep_cmd, since=None, until=None, limit=None):
+        """ since, until -- optional time window of the lines to select, as timestamp
+                          prefixes like '2015-09-10 14:00', both ends included
+            limit        -- optional number of lines to stop selecting at, over all files
+        """
+        super(GrepQuery, self).__init__()
+        if not grep_cmd or grep_cmd[0] != 'grep':
+            raise ValueError('Only grep queries are supported')
+
+        try:
+            opts, args = getopt.gnu_getopt(grep_cmd[1:], 'EFGivcne:m:')
+        except getopt.GetoptError, e:
+            raise ValueError(str(e))
+
+        flags = dict(opts)
+        self.extended = '-E' in flags
+        self.fixed = '-F' in flags
+        self.ignore_case = '-i' in flags
+        self.invert = '-v' in flags
+        self.count = '-c' in flags
+        self.line_number = '-n' in flags
+        try:
+            # Stop reading a file after this many selected lines
+            self.max_count = int(flags['-m']) if '-m' in flags else None
+            self.limit = int(limit) if limit is not None else None
+        except ValueError:
+            raise ValueError('Invalid number of lines')
+
+        patterns = [v for o, v in opts if o == '-e']
+        if not patterns:
+            if not args:
+                raise ValueError('No pattern is given')
+            patterns, args = [args[0]], args[1:]
+        self.files = args
+
+        # Like grep, a pattern with newlines is a list of alternative patterns
+        patterns = list(itertools.chain(*[p.split('\n') for p in patterns]))
+        if self.fixed:
+            regexes = [re.escape(p) for p in patterns]
+        else:
+            regexes = [translate_pattern(p, self.extended) for p in patterns]
+        self.pattern = regexes[0] if len(regexes) == 1 else '|'.join('(?:%s)' % r for r in regexes)
+
+        try:
+            self.regex = re.compile(self.pattern, re.MULTILINE | (re.IGNORECASE if self.ignore_case else 0))
+        except re.error, e:
+            raise ValueError('Invalid pattern (%s): %s' % (self.pattern, e))
+
+        for bound in (since, until):
+            if bound is not None and not TIME_BOUND.match(bound):
+                raise ValueError('Invalid time (%s), expecting YYYY-MM-DD[ HH[:MM[:SS]]]' % bound)
+        # Bounds from JSON are unicode, while the logs are compared as bytes
+        self.since = str(since) if since else None
+        self.until = str(until) if until else None
+
+        # Number of selected lines over all files, and per file
+        self.line_count = 0
+        self.file_counts = collections.Counter()
+        # Optional function telling whether the query is given up, checked between parts and chunks
+        self.cancelled = None
+
+    def stopped(self):
+        """ Whether to scan no further, once the limit is reached or the query is cancelled """
+        if self.limit is not None and self.line_count >= self.limit:
+            return True
+        return self.cancelled is not None and self.cancelled()
+
+    def __getstate__(self):
+        """ The query as sent to pool workers, which scan their part whole and have no use
+            for the cancel hook, a closure over the server's connection that cannot be pickled
+        """
+        state = self.__dict__.copy()
+        state['cancelled'] = None
+        return state
+
+    def run(self, narrow=None, pool=None, cache=None):
+        """ Yield the output lines grep would print for the query, see select() for the arguments """
+        labeled = len(self.files) > 1
+        for path, line in self.run_files(narrow, pool, cache):
+            yield '%s:%s' % (path, line) if labeled else line
+
+    def run_files(self, narrow=None, pool=None, cache=None):
+        """ Yield (path, output line without the path) of what grep would print for the query
+
+            Lines of different files may come interleaved, but those of a file come in order.
+        """
+        if self.count:
+            for _ in self.select(narrow, pool, cache):
+                pass
+            # A zero count used to be dropped with grep's non-zero exit status
+            if self.line_count:
+                for path in self.files:
+                    yield path, str(self.file_counts[path])
+            return
+
+        for path, lineno, line in self.select(narrow, pool, cache):
+            yield path, ('%d:' % lineno if self.line_number else '') + line
+
+    def select(self, narrow=None, pool=None, cache=None):
+        """ Yield (path, line number, line) of each line selected over all the files
+
+            narrow -- optional function of (path, query) returning the byte ranges
+                      of the file that can match, or None to scan it all
+            pool   -- optional multiprocessing pool to scan parts of large files,
+                      and several files at once
+            cache  -- optional ResultCache to reuse the results of earlier queries
+        """
+        if self.limit is not None and self.limit <= 0:
+            return
+        if pool is not None and len(self.files) > 1:
+            batches = self.scan_files(narrow, pool, cache)
+        else:
+            batches = ((path, self.scan_one(path, narrow, pool, cache)) for path in self.files)
+        try:
+            for path, selected in batches:
+                for lineno, line in selected:
+                    self.line_count += 1
+                    self.file_counts[path] += 1
+                    yield path, lineno, line
+                    # Whatever is still being scanned is dropped
+                    if self.line_count == self.limit:
+                        return
+        finally:
+            batches.close()
+
+    def scan_one(self, path, narrow=None, pool=None, cache=None):
+        if cache is not None:
+            selected = cache.scan(self, path, narrow, pool)
+        else:
+            selected = self.scan_file(path, narrow(path, self) if narrow else None, pool)
+        if self.max_count is not None:
+            return itertools.islice(selected, self.max_count)
+        return selected
+
+    def scan_files(self, narrow, pool, cache):
+        """ Scan the files at once, yield (path, [(line number, line)]) batches as they are found
+
+            The threads here only walk the files, the scanning is done by the pool.
+        """
+        paths = Queue.Queue()
+        for path in self.files:
+            paths.put(path)
+        batches = Queue.Queue(self.file_workers * 4)
+        stopped = threading.Event()
+
+        def put(item):
+            # Give up once the batches are no longer taken
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def scan():
+            try:
+                while True:
+                    try:
+                        path = paths.get_nowait()
+                    except Queue.Empty:
+                        return
+                    batch = []
+                    for item in self.scan_one(path, narrow, pool, cache):
+                        batch.append(item)
+                        if len(batch) >= self.batch_lines:
+                            if not put((path, batch)):
+                                return
+                            batch = []
+                    if batch and not put((path, batch)):
+                        return
+            except Exception, e:
+                put((None, e))
+            finally:
+                put(None)
+
+        workers = [threading.Thread(target=scan) for _ in xrange(min(self.file_workers, len(self.files)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            running = len(workers)
+            while running:
+                item = batches.get()
+                if item is None:
+                    running -= 1
+                elif item[0] is None:
+                    raise item[1]
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+    def scan_file(self, path, ranges=None, pool=None):
+        """ Yield (line number, line) of each selected line in the file
+
+            ranges -- optional list of (start, end, number of the first line) to scan
+                      only parts of the file, where end is None for the end of file
+        """
+        # Compressed logs can only be read through from the start
+        if is_compressed(path):
+            stream = open_compressed(path)
+            try:
+                for item in self.scan_stream(stream):
+                    yield item
+            finally:
+                stream.close()
+            return
+
+        # Match right over the mapped file, only the selected lines are copied out
+        buf = map_file(path)
+        if buf is None:
+            return
+        try:
+            for start, end, first_line in ranges or [(0, None, 1)]:
+                end = len(buf) if end is None else min(end, len(buf))
+                if self.since or self.until:
+                    window_start, end = self.time_window(buf, start, end)
+                    if self.line_number:
+                        first_line += count_newlines(buf, start, window_start)
+                    start = window_start
+                    if start >= end:
+                        continue
+                min_size = self.min_part_size if len(self.files) > 1 else 2 * self.part_size
+                if pool is None or end - start < min_size:
+                    # Chunk by chunk, so a rare pattern is not searched for to the end once stopped
+                    for chunk_start, chunk_end in self.split_range(buf, start, end, self.chunk_size):
+                        if self.stopped():
+                            return
+                        for idx, line in self.scan(buf, chunk_start, chunk_end):
+                            yield first_line + idx, line
+                        if self.line_number:
+                            first_line += count_newlines(buf, chunk_start, chunk_end)
+                    continue
+
+                # Parts come back in order, so lines are numbered as they do
+                base = first_line
+                for lines, newlines in self.scan_parts(pool, path, self.split_range(buf, start, end)):
+                    for idx, line in lines:
+                        yield base + idx, line
+                    base += newlines
+        finally:
+            buf.close()
+
+    def scan_parts(self, pool, path, parts):
+        """ Yield what scan_part() returns for each (start, end) part in order,
+            with max_parts of them in the pool at most
+        """
+        pending = collections.deque()
+        for start, end in parts:
+            # Parts in the pool already run to their end, but no more are handed to it
+            if self.stopped():
+                return
+            pending.append(pool.apply_async(scan_part, [(self, path, start, end)]))
+            if len(pending) >= self.max_parts:
+                yield pending.popleft().get()
+        while pending and not self.stopped():
+            yield pending.popleft().get()
+
+    def split_range(self, buf, start, end, size=None):
+        """ Cut buf[start:end] into parts of about size, part_size by default, at line ends """
+        size = size or self.part_size
+        parts = []
+        while end - start > size:
+            cut = buf.find('\n', start + size, end) + 1
+            if not cut or cut >= end:
+                break
+            parts.append((start, cut))
+            start = cut
+        parts.append((start, end))
+        return parts
+
+    def scan_stream(self, stream):
+        """ Yield (line number, line) of each selected line read from a stream, chunk by chunk """
+        windowed = self.since or self.until
+        base = 1
+        rest = ''
+        # Timestamp of the last line of the chunks read so far
+        last_time = None
+        while True:
+            if self.stopped():
+                return
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            buf = rest + data
+            # Keep the unterminated last line for the next chunk
+            cut = buf.rfind('\n') + 1
+            start, end = self.time_window(buf, 0, cut, last_time) if windowed else (0, cut)
+            for idx, line in self.scan(buf, start, end):
+                yield base + buf.count('\n', 0, start) + idx, line
+            # Lines are in time order, none after the window can be in it
+            if end < cut:
+                return
+            if windowed:
+                last_time = line_time(buf, cut, last_time)
+            base += buf.count('\n', 0, cut)
+            rest = buf[cut:]
+        if rest:
+            start, end = self.time_window(rest, 0, len(rest), last_time) if windowed else (0, len(rest))
+            for idx, line in self.scan(rest, start, end):
+                yield base + idx, line
+
+    def past_since(self, time):
+        return time is not None and time[:len(self.since)] >= self.since
+
+    def past_until(self, time):
+        return time is not None and time[:len(self.until)] > self.until
+
+    def time_window(self, buf, start, end, before=None):
+        """ Cut buf[start:end] down to the lines in the time window, return (start, end)
+
+            before -- timestamp of the lines before buf, if it does not hold them
+        """
+        time = line_time(buf, start, before)
+        window_start, window_end = start, end
+        if self.since and not self.past_since(time):
+            window_start = find_time(buf, start, end, self.past_since)
+        if self.until:
+            window_end = start if self.past_until(time) else find_time(buf, start, end, self.past_until)
+        return window_start, window_end
+
+    def scan(self, buf, start=0, end=None):
+        """ Yield (line index from start, line) of each selected line in buf[start:end] """
+        if end is None:
+            end = len(buf)
+        if self.invert:
+            return self._scan_inverted(buf, start, end)
+        return self._scan_matched(buf, start, end)
+
+    def _matched_spans(self, buf, start, end):
+        # Search the whole buffer at once and only cut out the lines hit,
+        #   which is much faster than testing line by line
+        search = self.regex.search
+        pos = start
+        while pos < end:
+            m = search(buf, pos, end)
+            if not m:
+                return
+            hit = m.start()
+            line_start = buf.rfind('\n', pos, hit) + 1 or pos
+            # An empty match right after the last newline is not a line
+            if line_start == end:
+                return
+            line_end = buf.find('\n', hit, end)
+            if line_end == -1:
+                line_end = end
+            # A match running over the line end only counts if the line matches alone
+            if m.end() <= line_end or search(buf[line_start:line_end]):
+                yield line_start, line_end
+            pos = line_end + 1
+
+    def _scan_matched(self, buf, start, end):
+        idx, last = 0, start
+        for line_start, line_end in self._matched_spans(buf, start, end):
+            # Counting lines is only worth it when they are numbered
+            if self.line_number:
+                idx += count_newlines(buf, last, line_start)
+                last = line_start
+            yield idx, buf[line_start:line_end]
+
+    def _scan_inverted(self, buf, start, end):
+        idx, pos = 0, start
+        spans = itertools.chain(self._matched_spans(buf, start, end), [(end, end)])
+        for line_start, line_end in spans:
+            # Every line between two matched lines is selected
+            for line in self._lines(buf, pos, line_start):
+                yield idx, line
+                idx += 1
+            if line_start == end:
+                return
+            idx += 1
+            pos = line_end + 1
+
+    def _lines(self, buf, start, end):
+        # Cut out chunk_size at most at a time, rather than the whole of buf[start:end]
+        while start < end:
+            stop = end
+            if end - start > self.chunk_size:
+                stop = buf.rfind('\n', start, start + self.chunk_size) + 1 or buf.find('\n', start + self.chunk_size, end) + 1 or end
+            piece = buf[start:stop]
+            if piece.endswith('\n'):
+                piece = piece[:-1]
+            for line in piece.split('\n'):
+                yield line
+            start = stop
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import zlib
+import logging
+import threading
+import collections
+import query_engine
+
+LOGGER = logging.getLogger('DLQ Cache')
+
+# Rough per line overhead of a cached (line number, line) tuple
+LINE_OVERHEAD = 64
+
+def clip_ranges(ranges, end):
+    """ Cut (start, end, number of the first line) ranges off at end """
+    clipped = []
+    for range_start, range_end, first_line in ranges:
+        if range_start >= end:
+            break
+        clipped.append((range_start, end if range_end is None else min(range_end, end), first_line))
+    return clipped
+
+class ResultCache(object):
+    """ LRU cache of the lines selected by queries, kept valid as logs grow """
+
+    # Trailing bytes of the cached part checked to detect rewritten logs
+    check_size = 1 << 12
+
+    def __init__(self, max_bytes):
+        super(ResultCache, self).__init__()
+        self.max_bytes = max_bytes
+        # A single result may take this share of the cache at most
+        self.max_entry_bytes = max_bytes / 8
+        # Key -> entry, from the least to the most recently used
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        if entry['bytes'] > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old['bytes']
+            self.entries[key] = entry
+            self.bytes += entry['bytes']
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted['bytes']
+
+    def crc(self, buf, end):
+        return zlib.crc32(buf[max(0, end - self.check_size):end])
+
+    def scan(self, query, path, narrow=None, pool=None):
+        """ Yield what query.scan_file() would for path, scanning only what the cache lacks """
+        # Output options do not change which lines are selected
+        key = (query.pattern, query.ignore_case, query.invert, query.line_number, query.since, query.until,
+               os.path.abspath(path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # A missing or rotated log is left for the scan to report, as it is without the cache
+            for item in query.scan_file(path, None, pool):
+                yield item
+            return
+        version = (stat.st_ino, stat.st_size, stat.st_mtime)
+        entry = self.get(key)
+
+        if query_engine.is_compressed(path):
+            # A compressed log is never appended to, it is valid as a whole or not at all
+            if entry is not None and entry['version'] == version:
+                LOGGER.info('Cache hit for %s' % path)
+                for item in entry['items']:
+                    yield item
+                return
+            cached, ranges, end, crc, lines = [], None, None, 0, 0
+        else:
+            buf = query_engine.map_file(path)
+            if buf is None:
+                return
+            try:
+                # Logs are appended to, so a cached prefix stays valid unless the log is rotated or rewritten
+                if entry is not None and entry['version'][0] == stat.st_ino and entry['end'] <= len(buf) and \
+                        (entry['version'] == version or self.crc(buf, entry['end']) == entry['crc']):
+                    LOGGER.info('Cache hit for %s, %d new bytes to scan' % (path, len(buf) - entry['end']))
+                    cached, start, lines = entry['items'], entry['end'], entry['lines']
+                    ranges = [(start, None, lines + 1)]
+                else:
+                    cached, start, lines = [], 0, 0
+                    ranges = (narrow(path, query) if narrow else None) or [(0, None, 1)]
+                # Only whole lines are cached, the line being written is scanned every time
+                end = buf.rfind('\n', start) + 1 or start
+                crc = self.crc(buf, end)
+                if query.line_number:
+                    lines += query_engine.count_newlines(buf, start, end)
+            finally:
+                buf.close()
+            ranges = clip_ranges(ranges, end)
+
+        for item in cached:
+            yield item
+
+        # Collect the new lines until they are too many to cache
+        items, items_bytes = [], 0
+        if ranges != []:
+            for item in query.scan_file(path, ranges, pool):
+                if items is not None:
+                    items.append(item)
+                    items_bytes += len(item[1]) + LINE_OVERHEAD
+                    if items_bytes > self.max_entry_bytes:
+                        items = None
+                yield item
+
+        # A scan stopped early has not got all the lines
+        if query.stopped():
+            return
+        if items is not None and (entry is None or entry['version'] != version or items):
+            if cached:
+                # Cached lists are never changed in place, so they can be shared
+                items = cached + items if items else cached
+                items_bytes += entry['bytes']
+            self.put(key, {
+                'version': version,
+                'end': end,
+                'crc': crc,
+                'lines': lines,
+                'items': items,
+                'bytes': items_bytes,
+            })
+
+        if end is not None:
+            for item in query.scan_file(path, [(end, None, lines + 1)]):
+                yield item
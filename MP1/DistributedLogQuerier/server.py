@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 
+import os
+import glob
 import yaml
+import argparse
 import logging
-import socket, SocketServer
+import socket
+import select
+import errno
+import zlib
 import threading
-import subprocess
+import multiprocessing
+import collections
+import Queue
 import json
+import query_engine
+import protocol
+import log_index
+import result_cache
+import aggregate
 
 logging.basicConfig(
     level=logging.DEBUG, 
@@ -16,6 +29,8 @@ logging.basicConfig(
 
 LOGGER = logging.getLogger('DLQ Server')
 
+BUSY = 'Server is busy, try again later'
+
 def find_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(('8.8.8.8', 0))
@@ -29,48 +44,440 @@ def find_local_id():
         if s['ip'] == ip:
             return s['id']
 
-class LogQueryRequestHandler(SocketServer.BaseRequestHandler):
-    """ The request handler to deal with incoming log queries """
-
-    def handle(self):
-        request = self.request.recv(1024).strip()
-        grep_cmd = json.loads(request)
-
-        handler_thread = threading.current_thread()
-        LOGGER.info('Handler thread starts querying [%s]' % ' '.join(grep_cmd))
-        
-        try: 
-            output = subprocess.check_output(grep_cmd)
-            # Leave out the ending '\n'
-            output = output[:-1]
-            line_count = len(output.split('\n'))
-            LOGGER.info('Found %d lines.' % line_count)
-        except subprocess.CalledProcessError, e:
-            LOGGER.info('No matched lines.')
-            output = ''
-        except Exception, e:
-            LOGGER.info(e.strerror)
-        finally:
-            self.request.sendall(output)
-
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    """ The server to communicate with clients """
-        
+class ConnectionClosed(Exception):
+    """ The client of a query has gone away """
+
+class QueryCancelled(Exception):
+    """ The client has cancelled the query """
+
+class QueryConnection(object):
+    """ A client connection, read and written by the event loop only """
+
+    def __init__(self, server, sock, address):
+        super(QueryConnection, self).__init__()
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.in_buffer = ''
+
+        # Frames waiting to be written, filled by workers
+        self.out_frames = collections.deque()
+        self.out_bytes = 0
+        self.lock = threading.Condition()
+        self.closed = False
+
+        # Queries waiting to run, one after another
+        self.requests = collections.deque()
+        self.busy = False
+        # Queries are numbered as they come, a cancel covers all those before it
+        self.received = 0
+        self.cancelled_through = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, kind, payload='', wait=True):
+        """ Queue a frame to be written, blocking the worker while the client lags behind """
+        with self.lock:
+            while wait and self.out_bytes >= self.server.max_buffer and not self.closed:
+                self.lock.wait()
+            if self.closed:
+                raise ConnectionClosed()
+            frame = protocol.pack_frame(kind, payload)
+            self.out_frames.append(frame)
+            self.out_bytes += len(frame)
+        self.server.wake()
+
+    def send_json(self, kind, obj):
+        self.send(kind, json.dumps(obj))
+
+    def wants_write(self):
+        return bool(self.out_frames)
+
+    def handle_write(self):
+        with self.lock:
+            while self.out_frames:
+                frame = self.out_frames[0]
+                try:
+                    sent = self.sock.send(frame)
+                except socket.error, e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self.out_bytes -= sent
+                if sent < len(frame):
+                    self.out_frames[0] = frame[sent:]
+                    break
+                self.out_frames.popleft()
+            # Let workers blocked on a full buffer go on
+            self.lock.notify_all()
+
+    def handle_read(self):
+        """ Receive what has arrived, return the requests completed by it """
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if not data:
+            raise EOFError('Connection closed by client')
+        frames, self.in_buffer = protocol.split_frames(self.in_buffer + data)
+        if len(self.in_buffer) > self.server.max_request:
+            raise ValueError('Request too large')
+
+        requests = []
+        for kind, payload in frames:
+            if kind == protocol.QUERY:
+                self.received += 1
+                requests.append((self.received, json.loads(payload)))
+            elif kind == protocol.CANCEL:
+                self.cancelled_through = self.received
+            else:
+                raise ValueError('Unexpected frame (%s) instead of a query' % kind)
+        return requests
+
+    def is_cancelled(self, seq):
+        return seq <= self.cancelled_through
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.out_frames.clear()
+            self.out_bytes = 0
+            self.lock.notify_all()
+        self.sock.close()
+
+class ResultWriter(object):
+    """ Writes the frames of a result, compressing them once they add up to enough """
+
+    def __init__(self, conn, compress_conf=None):
+        super(ResultWriter, self).__init__()
+        self.conn = conn
+        # None unless the client takes compressed frames
+        self.compress_conf = compress_conf
+        self.raw_bytes = 0
+        self.deflate = None
+        self.compressed_in = 0
+        self.compressed_out = 0
+
+    def send(self, kind, payload):
+        frame = protocol.pack_frame(kind, payload)
+        self.raw_bytes += len(frame)
+        # Small results are not worth the time to compress
+        if self.deflate is None and self.compress_conf and self.raw_bytes >= self.compress_conf['min_bytes']:
+            self.deflate = zlib.compressobj(self.compress_conf['level'])
+        if self.deflate is None:
+            self.conn.send(kind, payload)
+            return
+
+        data = self.deflate.compress(frame) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.conn.send(protocol.COMPRESSED, data)
+        self.compressed_in += len(frame)
+        self.compressed_out += len(data)
+        # Lines which hardly compress go back to being sent as they are
+        if self.compressed_in >= self.compress_conf['check_bytes'] and \
+                self.compressed_in < self.compress_conf['min_ratio'] * self.compressed_out:
+            LOGGER.info('Result compresses by %.2f only, sending the rest uncompressed'
+                        % (float(self.compressed_in) / self.compressed_out))
+            self.deflate = None
+            self.compress_conf = None
+
+class LogQueryServer(object):
+    """ The server to communicate with clients
+
+        One event loop serves all the connections, while queries are run by
+        a bounded number of worker threads.
+    """
+
+    # Send matched lines in batches as they are found instead of all at once
+    batch_size = 1 << 16
+    # Max size of a request frame
+    max_request = 1 << 20
+
+    def __init__(self, server_address, conf, pool=None):
+        super(LogQueryServer, self).__init__()
+        self.conf = conf
+        serve_conf = conf['serve']
+        # Bytes queued for a client before its query waits for it to catch up
+        self.max_buffer = serve_conf['max_buffer']
+        # Queries beyond this many running or waiting ones are turned away
+        self.max_queries = serve_conf['max_queries']
+        self.active_queries = 0
+        self.active_lock = threading.Lock()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(server_address)
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        self.server_address = self.listener.getsockname()
+
+        # Workers write to this pipe to wake the event loop up when they have output
+        self.wake_read, self.wake_write = os.pipe()
+        self.running = False
+        self.connections = {}
+
+        # Connections with queries to run
+        self.jobs = Queue.Queue()
+        for i in xrange(serve_conf['workers']):
+            worker = threading.Thread(target=self.work, name='Worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+        # Worker processes shared by all queries to scan large logs in parallel
+        self.pool = pool
+        self.cache = result_cache.ResultCache(conf['cache']['max_bytes']) if 'cache' in conf else None
+        # Log file -> its trigram index, shared by all workers
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+
+    def wake(self):
+        os.write(self.wake_write, 'x')
+
+    def serve_forever(self):
+        LOGGER.info('Start serving on %s:%d' % self.server_address)
+        poller = select.poll()
+        poller.register(self.listener, select.POLLIN)
+        poller.register(self.wake_read, select.POLLIN)
+        # fd -> events it is registered for
+        registered = {}
+
+        self.running = True
+        while self.running:
+            # Ask for writability only of the connections with output
+            for fd, conn in self.connections.items():
+                events = select.POLLIN | (select.POLLOUT if conn.wants_write() else 0)
+                if registered.get(fd) != events:
+                    poller.register(fd, events)
+                    registered[fd] = events
+
+            for fd, events in poller.poll():
+                if fd == self.listener.fileno():
+                    self.accept()
+                elif fd == self.wake_read:
+                    os.read(self.wake_read, 1 << 12)
+                elif fd in self.connections:
+                    conn = self.connections[fd]
+                    try:
+                        if events & select.POLLOUT:
+                            conn.handle_write()
+                        if events & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                            for seq, request in conn.handle_read():
+                                self.admit(conn, seq, request)
+                    except (socket.error, EOFError, ValueError), e:
+                        LOGGER.info('Connection from %s:%d lost: %s' % (conn.address + (e,)))
+                        poller.unregister(fd)
+                        del registered[fd]
+                        del self.connections[fd]
+                        conn.close()
+
+        for conn in self.connections.values():
+            conn.close()
+        self.listener.close()
+
+    def shutdown(self):
+        self.running = False
+        self.wake()
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        sock.setblocking(0)
+        self.connections[sock.fileno()] = QueryConnection(self, sock, address)
+
+    def admit(self, conn, seq, request):
+        with self.active_lock:
+            admitted = self.active_queries < self.max_queries
+            if admitted:
+                self.active_queries += 1
+        if not admitted:
+            LOGGER.info('Turning away a query, %d queries are active' % self.max_queries)
+
+        with conn.lock:
+            if conn.busy:
+                # Answers go back in the order of the queries, even the busy ones
+                conn.requests.append((seq, request if admitted else None))
+                return
+            if admitted:
+                conn.requests.append((seq, request))
+                conn.busy = True
+        if admitted:
+            # The queries of a connection run in order on one worker
+            self.jobs.put(conn)
+        else:
+            # The event loop itself must never wait for a client
+            conn.send(protocol.ERROR, BUSY, wait=False)
+
+    def work(self):
+        while True:
+            conn = self.jobs.get()
+            while True:
+                with conn.lock:
+                    if not conn.requests:
+                        conn.busy = False
+                        break
+                    seq, request = conn.requests.popleft()
+                try:
+                    if request is None:
+                        conn.send(protocol.ERROR, BUSY)
+                        continue
+                    try:
+                        self.handle_query(conn, seq, request)
+                    finally:
+                        with self.active_lock:
+                            self.active_queries -= 1
+                except ConnectionClosed:
+                    LOGGER.info('Client left before the query finished')
+                except Exception, e:
+                    LOGGER.exception('Query failed')
+                    # Whatever went wrong, the client is told rather than left waiting out its timeout
+                    try:
+                        conn.send(protocol.ERROR, 'Query failed: %s' % e)
+                    except ConnectionClosed:
+                        pass
+
+    def handle_query(self, conn, seq, request):
+        grep_cmd = request['cmd']
+        LOGGER.info('Worker starts querying [%s]' % ' '.join(grep_cmd))
+
+        try:
+            query = query_engine.GrepQuery(grep_cmd, request.get('since'), request.get('until'), request.get('limit'))
+            query.part_size = self.conf['scan']['part_size']
+            query.file_workers = self.conf['scan']['files']
+            query.max_parts = self.conf['scan']['parts']
+            query.cancelled = lambda: conn.is_cancelled(seq)
+            query.files = self.log_files(query)
+            trailer = {}
+            if request.get('aggregate'):
+                # Only the aggregate is sent back, not the lines
+                selected = query.select(self.narrow, self.pool, self.cache)
+                trailer['aggregate'] = aggregate.compute(request['aggregate'], query, (l for _, _, l in selected))
+                if conn.is_cancelled(seq):
+                    trailer['cancelled'] = True
+            else:
+                # Compress only what the client has offered to take
+                compress = 'compress' in self.conf and 'zlib' in request.get('compress', [])
+                writer = ResultWriter(conn, self.conf['compress'] if compress else None)
+                try:
+                    self.send_lines(writer, query.run_files(self.narrow, self.pool, self.cache),
+                                    lambda: conn.is_cancelled(seq))
+                except QueryCancelled:
+                    LOGGER.info('Query cancelled by the client')
+                    trailer['cancelled'] = True
+
+            if query.line_count:
+                LOGGER.info('Found %d lines.' % query.line_count)
+            else:
+                LOGGER.info('No matched lines.')
+            trailer['line_count'] = query.line_count
+            trailer['files'] = dict(query.file_counts)
+            conn.send_json(protocol.TRAILER, trailer)
+        except ValueError, e:
+            LOGGER.info('Bad query: %s' % e)
+            conn.send(protocol.ERROR, str(e))
+        except EnvironmentError, e:
+            LOGGER.info(str(e))
+            conn.send(protocol.ERROR, str(e))
+
+    def send_lines(self, writer, lines, cancelled):
+        """ Send (path, line) in batches, each file led by a FILE frame,
+            until there are no more lines or cancelled() is true
+        """
+        if cancelled():
+            raise QueryCancelled()
+        batch, batch_len, batch_path = [], 0, None
+        for path, line in lines:
+            if cancelled():
+                raise QueryCancelled()
+            if path != batch_path or batch_len >= self.batch_size:
+                if batch:
+                    writer.send(protocol.BATCH, ''.join(batch))
+                # Lines of several files come interleaved when they are scanned at once
+                if path != batch_path:
+                    writer.send(protocol.FILE, path)
+                batch, batch_len, batch_path = [], 0, path
+            batch.append(line + '\n')
+            batch_len += len(line) + 1
+        # The scan stops as well once cancelled, maybe before another line is found
+        if cancelled():
+            raise QueryCancelled()
+        if batch:
+            writer.send(protocol.BATCH, ''.join(batch))
+
+    def log_files(self, query):
+        """ Expand the globs a query names, or those of the logs this server has if it names none """
+        files = []
+        for pattern in query.files or self.conf.get('logs', []):
+            matched = sorted(glob.glob(pattern))
+            # A missing plain path is left for the scan to report
+            if not matched and not glob.has_magic(pattern):
+                matched = [pattern]
+            for f in matched:
+                if f not in files:
+                    files.append(f)
+        if not files:
+            raise ValueError('No log file to query')
+        return files
+
+    def narrow(self, path, query):
+        # Lines selected by -v are those without the pattern, which no trigram can tell
+        regex = None if query.invert else query.pattern
+        if regex is None and not (query.since or query.until):
+            return None
+        if query_engine.is_compressed(path) or 'index' not in self.conf:
+            return None
+        try:
+            index = self.get_index(path)
+            # Indexing runs in the background, the part of the log not indexed yet is scanned meanwhile
+            index.refresh()
+            return index.candidate_ranges(regex, query.since, query.until)
+        except (IOError, OSError), e:
+            LOGGER.info('Index of %s is unusable (%s), scanning in full' % (path, e))
+            return None
+
+    def index_logs(self):
+        """ Start indexing the logs of this server in the background, before queries ask for them """
+        if 'index' not in self.conf:
+            return
+        for pattern in self.conf.get('logs', []):
+            for path in sorted(glob.glob(pattern)):
+                if not query_engine.is_compressed(path):
+                    self.get_index(path).refresh()
+
+    def get_index(self, log_file):
+        with self.indexes_lock:
+            if log_file not in self.indexes:
+                index_conf = self.conf['index']
+                self.indexes[log_file] = log_index.TrigramIndex(log_file, index_conf['path'], index_conf.get('block_size'))
+            return self.indexes[log_file]
+
 def main():
-    with open('conf.yaml') as f:
+    parser = argparse.ArgumentParser(description='Distributed log querier server')
+    parser.add_argument('--host', help='address to serve on, the local IP by default')
+    parser.add_argument('--port', type=int, help='port to serve on, port in the conf by default')
+    parser.add_argument('--conf', default='conf.yaml', help='conf file to use')
+    args = parser.parse_args()
+
+    with open(args.conf) as f:
         conf = yaml.safe_load(f)
 
-    HOST, PORT = find_local_ip(), conf['port']
-    server = ThreadedTCPServer((HOST, PORT), LogQueryRequestHandler)
+    # Fork scanning workers before any thread is started
+    pool = multiprocessing.Pool(conf['scan']['workers'] or multiprocessing.cpu_count())
 
-    # TODO: 
-    server_thread = threading.Thread(target=server.serve_forever())
-    LOGGER.info('Server thread starts serving.')
+    HOST, PORT = args.host or find_local_ip(), args.port or conf['port']
+    server = LogQueryServer((HOST, PORT), conf, pool)
+    server.index_logs()
     try:
-        server_thread.start()
+        server.serve_forever()
     except KeyboardInterrupt:
-        server.shut_down()
-        server.close()
-    
+        LOGGER.info('Server stops serving.')
+    finally:
+        pool.terminate()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,18 @@
 #!/usr/bin/env python
 
 import client
+import query_engine
+import log_index
+import result_cache
+import aggregate
+import gen_testlog
+import server
+import protocol
+import zlib
+import json
+import re
+import socket
+import threading
 import unittest
 import yaml
 import os
@@ -8,6 +20,12 @@ import sys
 import time
 import rstr
 import logging
+import subprocess
+import tempfile
+import shutil
+import multiprocessing
+import gzip
+import pickle
 
 logging.basicConfig(
     level=logging.DEBUG, 
@@ -95,6 +113,585 @@ class DLCTestCase(unittest.TestCase):
 
         self.assertDictEqual(query_result, ground_truth) 
 
+class CountingPool(object):
+    """ A pool scanning each part in place once its result is taken,
+        counting the parts handed to it and those not yet taken
+    """
+
+    class Result(object):
+        def __init__(self, pool, func, args):
+            # Pickled on the way like in a real pool
+            self.pool, self.func, self.args = pool, func, pickle.loads(pickle.dumps(args, pickle.HIGHEST_PROTOCOL))
+
+        def get(self):
+            self.pool.in_flight -= 1
+            return self.func(*self.args)
+
+    def __init__(self):
+        self.submitted = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def apply_async(self, func, args):
+        self.submitted += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return self.Result(self, func, args)
+
+class EngineTestCase(unittest.TestCase):
+    """ Unit test for the in-process query engine against grep itself """
+
+    def setUp(self):
+        with open('conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+
+        fd, self.log = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            for i in xrange(2000):
+                t = ['high', 'regular', 'low', 'random'][i % 4]
+                f.write(rstr.xeger(self.conf['test']['pattern'][t]) + '\n')
+            f.write('\nserver 1\nall_server')
+
+        # The same log rotated and compressed
+        self.gz_log = self.log + '.gz'
+        with open(self.log, 'rb') as src, gzip.open(self.gz_log, 'wb') as dst:
+            dst.write(src.read())
+
+    def tearDown(self):
+        os.remove(self.log)
+        os.remove(self.gz_log)
+
+    def assertSameAsGrep(self, grep_cmd):
+        try:
+            expected = subprocess.check_output(grep_cmd + [self.log]).splitlines()
+        except subprocess.CalledProcessError:
+            expected = []
+        for log in [self.log, self.gz_log]:
+            query = query_engine.GrepQuery(grep_cmd + [log])
+            # Small chunks to exercise lines split over chunk boundaries
+            query.chunk_size = 100
+            self.assertListEqual(list(query.run()), expected)
+
+    def test_patterns(self):
+        for t in ['high', 'regular', 'low']:
+            pattern = self.conf['test']['pattern'][t]
+            for flags in [['-E'], ['-E', '-n'], ['-E', '-v'], ['-E', '-c'], ['-E', '-i', '-n', '-v']]:
+                self.assertSameAsGrep(['grep'] + flags + [pattern])
+
+    def test_parallel(self):
+        pool = multiprocessing.Pool(3)
+        for flags in [['-E', '-n'], ['-E', '-v', '-n'], ['-E', '-c']]:
+            grep_cmd = ['grep'] + flags + [self.conf['test']['pattern']['regular'], self.log]
+            query = query_engine.GrepQuery(grep_cmd)
+            query.part_size = 1000
+            self.assertListEqual(list(query.run(pool=pool)), list(query_engine.GrepQuery(grep_cmd).run()))
+        pool.terminate()
+
+    def test_parts_in_flight(self):
+        pool = CountingPool()
+        grep_cmd = ['grep', '-E', '-v', '-n', self.conf['test']['pattern']['regular'], self.log]
+        query = query_engine.GrepQuery(grep_cmd)
+        query.part_size = 100
+        query.max_parts = 3
+        self.assertListEqual(list(query.run(pool=pool)), list(query_engine.GrepQuery(grep_cmd).run()))
+        self.assertEqual(pool.max_in_flight, 3)
+
+    def test_files(self):
+        pool = multiprocessing.Pool(3)
+        copy = self.log + '.1'
+        shutil.copy(self.log, copy)
+        logs = [self.log, self.gz_log, copy]
+        for flags in [['-E', '-n'], ['-E', '-c']]:
+            grep_cmd = ['grep'] + flags + [self.conf['test']['pattern']['regular']]
+            expected = subprocess.check_output(grep_cmd + [self.log]).splitlines()
+            self.assertListEqual(list(query_engine.GrepQuery(grep_cmd + logs).run()),
+                                 ['%s:%s' % (log, l) for log in logs for l in expected])
+
+            # Scanned at once, lines of a file still come in order
+            query = query_engine.GrepQuery(grep_cmd + logs)
+            query.min_part_size = 1000
+            query.batch_lines = 10
+            lines = list(query.run_files(pool=pool))
+            for log in logs:
+                self.assertListEqual([l for p, l in lines if p == log], expected)
+            self.assertEqual(query.file_counts[self.gz_log], query.line_count / 3)
+        os.remove(copy)
+        pool.terminate()
+
+    def test_max_count(self):
+        pattern = self.conf['test']['pattern']['regular']
+        for flags in [['-m', '5'], ['-m', '3', '-n', '-v'], ['-m', '4', '-c'], ['-m', '0']]:
+            self.assertSameAsGrep(['grep', '-E'] + flags + [pattern])
+
+    def test_limit(self):
+        pool = multiprocessing.Pool(2)
+        grep_cmd = ['grep', '-E', '-n', self.conf['test']['pattern']['regular'], self.log, self.gz_log]
+        expected = list(query_engine.GrepQuery(grep_cmd).run())
+        for limit in [0, 7, 1000]:
+            self.assertListEqual(list(query_engine.GrepQuery(grep_cmd, limit=limit).run()), expected[:limit])
+            query = query_engine.GrepQuery(grep_cmd, limit=limit)
+            query.min_part_size = 1000
+            self.assertEqual(len(list(query.run(pool=pool))), len(expected[:limit]))
+        pool.terminate()
+
+    def test_cancel(self):
+        for log, pool in [(self.log, None), (self.log, CountingPool()), (self.gz_log, None)]:
+            # Given up after a few checks, long before the only match at the end
+            checks = []
+            query = query_engine.GrepQuery(['grep', 'all_server', log])
+            query.chunk_size = query.part_size = query.min_part_size = 1000
+            query.max_parts = 2
+            query.cancelled = lambda: checks.append(1) or len(checks) > 3
+            self.assertListEqual(list(query.run(pool=pool)), [])
+            self.assertEqual(len(checks), 4)
+            if pool is not None:
+                self.assertLessEqual(pool.submitted, 3)
+
+    def test_cancel_pooled(self):
+        pool = multiprocessing.Pool(2)
+        grep_cmd = ['grep', '-E', '-n', self.conf['test']['pattern']['regular'], self.log, self.gz_log]
+        expected = list(query_engine.GrepQuery(grep_cmd).run())
+        # Queries from the server always have a cancel hook, which is not sent to the workers
+        query = query_engine.GrepQuery(grep_cmd)
+        query.part_size = query.min_part_size = 1000
+        query.cancelled = lambda: False
+        # Lines of the files scanned at once come interleaved
+        self.assertListEqual(sorted(query.run(pool=pool)), sorted(expected))
+
+        checks = []
+        query = query_engine.GrepQuery(['grep', 'all_server', self.log])
+        query.part_size = 1000
+        query.max_parts = 2
+        query.cancelled = lambda: checks.append(1) or len(checks) > 3
+        self.assertListEqual(list(query.run(pool=pool)), [])
+        pool.terminate()
+
+    def test_basic_regex(self):
+        for pattern in ['server 1', 'hi[0-9]\\{3\\}$', '^[[:digit:]]\\+[@(]', '(', '^$', '[^a]']:
+            self.assertSameAsGrep(['grep', '-n', pattern])
+
+class IndexTestCase(unittest.TestCase):
+    """ Unit test for narrowing queries with the trigram index """
+
+    def setUp(self):
+        with open('conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+
+        self.index_path = tempfile.mkdtemp()
+        fd, self.log = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            for i in xrange(2000):
+                t = ['high', 'regular', 'random', 'random'][i % 4]
+                f.write(rstr.xeger(self.conf['test']['pattern'][t]) + '\n')
+            f.write('server 1\n1PQRST\n')
+        self.index = log_index.TrigramIndex(self.log, self.index_path, block_size=512)
+        self.index.update()
+
+    def tearDown(self):
+        os.remove(self.log)
+        shutil.rmtree(self.index_path)
+
+    def narrow(self, path, query):
+        return self.index.candidate_ranges(query.pattern)
+
+    def test_same_results(self):
+        patterns = [p for p in self.conf['test']['pattern'].values()] + ['server 1', 'HI[0-9]+', 'P(QR|XY)S', '[0-9][P-Z]{5}']
+        for pattern in patterns:
+            for flags in [['-E', '-n'], ['-E', '-i', '-n']]:
+                grep_cmd = ['grep'] + flags + [pattern, self.log]
+                self.assertListEqual(list(query_engine.GrepQuery(grep_cmd).run(self.narrow)),
+                                     list(query_engine.GrepQuery(grep_cmd).run()))
+
+    def test_narrowing(self):
+        ranges = self.index.candidate_ranges('[0-9][P-Z]{5}')
+        scanned = sum((end or os.path.getsize(self.log)) - start for start, end, _ in ranges)
+        self.assertLess(scanned, os.path.getsize(self.log) / 4)
+        self.assertIsNone(self.index.candidate_ranges('[0-9]+@'))
+
+    def test_append_and_rewrite(self):
+        indexed_end = self.index.indexed_end
+        with open(self.log, 'a') as f:
+            f.write('appended\n' * 200)
+        self.index.update()
+        self.assertGreater(self.index.indexed_end, indexed_end)
+        self.assertEqual(self.index.block_starts[0], 0)
+
+        with open(self.log, 'w') as f:
+            f.write('rewritten\n' * 200)
+        # Not narrowed by the index of what was there before, even before it is updated
+        self.assertIsNone(self.index.candidate_ranges('rewritten'))
+        self.index.update()
+        self.assertEqual(len(list(query_engine.GrepQuery(['grep', 'rewritten', self.log]).run(self.narrow))), 200)
+
+    def assertSameIndex(self, index, other):
+        for k in ('inode', 'indexed_end', 'indexed_lines', 'tail_crc', 'block_starts', 'block_lines', 'block_times', 'last_time', 'postings'):
+            self.assertEqual(getattr(index, k), getattr(other, k))
+
+    def test_saved_incrementally(self):
+        self.assertEqual(self.index.records, 1)
+        with open(self.index.index_file, 'rb') as f:
+            first = f.read()
+        for i in xrange(3):
+            with open(self.log, 'a') as f:
+                f.write('appended %d\n' % i * 100)
+            self.index.update()
+            # Only the blocks added are written, after what was saved before
+            self.assertEqual(self.index.records, i + 2)
+            with open(self.index.index_file, 'rb') as f:
+                self.assertTrue(f.read().startswith(first))
+            self.assertSameIndex(log_index.TrigramIndex(self.log, self.index_path, block_size=512), self.index)
+
+        # Once the records appended add up to the first, the index is written anew as one
+        while self.index.records > 1:
+            with open(self.log, 'a') as f:
+                f.write('more\n' * 1000)
+            self.index.update()
+        self.assertSameIndex(log_index.TrigramIndex(self.log, self.index_path, block_size=512), self.index)
+
+    def test_torn_record(self):
+        with open(self.log, 'a') as f:
+            f.write('appended\n' * 200)
+        self.index.update()
+        size = os.path.getsize(self.index.index_file)
+        with open(self.index.index_file, 'ab') as f:
+            f.write('\0\0\1\0partial')
+        index = log_index.TrigramIndex(self.log, self.index_path, block_size=512)
+        self.assertSameIndex(index, self.index)
+        self.assertEqual(os.path.getsize(self.index.index_file), size)
+
+    def test_refresh(self):
+        # Nothing indexed yet, the log is scanned in full
+        index = log_index.TrigramIndex(self.log, tempfile.mkdtemp(), block_size=512)
+        self.assertIsNone(index.candidate_ranges('server 1'))
+        index.refresh()
+        index.updater.join()
+        self.assertSameIndex(index, self.index)
+        shutil.rmtree(os.path.dirname(index.index_file))
+
+class TimeWindowTestCase(unittest.TestCase):
+    """ Unit test for queries restricted to a time window """
+
+    def setUp(self):
+        self.index_path = tempfile.mkdtemp()
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'vm1.log')
+        # Two hours of a line per second, with a traceback every 100 seconds
+        self.lines = []
+        for i in xrange(7200):
+            self.lines.append('2015-09-10 %02d:%02d:%02d,000 INFO request %d served' % (12 + i / 3600, i / 60 % 60, i % 60, i))
+            if i % 100 == 99:
+                self.lines.extend(['Traceback (most recent call last):', '  request %d failed' % i])
+        with open(self.log, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        with gzip.open(self.log + '.gz', 'wb') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        self.index = log_index.TrigramIndex(self.log, self.index_path, block_size=4096)
+        self.index.update()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        shutil.rmtree(self.index_path)
+
+    def expected(self, pattern, since, until, invert=False):
+        """ Lines in the window, where those without a timestamp go with the line before them """
+        selected, time = [], None
+        for n, line in enumerate(self.lines, 1):
+            if line.startswith('2015'):
+                time = line[:19]
+            if since <= time[:len(since)] and time[:len(until)] <= until and bool(re.search(pattern, line)) != invert:
+                selected.append('%d:%s' % (n, line))
+        return selected
+
+    def narrow(self, path, query):
+        return self.index.candidate_ranges(None if query.invert else query.pattern, query.since, query.until)
+
+    def test_window(self):
+        windows = [('2015-09-10 12:30', '2015-09-10 12:31'), ('2015-09-10 12:59:59', '2015-09-10 13'),
+                   ('2015-09-10', '2015-09-10 12:00:05'), ('2015-09-10 13:59:58', '2015-09-11'),
+                   ('2015-09-10 14', '2015-09-11'), ('2015-09-10 13:10', '2015-09-10 13:05')]
+        for since, until in windows:
+            for pattern, flags in [('request', []), ('failed', []), ('00,', ['-v'])]:
+                expected = self.expected(pattern, since, until, '-v' in flags)
+                for path, narrow in [(self.log, None), (self.log, self.narrow), (self.log + '.gz', None)]:
+                    query = query_engine.GrepQuery(['grep', '-n'] + flags + [pattern, path], since, until)
+                    # Small chunks, so windows start and end in the middle of a compressed log
+                    query.chunk_size = 4096
+                    self.assertListEqual(list(query.run(narrow)), expected)
+
+    def test_pruning(self):
+        ranges = self.index.candidate_ranges(None, '2015-09-10 12:30', '2015-09-10 12:31')
+        scanned = sum((end or os.path.getsize(self.log)) - start for start, end, _ in ranges)
+        self.assertLess(scanned, os.path.getsize(self.log) / 20)
+        self.assertRaises(ValueError, query_engine.GrepQuery, ['grep', 'request'], '12:30')
+
+class CacheTestCase(unittest.TestCase):
+    """ Unit test for reusing cached results as the log changes """
+
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join('line %d %s\n' % (i, 'hit' if i % 7 == 0 else 'miss') for i in xrange(1000)))
+        self.cache = result_cache.ResultCache(1 << 20)
+
+    def tearDown(self):
+        os.remove(self.log)
+
+    def assertSameAsScan(self, grep_cmd):
+        self.assertListEqual(list(query_engine.GrepQuery(grep_cmd).run(cache=self.cache)),
+                             list(query_engine.GrepQuery(grep_cmd).run()))
+
+    def test_growing_log(self):
+        grep_cmd = ['grep', '-n', 'hit', self.log]
+        self.assertSameAsScan(grep_cmd)
+        self.assertEqual(len(self.cache.entries), 1)
+        self.assertSameAsScan(grep_cmd)
+
+        # A partially written line is never cached
+        with open(self.log, 'a') as f:
+            f.write('new hit')
+        self.assertSameAsScan(grep_cmd)
+        with open(self.log, 'a') as f:
+            f.write(' done\nlast hit\n')
+        self.assertSameAsScan(grep_cmd)
+        self.assertSameAsScan(['grep', '-v', 'hit', self.log])
+
+        with open(self.log, 'w') as f:
+            f.write('rewritten hit\n')
+        self.assertSameAsScan(grep_cmd)
+
+    def test_missing_log(self):
+        missing = self.log + '.missing'
+        self.assertRaises(IOError, list, query_engine.GrepQuery(['grep', 'hit', missing]).run(cache=self.cache))
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_eviction(self):
+        for i in xrange(20):
+            self.assertSameAsScan(['grep', '-v', 'line %d ' % i, self.log])
+        self.assertLessEqual(self.cache.bytes, self.cache.max_bytes)
+        self.assertLess(len(self.cache.entries), 20)
+
+class AggregateTestCase(unittest.TestCase):
+    """ Unit test for aggregates computed by servers and merged by the client """
+
+    def setUp(self):
+        # user0 logs in on every even second, users 0-4 take turns on odd ones
+        self.log = '\n'.join('2015-09-10 12:%02d:%02d,000 INFO user%d logged in' % (i / 60 % 60, i % 60, i % 5 if i % 2 else 0)
+                             for i in xrange(600))
+
+    def aggregate(self, spec, grep_cmd, servers=3):
+        """ Split the log among servers, aggregate on each and merge the results """
+        query = query_engine.GrepQuery(grep_cmd)
+        lines = [l for _, l in query.scan(self.log)]
+        return aggregate.merge(spec, [aggregate.compute(spec, query, lines[i::servers]) for i in xrange(servers)])
+
+    def test_count(self):
+        self.assertEqual(self.aggregate({'type': 'count'}, ['grep', 'user[12] ']), 120)
+
+    def test_top(self):
+        self.assertListEqual(self.aggregate({'type': 'top', 'k': 1}, ['grep', '-E', '(user[0-3])']), [('user0', 360)])
+        # Lines selected by -v are counted whole
+        self.assertListEqual([c for _, c in self.aggregate({'type': 'top', 'k': 2}, ['grep', '-v', 'user0'])], [1, 1])
+        self.assertRaises(ValueError, aggregate.compute, {'type': 'top', 'k': 1, 'group': 2}, query_engine.GrepQuery(['grep', 'user']), [])
+
+    def test_histogram(self):
+        spec = {'type': 'histogram', 'minutes': 5}
+        self.assertListEqual(self.aggregate(spec, ['grep', 'user0']), [('2015-09-10 12:00', 180), ('2015-09-10 12:05', 180)])
+        self.assertEqual(len(self.aggregate({'type': 'histogram'}, ['grep', 'user0'])), 10)
+
+class GenTestLogTestCase(unittest.TestCase):
+    """ Unit test for the generated test logs """
+
+    def test_exact_frequency(self):
+        with open('conf.yaml') as f:
+            test_conf = yaml.safe_load(f)['test']
+        lines = list(gen_testlog.gen_lines(test_conf, test_conf['hit_servers'][0], 2000))
+        self.assertEqual(len(lines), 2000)
+        for t, f in test_conf['frequency'].iteritems():
+            query = query_engine.GrepQuery(['grep', '-E', test_conf['pattern'][t]])
+            self.assertEqual(sum(1 for _ in query.scan('\n'.join(lines))), int(2000 * float(f)))
+        for line in ('hit_server', 'all_server', 'server %d' % test_conf['hit_servers'][0]):
+            self.assertEqual(lines.count(line), 1)
+
+class CompressTestCase(unittest.TestCase):
+    """ Unit test for compressing the result stream """
+
+    class Connection(object):
+        def __init__(self):
+            self.frames = []
+
+        def send(self, kind, payload=''):
+            self.frames.append((kind, payload))
+
+    conf = {'level': 1, 'min_bytes': 1000, 'check_bytes': 10000, 'min_ratio': 1.5}
+
+    def received(self, frames):
+        """ Frames as the client takes them, with the compressed ones expanded """
+        inflate, rest, received = zlib.decompressobj(), '', []
+        for kind, payload in frames:
+            if kind == protocol.COMPRESSED:
+                inner, rest = protocol.split_frames(rest + inflate.decompress(payload))
+                received.extend(inner)
+            else:
+                received.append((kind, payload))
+        return received
+
+    def test_round_trip(self):
+        conn = self.Connection()
+        writer = server.ResultWriter(conn, self.conf)
+        sent = [(protocol.BATCH, 'line %d matched\n' % i * 10) for i in xrange(200)]
+        for kind, payload in sent:
+            writer.send(kind, payload)
+        self.assertListEqual(self.received(conn.frames), sent)
+        # Small results go as they are
+        self.assertEqual(conn.frames[0][0], protocol.BATCH)
+        self.assertLess(sum(len(p) for _, p in conn.frames), writer.raw_bytes / 4)
+
+    def test_incompressible(self):
+        conn = self.Connection()
+        writer = server.ResultWriter(conn, self.conf)
+        sent = [(protocol.BATCH, os.urandom(500)) for i in xrange(100)]
+        for kind, payload in sent:
+            writer.send(kind, payload)
+        self.assertListEqual(self.received(conn.frames), sent)
+        self.assertEqual(conn.frames[-1][0], protocol.BATCH)
+
+class LocalServerTestCase(unittest.TestCase):
+    """ Unit test for clients and a server talking over loopback sockets """
+
+    def setUp(self):
+        with open('conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+        # Neither an index nor the logs of the real servers
+        del self.conf['index']
+        del self.conf['logs']
+
+        self.log_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.log_dir, 'vm1.log'), 'w') as f:
+            f.write(''.join('line %d %s\n' % (i, 'hit' if i % 7 == 0 else 'miss') for i in xrange(1000)))
+
+        self.server = server.LogQueryServer(('127.0.0.1', 0), self.conf)
+        self.serving = threading.Thread(target=self.server.serve_forever)
+        self.serving.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.serving.join()
+        shutil.rmtree(self.log_dir)
+
+    def query(self, grep_cmd, server_list, connections=None):
+        """ Query the local server as each of server_list, return the client """
+        c = client.LogQueryClient(grep_cmd, connections)
+        c.conf['log_path'] = os.path.join(self.log_dir, '')
+        c.conf['server_list'] = [dict(s, ip='127.0.0.1', port=self.server.server_address[1]) for s in server_list]
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            c.query()
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+        return c
+
+    def test_servers_on_one_host(self):
+        connections = client.ConnectionPool()
+        server_list = [{'id': 1, 'logfile': 'vm1.log'}, {'id': 2, 'logfile': 'vm1.log'}]
+        for i in xrange(2):
+            c = self.query(['grep', 'hit'], server_list, connections)
+            self.assertDictEqual(c.line_dict, {1: 143, 2: 143})
+        # Each server has a connection of its own, kept across queries
+        self.assertEqual(len(connections.connections), 2)
+        self.assertEqual(len(self.server.connections), 2)
+        connections.close()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address)
+        # A frame which never comes fails the test rather than hangs it
+        sock.settimeout(10)
+        return sock
+
+    def request(self, sock, request):
+        """ Send a query on a socket, return the frames of its result """
+        protocol.send_json(sock, protocol.QUERY, request)
+        frames = []
+        while not frames or frames[-1][0] not in (protocol.TRAILER, protocol.ERROR):
+            frames.append(protocol.recv_frame(sock))
+        return frames
+
+    def test_busy(self):
+        sock = self.connect()
+        log = os.path.join(self.log_dir, 'vm1.log')
+        # As many queries as it takes are running already
+        self.server.active_queries = self.server.max_queries
+        self.assertListEqual(self.request(sock, {'cmd': ['grep', 'hit', log]}), [(protocol.ERROR, server.BUSY)])
+        self.server.active_queries = 0
+        self.assertEqual(self.request(sock, {'cmd': ['grep', 'hit', log]})[-1][0], protocol.TRAILER)
+        sock.close()
+
+    def test_error(self):
+        # A missing log is reported at once, with the cache on or off
+        for cache in [self.server.cache, None]:
+            self.server.cache = cache
+            tick = time.time()
+            c = self.query(['grep', 'hit'], [{'id': 1, 'logfile': 'missing.log'}])
+            self.assertListEqual(c.failed, [1])
+            self.assertListEqual(c.timed_out, [])
+            self.assertLess(time.time() - tick, 5)
+
+        # So is a request the server does not expect, and the connection still serves the next one
+        sock = self.connect()
+        self.assertEqual(self.request(sock, {})[-1][0], protocol.ERROR)
+        self.assertEqual(self.request(sock, {'cmd': ['grep', 'hit', os.path.join(self.log_dir, 'vm1.log')]})[-1][0], protocol.TRAILER)
+        sock.close()
+
+    def test_pooled(self):
+        # Logs cut into parts are scanned by a real pool, sent each query without its cancel hook
+        self.server.pool = multiprocessing.Pool(2)
+        self.server.conf['scan']['part_size'] = 1000
+        try:
+            c = self.query(['grep', 'hit'], [{'id': 1, 'logfile': 'vm1.log'}])
+            self.assertDictEqual(c.line_dict, {1: 143})
+            sock = self.connect()
+            frames = self.request(sock, {'cmd': ['grep', 'hit', os.path.join(self.log_dir, 'vm1.log')], 'aggregate': {'type': 'count'}})
+            self.assertEqual(frames[-1][0], protocol.TRAILER)
+            self.assertEqual(json.loads(frames[-1][1])['aggregate'], 143)
+            sock.close()
+        finally:
+            self.server.pool.terminate()
+
+class ProtocolTestCase(unittest.TestCase):
+    """ Unit test for the framing of queries and results """
+
+    frames = [(protocol.QUERY, '{"cmd": ["grep", "hit"]}'), (protocol.CANCEL, ''),
+              (protocol.BATCH, 'line\n' * 50000), (protocol.TRAILER, '{}')]
+
+    def test_socket_round_trip(self):
+        a, b = socket.socketpair()
+        def send():
+            for kind, payload in self.frames:
+                protocol.send_frame(a, kind, payload)
+            a.close()
+        # Frames larger than the socket buffer need the other end reading
+        sender = threading.Thread(target=send)
+        sender.start()
+        received = []
+        while True:
+            kind, payload = protocol.recv_frame(b)
+            if kind is None:
+                break
+            received.append((kind, payload))
+        sender.join()
+        b.close()
+        self.assertListEqual(received, self.frames)
+
+    def test_split_frames(self):
+        data = ''.join(protocol.pack_frame(k, p) for k, p in self.frames)
+        # Bytes come in at any boundary, whole frames come out
+        received, rest = [], ''
+        for i in xrange(0, len(data), 777):
+            frames, rest = protocol.split_frames(rest + data[i:i + 777])
+            received.extend(frames)
+        self.assertListEqual(received, self.frames)
+        self.assertEqual(rest, '')
+
 def test_speed():
         with open('conf.yaml') as f:
             conf = yaml.safe_load(f)
@@ -117,7 +714,18 @@ def test_speed():
 
 def main():
     test_speed()
-    suite = unittest.TestLoader().loadTestsFromTestCase(DLCTestCase)
+    suite = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(EngineTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(IndexTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TimeWindowTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(CacheTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(AggregateTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(GenTestLogTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(CompressTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ProtocolTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(LocalServerTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(DLCTestCase),
+    ])
     unittest.TextTestRunner(verbosity=2).run(suite)
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import time
+import logging
+import argparse
+import yaml
+import gossiper
+import transport
+from message import RUMOR, encode_message, decode_message
+
+def member_ips(member_num):
+    return ['10.%d.%d.%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff) for i in xrange(2, member_num + 2)]
+
+def gen_rumors(ips, repeat, status='JOINED'):
+    """ Rumors of all the members, each with heartbeats fresher than the one before """
+    return [{'%s_1' % ip: {'heartbeat': round, 'status': status} for ip in ips} for round in xrange(1, repeat + 1)]
+
+def timed(func, args_list):
+    """ Seconds per call of func over the args in turn """
+    tick = time.time()
+    for args in args_list:
+        func(*args)
+    return (time.time() - tick) / len(args_list)
+
+def bench(conf, member_num, repeat):
+    """ Seconds per call of each step of gossiping, for one gossiper with member_num members """
+    node = gossiper.Gossiper(conf, transport.MemoryNetwork().transport('10.0.0.1'))
+    ips = member_ips(member_num)
+    rumors = gen_rumors(ips, repeat + 1)
+    node.member_list.merge(rumors[0], ips[0])
+    rumors = rumors[1:]
+
+    stats = {}
+    # Every member fresher, as a full rumor of heartbeat gossip is
+    stats['merge fresh'] = timed(node.member_list.merge, [(rumor, ips[i % len(ips)]) for i, rumor in enumerate(rumors)])
+    # Nothing new, as a rumor repeated is
+    stats['merge stale'] = timed(node.member_list.merge, [(rumors[-1], ips[0])] * repeat)
+    # Nobody overdue, as in most rounds
+    stats['refresh'] = timed(node.member_list.refresh, [()] * repeat)
+    # Rumors to peers told before, of which only some are told in full
+    stats['gen_rumor'] = timed(node.member_list.gen_rumor, [(ips[i % len(ips)],) for i in xrange(repeat)])
+    stats['gen_rumor full'] = timed(node.member_list.gen_rumor, [(ips[0], True)] * repeat)
+
+    datagrams = encode_message(RUMOR, rumors[-1], conf['rumor']['max_datagram'])
+    stats['encode'] = timed(encode_message, [(RUMOR, rumors[-1], conf['rumor']['max_datagram'])] * repeat)
+    stats['decode'] = timed(lambda: [decode_message(datagram) for datagram in datagrams], [()] * repeat)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the member list of a gossiper')
+    parser.add_argument('--members', type=int, nargs='+', default=[100, 1000], help='numbers of members to try')
+    parser.add_argument('--repeat', type=int, default=200, help='calls of each step')
+    parser.add_argument('--detector', choices=['heartbeat', 'phi', 'swim'], help='failure detector')
+    args = parser.parse_args()
+
+    # Only the results of the benchmark are of interest
+    logging.getLogger('Gossiper').setLevel(logging.WARNING)
+
+    with open('gossiper_conf.yaml') as f:
+        conf = yaml.safe_load(f)
+    conf['seeds'] = []
+    if args.detector is not None:
+        conf['detector'] = args.detector
+
+    print '%s detector, %d calls of each step' % (conf['detector'], args.repeat)
+    print '%-8s %-15s %12s %14s' % ('members', 'step', 'us/call', 'members/s')
+    for member_num in args.members:
+        for step, seconds in sorted(bench(conf, member_num, args.repeat).iteritems()):
+            print '%-8d %-15s %12.1f %14.0f' % (member_num, step, seconds * 1e6, member_num / seconds)
+
+if __name__ == '__main__':
+    main()
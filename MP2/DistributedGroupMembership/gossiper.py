@@ -3,267 +3,672 @@
 import yaml
 import logging
 import socket
-import thread
-import json
 import time
 import random
-
-logging.basicConfig(
-    level=logging.DEBUG, 
-    format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s',
-    # Seperate logs by each instance starting
-    filename='Gossiper.log.' + str(int(time.time())),
-    filemode='w',
-)
+import threading
+import collections
+import itertools
+import math
+import Queue
+from message import RUMOR, PULL, PING, PING_REQ, ACK, SYNC, parse_id, encode_message, decode_message
+from transport import UdpTransport
 
 LOGGER = logging.getLogger('Gossiper')
 
-# Synchronize between gossip() and listen()
-member_list_lock = thread.allocate_lock()
-
 def find_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(('8.8.8.8', 0))
     return s.getsockname()[0]
 
+class Listener(object):
+    """ A consumer of membership changes, called back with batches of (event, id)
+        in a thread of its own, so slow consumers do not hold up gossiping
+    """
+    def __init__(self, callback, debounce, max_delay, max_batch):
+        super(Listener, self).__init__()
+        self.callback = callback
+        # Deliver once changes stop coming for debounce seconds,
+        #   but hold none back for over max_delay seconds, nor more than max_batch of them
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.events = []
+        self.first_time = None
+        self.last_time = None
+        self.batches = Queue.Queue()
+
+        worker = threading.Thread(target=self.work, name='Listener')
+        worker.daemon = True
+        worker.start()
+
+    def add(self, event, id, now):
+        self.last_time = now
+        if not self.events:
+            self.first_time = self.last_time
+        self.events.append((event, id))
+        if len(self.events) >= self.max_batch:
+            self.flush()
+
+    def flush(self, now=None):
+        """ Deliver the changes so far, if it is time to """
+        if now is not None and not (self.events and (now - self.last_time >= self.debounce or now - self.first_time >= self.max_delay)):
+            return
+        self.batches.put(self.events)
+        self.events = []
+
+    def work(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                self.callback(batch)
+            except Exception:
+                LOGGER.exception('Listener failed on %s' % batch)
+
+class Member(object):
+    """ Entry of a member in the member list, with its id parsed once """
+    __slots__ = ('id', 'ip', 'join_time', 'heartbeat', 'timestamp', 'status')
+
+    def __init__(self, id, heartbeat, timestamp, status):
+        super(Member, self).__init__()
+        self.id = id
+        self.ip, self.join_time = parse_id(id)
+        self.heartbeat = heartbeat
+        self.timestamp = timestamp
+        self.status = status
+
+    def __str__(self):
+        return "{'heartbeat': %d, 'timestamp': %f, 'status': '%s'}" % (self.heartbeat, self.timestamp, self.status)
+
+class MemberIndex(object):
+    """ Ids of the members in a status, a set which can also be sampled from in O(1) """
+    def __init__(self):
+        super(MemberIndex, self).__init__()
+        self.ids = []
+        # Entry format -- id : position in ids
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, id):
+        return id in self.positions
+
+    def add(self, id):
+        if id not in self.positions:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+
+    def discard(self, id):
+        pos = self.positions.pop(id, None)
+        if pos is None:
+            return
+        # Move the last one into its place, so no other has to move
+        last = self.ids.pop()
+        if pos < len(self.ids):
+            self.ids[pos] = last
+            self.positions[last] = pos
+
 class MemberList(object):
     """ The member list maintained by gossiper """
     def __init__(self, gossiper):
         super(MemberList, self).__init__()
         self.gossiper = gossiper
-        self.introducer_ip = gossiper.conf['introducer']['ip']
+        self.time = gossiper.transport.time
+        self.seed_ips = gossiper.conf['seeds']
         self.threshold = gossiper.conf['threshold']
-        # Entry format -- id : {'heartbeat' : heartbeat, 'timestamp' : timestamp, 'status' : status}
+        # 'heartbeat' suspects members whose heartbeats go stale,
+        #   'phi' those whose heartbeats are later than their past intervals make likely,
+        #   'swim' those who fail to answer probes, and spreads its suspicion by rumors
+        self.detector = gossiper.conf['detector']
+        self.swim = gossiper.conf['swim']
+        self.phi_conf = gossiper.conf['phi']
+        # Recent intervals between fresher heartbeats of each member
+        #   Entry format -- id : deque of seconds
+        self.arrivals = {}
+        # Told of members 'joined', 'left' or 'failed', see add_listener()
+        self.listeners = []
+        self.listener_conf = gossiper.conf['listener']
+        # Entry format -- id : Member
         self.members = {}
+        # Ids of the members in each status, only ever changed along with members
+        #   Entry format -- status : MemberIndex
+        self.by_status = {status: MemberIndex() for status in ('ADDED', 'JOINED', 'SUSPECTED', 'LEFT')}
+        # Number of members of each ip, more than one while an old incarnation is not forgotten
+        self.ip_counts = collections.Counter()
+        # Join time of the newest incarnation heard of on each ip, older ones being over
+        #   Entry format -- ip : join time
+        self.incarnations = {gossiper.ip: parse_id(gossiper.id)[1]}
+        # Members in the order they last changed, each with the version of the list it changed at
+        #   Entry format -- id : version
+        self.changes = collections.OrderedDict()
+        self.version = 0
+        # What each peer is known to have heard, to only tell it what has changed since
+        #   Entry format -- ip : {id : (heartbeat, status)}
+        self.peer_views = {}
+        # Version of the list each peer was last told
+        self.peer_versions = {}
+        # Rumors sent to each peer, every full_every-th of which is told in full
+        #   so what got lost on the way is made up for
+        self.peer_rounds = {}
+        self.full_every = gossiper.conf['rumor']['full_every']
 
     def __str__(self):
         delinator_begin = '%sMEMBERLIST BEGINS%s\n' % ('-' * 15, '-' * 15)
-        content = ['%s : %6d, %f, %s\n' % (id, info['heartbeat'], info['timestamp'], info['status']) for id, info in self.members.iteritems()]
+        content = ['%s : %6d, %f, %s\n' % (id, member.heartbeat, member.timestamp, member.status) for id, member in self.members.iteritems()]
         delinator_end = '%sMEMBERLIST ENDS%s\n' % ('-' * 15, '-' * 18)
         return delinator_begin + ''.join(content) + delinator_end
 
-    def has_introducer(self):
-        for id in self.members:
-            if id.split('_')[0] == self.introducer_ip:
-                return True
-        return False
+    def add_seeds(self):
+        # Behave like receiving virtual rumors about seeds not heard of
+        for ip in self.seed_ips:
+            if ip not in self.ip_counts and ip != self.gossiper.ip:
+                self.add(ip, 0, 'ADDED', 0)
+                LOGGER.info('[ADDED SEED] %s : %s' % (ip, str(self.members[ip])))
+
+    def del_seed(self, ip):
+        if ip in self.members:
+            self.remove(ip)
+            LOGGER.info('[DELETED SEED] %s' % ip)
+
+    def add(self, id, heartbeat, status, timestamp=None):
+        member = Member(id, heartbeat, self.time() if timestamp is None else timestamp, status)
+        self.members[id] = member
+        self.by_status[status].add(id)
+        self.ip_counts[member.ip] += 1
+        self.changed(id)
+        return member
+
+    def update(self, member, heartbeat, status, timestamp=None):
+        """ Change the entry of a member, and the indexes along with it """
+        if status != member.status:
+            self.by_status[member.status].discard(member.id)
+            self.by_status[status].add(member.id)
+        member.heartbeat = heartbeat
+        member.status = status
+        if timestamp is not None:
+            member.timestamp = timestamp
+        self.changed(member.id)
+
+    def changed(self, id):
+        self.version += 1
+        self.changes.pop(id, None)
+        self.changes[id] = self.version
+
+    def remove(self, id):
+        member = self.members.pop(id)
+        self.by_status[member.status].discard(id)
+        self.ip_counts[member.ip] -= 1
+        if not self.ip_counts[member.ip]:
+            del self.ip_counts[member.ip]
+        self.changes.pop(id, None)
+        return member
+
+    def merge(self, rumor, sender_ip=None):
+        # The sender has heard all it tells
+        if sender_ip is not None:
+            view = self.peer_views.setdefault(sender_ip, {})
+            for id, heard in rumor.iteritems():
+                view[id] = (heard['heartbeat'], heard['status'])
 
-    def add_introducer(self):
-        # Behave like receiving a virtual rumor about introducer
-        id = self.introducer_ip
-        self.members[id] = {
-            'heartbeat': 0, 
-            'timestamp': 0,
-            'status': 'ADDED',
-        }
-        LOGGER.info('[ADDED INTRODUCER] %s : %s' % (id, str(self.members[id])))
-
-    def del_introducer(self):
-        if self.introducer_ip in self.members:
-            del self.members[self.introducer_ip]
-            LOGGER.info('[DELETED INTRODUCER] %s' % self.introducer_ip)
-
-    def merge(self, rumor):
         for id, heard in rumor.iteritems():
-            # Clean the virtual info about introducer, prepare to adopt the real info
-            if self.introducer_ip in self.members and id.split('_')[0] == self.introducer_ip:
-                self.del_introducer()
+            if id == self.gossiper.id:
+                # Suspected by others, tell them I'm alive with a new incarnation
+                if heard['status'] == 'SUSPECTED' and heard['heartbeat'] >= self.gossiper.heartbeat:
+                    self.gossiper.heartbeat = heard['heartbeat'] + 1
+                    LOGGER.info('[REFUTED] %s : %d' % (id, self.gossiper.heartbeat))
+                continue
 
+            # Clean the virtual info about a seed, prepare to adopt the real info
+            if self.by_status['ADDED'] and parse_id(id)[0] in self.by_status['ADDED']:
+                self.del_seed(parse_id(id)[0])
+
+            # A member restarted is a new incarnation on the same ip, the old one is over
+            #   whatever is still told of it, so it neither joins again nor fails later
+            ip, join_time = parse_id(id)
+            newest = self.incarnations.get(ip)
+            if newest is not None and join_time < newest:
+                continue
+
+            mine = self.members.get(id)
             if heard['status'] == 'LEFT':
                 # Duplicate LEFT rumor is received
-                if not id in self.members or self.members[id]['status'] == 'LEFT':
+                if mine is None or mine.status == 'LEFT':
                     continue
                 else:
-                    self.members[id].update({
-                        'heartbeat' : heard['heartbeat'],
-                        'timestamp' : time.time(),
-                        'status'    : 'LEFT',
-                    })
-                    LOGGER.info('[LEFT] %s : %s' % (id, str(self.members[id])))
+                    self.update(mine, heard['heartbeat'], 'LEFT', self.time())
+                    LOGGER.info('[LEFT] %s : %s' % (id, str(mine)))
+                    self.notify('left', id)
             elif heard['status'] == 'JOINED':
                 # New member is heard
-                if not id in self.members:
-                    self.members[id] = {
-                        'heartbeat' : heard['heartbeat'],
-                        'timestamp' : time.time(),
-                        'status'    : 'JOINED',
-                    }
-                    LOGGER.info('[JOINED] %s : %s' % (id, str(self.members[id])))
-                else:
-                    mine = self.members[id]
-                    # Update info after hearing a fresher heartbeat
-                    if heard['heartbeat'] > mine['heartbeat']:
-                        mine.update({
-                            'heartbeat' : heard['heartbeat'],
-                            'timestamp' : time.time(),
-                            'status'    : 'JOINED',
-                        })
-                        # LOGGER.info('[UPDATED] %s : %s' % (id, str(self.members[id])))
+                if mine is None:
+                    if newest is not None and join_time > newest:
+                        self.retire('%s_%d' % (ip, newest))
+                    self.incarnations[ip] = join_time
+                    mine = self.add(id, heard['heartbeat'], 'JOINED')
+                    LOGGER.info('[JOINED] %s : %s' % (id, str(mine)))
+                    self.notify('joined', id)
+                # Update info after hearing a fresher heartbeat
+                elif heard['heartbeat'] > mine.heartbeat:
+                    if self.detector == 'phi':
+                        self.arrivals.setdefault(id, collections.deque(maxlen=self.phi_conf['window'])).append(self.time() - mine.timestamp)
+                    self.update(mine, heard['heartbeat'], 'JOINED', self.time())
+                    # LOGGER.info('[UPDATED] %s : %s' % (id, str(mine)))
+            elif heard['status'] == 'SUSPECTED':
+                # Only told by SWIM, whose heartbeat is the incarnation of the member
+                #   Suspicion overrides being alive in the same incarnation, but not in a newer one,
+                #   and a member is only ever joined by hearing it alive
+                if mine is None:
+                    continue
+                if mine.status == 'JOINED' and heard['heartbeat'] >= mine.heartbeat:
+                    self.update(mine, heard['heartbeat'], 'SUSPECTED', self.time())
+                    LOGGER.info('[SUSPECTED] %s : %s' % (id, str(mine)))
+                elif mine.status == 'SUSPECTED' and heard['heartbeat'] > mine.heartbeat:
+                    self.update(mine, heard['heartbeat'], 'SUSPECTED')
             else:
                 LOGGER.info('Unhandled status (%s) in rumor' % heard['status'])
 
 
     def refresh(self):
         # Change members' status if necessary
-        ## Use items() instead of iteritems(), because dict changes during iteration
-        for id, info in self.members.items(): 
-            # Ignore introducer when it's just virtual and may be the only member locally
-            if info['status'] == 'ADDED':
+        ## Use values() instead of itervalues(), because dict changes during iteration
+        for member in self.members.values(): 
+            # Ignore seeds when they're just virtual and may be the only members locally
+            if member.status == 'ADDED':
                 continue
 
-            if info['status'] == 'JOINED' and time.time() - info['timestamp'] > float(self.threshold['suspect']):
-                info['status'] = 'SUSPECTED'
-                LOGGER.info('[SUSPECTED] %s : %s' % (id, self.members[id]))
-            elif info['status'] == 'SUSPECTED' and time.time() - info['timestamp'] > float(self.threshold['fail']):
-                LOGGER.info('[FAILING] %s : %s' % (id, self.members[id]))
-                del self.members[id]
-            elif info['status'] == 'LEFT' and time.time() - info['timestamp'] > float(self.threshold['forget']):
-                LOGGER.info('[FORGETING] %s : %s' % (id, self.members[id]))
-                del self.members[id]
-
-        if not self.has_introducer() and not self.gossiper.is_introducer():
-            # At least, introducer is 'ADDED' locally
-            self.add_introducer()
-
-    def get_one_to_gossip_to(self, status=('JOINED', 'ADDED')):
+            if member.status == 'JOINED' and self.overdue(member, 'suspect'):
+                self.update(member, member.heartbeat, 'SUSPECTED')
+                LOGGER.info('[SUSPECTED] %s : %s' % (member.id, member))
+            elif member.status == 'SUSPECTED' and self.overdue(member, 'fail'):
+                LOGGER.info('[FAILING] %s : %s' % (member.id, member))
+                self.forget(member.id)
+                self.notify('failed', member.id)
+            elif member.status == 'LEFT' and self.time() - member.timestamp > float(self.threshold['forget']):
+                LOGGER.info('[FORGETING] %s : %s' % (member.id, member))
+                self.forget(member.id)
+
+        # Deliver changes that are due
+        now = self.time()
+        for listener in self.listeners:
+            listener.flush(now)
+
+        # At least, seeds are 'ADDED' locally
+        self.add_seeds()
+
+    def add_listener(self, callback, debounce=None, max_delay=None, max_batch=None):
+        """ Have callback([(event, id)]) called with batches of members 'joined', 'left' or 'failed',
+            in the order they changed, by default as batched in the listener conf
+        """
+        listener = Listener(
+            callback,
+            float(self.listener_conf['debounce'] if debounce is None else debounce),
+            float(self.listener_conf['max_delay'] if max_delay is None else max_delay),
+            int(self.listener_conf['max_batch'] if max_batch is None else max_batch),
+        )
+        self.listeners.append(listener)
+        return listener
+
+    def notify(self, event, id):
+        now = self.time()
+        for listener in self.listeners:
+            listener.add(event, id, now)
+
+    def overdue(self, member, level):
+        """ Whether a member has been unheard for long enough to be suspected or failed, by level """
+        if self.detector == 'swim':
+            # Members are only suspected by probe(), and fail some time after that
+            return level == 'fail' and self.time() - member.timestamp > float(self.swim['suspicion'])
+        if self.detector == 'phi' and len(self.arrivals.get(member.id, ())) >= self.phi_conf['min_samples']:
+            return self.phi(member.id, self.time() - member.timestamp) > float(self.phi_conf[level])
+        # Fixed thresholds, also for members not heard from often enough to judge by phi
+        return self.time() - member.timestamp > float(self.threshold[level])
+
+    def phi(self, id, elapsed):
+        """ Suspicion level of a member unheard for elapsed seconds, the phi accrual
+            -log10 of the chance of a heartbeat interval this long
+        """
+        # Gossip relays heartbeats from random members at random times, so intervals are
+        #   taken as exponentially distributed, which makes phi grow with elapsed in proportion
+        #   and a fail level twice the suspect level take twice the time
+        intervals = self.arrivals[id]
+        return elapsed / (sum(intervals) / len(intervals)) * math.log10(math.e)
+
+    def suspect(self, id):
+        member = self.members.get(id)
+        if member is not None and member.status == 'JOINED':
+            self.update(member, member.heartbeat, 'SUSPECTED', self.time())
+            LOGGER.info('[SUSPECTED] %s : %s' % (id, member))
+
+    def forget(self, id):
+        member = self.remove(id)
+        self.arrivals.pop(id, None)
+        self.peer_views.pop(member.ip, None)
+        self.peer_versions.pop(member.ip, None)
+        self.peer_rounds.pop(member.ip, None)
+        for view in self.peer_views.itervalues():
+            view.pop(id, None)
+
+    def retire(self, id):
+        """ Forget an old incarnation of a member restarted, without telling listeners,
+            as the member is still there
+        """
+        if id in self.members:
+            LOGGER.info('[RETIRED] %s : %s' % (id, self.members[id]))
+            self.forget(id)
+
+    def get_to_gossip_to(self, fanout, status=('JOINED', 'ADDED')):
         # Gossip to 'ADDED' node to:
         #   1. initialize my exsitence
         #   2. recover from bad communication
-        #   3. help introducer rejoin the group after its failure
-        candidates = [id for id, info in self.members.iteritems() if info['status'] in status]
-        if not candidates:
-            return None
-        dest_id = random.choice(candidates)
-        dest_ip = dest_id.split('_')[0]
-        return dest_ip
-
-    def gen_rumor(self, dest_ip):
+        #   3. help seeds rejoin the group after their failure
+        indexes = [self.by_status[s] for s in status]
+        total = sum(len(index) for index in indexes)
+        dest_ips = []
+        # Pick positions over the indexes one after another, rather than listing the candidates
+        for pos in random.sample(xrange(total), min(fanout, total)):
+            for index in indexes:
+                if pos < len(index):
+                    dest_ips.append(self.members[index.ids[pos]].ip)
+                    break
+                pos -= len(index)
+        return dest_ips
+
+    def gen_rumor(self, dest_ip, full=False):
         # Rumor rule:
         #   0. timestamp field can be ignored
         #   1. include those are 'JOINED' or 'LEFT'
-        #   2. exclude destination, because no one knows better than itself
+        #   2. exclude destination, because no one knows better than itself,
+        #      unless SWIM suspects it, so it can refute
         #   3. include myself
-        rumor_filter = lambda m : m[1]['status'] in ('JOINED', 'LEFT') and m[0].split('_')[0] != dest_ip
-        rumor_candidates = {id : {'heartbeat' : info['heartbeat'], 'status' : info['status']} for id, info in self.members.iteritems()}
-        rumor = dict(filter(rumor_filter, rumor_candidates.iteritems()))
-        rumor[self.gossiper.id] = {
-            'heartbeat' : self.gossiper.heartbeat,
-            'status'    : self.gossiper.status,
-        } 
+        #   4. exclude what the destination has heard already, unless it's time to tell all,
+        #      looking only at those changed since it was last told
+        told = ('JOINED', 'LEFT', 'SUSPECTED') if self.detector == 'swim' else ('JOINED', 'LEFT')
+        view = self.peer_views.setdefault(dest_ip, {})
+        rounds = self.peer_rounds.get(dest_ip, 0)
+        self.peer_rounds[dest_ip] = rounds + 1
+        full = full or rounds % self.full_every == 0
+        if full:
+            ids = itertools.chain.from_iterable(self.by_status[status] for status in told)
+        else:
+            since = self.peer_versions.get(dest_ip, 0)
+            ids = itertools.takewhile(lambda id: self.changes[id] > since, reversed(self.changes))
+        self.peer_versions[dest_ip] = self.version
+
+        rumor = {}
+        for id in ids:
+            member = self.members[id]
+            if member.status not in told or (member.ip == dest_ip and member.status != 'SUSPECTED'):
+                continue
+            heard = (member.heartbeat, member.status)
+            if not full and view.get(id) == heard:
+                continue
+            view[id] = heard
+            rumor[id] = {'heartbeat' : member.heartbeat, 'status' : member.status}
+
+        rumor.update(self.gossiper.self_rumor())
         return rumor
 
     def count_member(self, status):
-        return sum([1 for info in self.members.values() if info['status'] in status])
+        return sum(len(self.by_status[s]) for s in status)
 
 class Gossiper(object):
-    """ Gossiper who maintains the group member list """
-    def __init__(self):
+    """ Gossiper who maintains the group member list, over UDP unless given another transport """
+    def __init__(self, conf=None, transport=None):
         super(Gossiper, self).__init__()
-        with open('conf.yaml') as f:
-            self.conf = yaml.safe_load(f)
-        self.ip = find_local_ip()
-
-        self.id = '%s_%d' % (self.ip, int(time.time()))
+        if conf is None:
+            with open('gossiper_conf.yaml') as f:
+                conf = yaml.safe_load(f)
+        self.conf = conf
+        if transport is None:
+            transport = UdpTransport(find_local_ip(), conf['port'], conf['sync']['port'], float(conf['sync']['timeout']))
+        self.transport = transport
+        self.ip = transport.ip
+        self.time = transport.time
+
+        self.id = '%s_%d' % (self.ip, int(self.time()))
         self.heartbeat = 1
-        self.timestamp = time.time()
+        self.timestamp = self.time()
         self.status = 'JOINED'
+        # Probes of SWIM waiting for an ACK -- sequence : id of the member probed
+        self.acks = {}
+        # PING_REQs being served -- sequence of my PING : (requester ip, its sequence, id of the member probed)
+        self.relays = {}
+        self.seq = 0
+        # Members yet to probe in this round
+        self.to_probe = []
+        # Set once the loop has sent the last word and stopped
+        self.left = threading.Event()
         
         # Exclude self in member list
         self.member_list = MemberList(self)
-        if not self.is_introducer():
-            self.member_list.add_introducer()
+        self.member_list.add_seeds()
 
-    def is_introducer(self):
-        return self.ip == self.conf['introducer']['ip']
+    def is_seed(self):
+        return self.ip in self.conf['seeds']
 
     def heartbeat_once(self, last=False):
-        self.heartbeat += 1
-        self.timestamp = time.time()
+        # Under SWIM, heartbeat is the incarnation, which only changes to refute suspicion or leave
+        if self.conf['detector'] != 'swim' or last:
+            self.heartbeat += 1
+        self.timestamp = self.time()
         if last:
             self.status = 'LEFT'
 
-    def gossip(self):
+    def self_rumor(self):
+        # A leaving gossiper is still joined until its last word, and left after,
+        #   statuses of its own like 'TO_LEAVE' never go on the wire
+        status = 'LEFT' if self.status in ('LEFT', 'AFTER_LEFT') else 'JOINED'
+        return {self.id: {'heartbeat': self.heartbeat, 'status': status}}
+
+    def schedule(self, delay, callback, *args):
+        """ Call back from the loop after delay seconds """
+        self.transport.schedule(delay, callback, *args)
+
+    def open(self):
+        """ Receive from the transport, and as a seed, serve syncs """
+        self.transport.open(self.receive, self.answer_sync if self.is_seed() else None)
+
+    def loop(self):
+        """ The only thread of the gossiper, running the transport until the last word is sent """
+        # leave() waits on left, which is set however the loop ends
+        try:
+            self.start()
+            self.transport.loop(lambda: self.status == 'AFTER_LEFT')
+        finally:
+            self.transport.close()
+            self.left.set()
+
+    def start(self):
+        """ Sync from a seed, then schedule the rounds of gossiping, and probing if by SWIM """
+        self.sync()
         LOGGER.info('Start gossiping!')
-        while True:
-            member_list_lock.acquire()
-            self.member_list.refresh()
-
-            if self.status == 'TO_LEAVE':
-                dest_ip = self.member_list.get_one_to_gossip_to(('JOINED'))
-                # Last word to tell if there's any other alive one
-                if dest_ip:
-                    self.heartbeat_once(last=True)
-                    rumor = self.member_list.gen_rumor(dest_ip)
-                    try:
-                        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                        sock.sendto(json.dumps(rumor), (dest_ip, self.conf['port']))
-                    except Exception:
-                        pass
-                # Now, I can go peacefully
-                self.status = 'AFTER_LEFT'
-                break
-            elif self.status == 'JOINED':
-                dest_ip = self.member_list.get_one_to_gossip_to()
-                if dest_ip:
-                    self.heartbeat_once()
-                    rumor = self.member_list.gen_rumor(dest_ip)
-                    try:
-                        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                        sock.sendto(json.dumps(rumor), (dest_ip, self.conf['port']))
-                    except Exception:
-                        pass
-            else:
-                LOGGER.info('Unhandled status (%s) of gossiper' % self.status)
-
-            member_list_lock.release()
+        self.schedule(0, self.gossip)
+        if self.conf['detector'] == 'swim':
+            LOGGER.info('Start probing!')
+            self.schedule(0, self.probe)
+        # self.schedule(0, self.reading)
+
+    def sync(self):
+        """ Start from the member list of the first live seed, rather than wait for gossip to bring it """
+        seed_ips = [ip for ip in self.conf['seeds'] if ip != self.ip]
+        random.shuffle(seed_ips)
+        hello = encode_message(SYNC, self.self_rumor(), self.conf['rumor']['max_datagram'])
+        for seed_ip in seed_ips:
+            try:
+                rumor = {}
+                for datagram in self.transport.sync(seed_ip, hello):
+                    rumor.update(decode_message(datagram)[3])
+            except (socket.error, ValueError), e:
+                LOGGER.info('Failed to sync from %s: %s' % (seed_ip, e))
+                continue
+            self.member_list.merge(rumor, seed_ip)
+            LOGGER.info('Synced %d members from %s' % (len(rumor), seed_ip))
+            return True
+        return False
 
-            time.sleep(float(self.conf['interval']['gossip']))
+    def answer_sync(self, joiner_ip, datagrams):
+        """ Take in a node joining through me, and tell it all I know """
+        messages = [decode_message(datagram) for datagram in datagrams]
+        if not messages or messages[0][0] != SYNC:
+            raise ValueError('Not a sync')
+        for kind, seq, target, rumor in messages:
+            self.member_list.merge(rumor, joiner_ip)
+        return encode_message(RUMOR, self.member_list.gen_rumor(joiner_ip, full=True), self.conf['rumor']['max_datagram'])
 
-    def listen(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((self.ip, self.conf['port']))
-        LOGGER.info('Start listening!')
-        while self.status == 'JOINED':
-            rumor = json.loads(sock.recvfrom(1024)[0].strip())
-            if rumor:
-                member_list_lock.acquire()
-                self.member_list.merge(rumor)
-                member_list_lock.release()
+    def gossip(self):
+        # The next round comes even if this one fails
+        self.schedule(float(self.conf['interval']['gossip']), self.gossip)
+        self.member_list.refresh()
+
+        if self.status == 'TO_LEAVE':
+            dest_ips = self.member_list.get_to_gossip_to(1, ('JOINED',))
+            # Last word to tell if there's any other alive one
+            if dest_ips:
+                self.heartbeat_once(last=True)
+                self.send(RUMOR, dest_ips[0])
+            # Now, I can go peacefully
+            self.status = 'AFTER_LEFT'
+            return
+        elif self.status == 'JOINED':
+            dest_ips = self.member_list.get_to_gossip_to(self.conf['gossip']['fanout'])
+            if dest_ips:
+                self.heartbeat_once()
+            for dest_ip in dest_ips:
+                # push      -- tell my rumor
+                # pull      -- ask for theirs, telling just my heartbeat
+                # push-pull -- tell mine and ask for theirs, which then leaves out what mine told
+                mode = self.conf['gossip']['mode']
+                if mode == 'push':
+                    self.send(RUMOR, dest_ip)
+                elif mode == 'pull':
+                    self.send(PULL, dest_ip, rumor=self.self_rumor())
+                else:
+                    self.send(PULL, dest_ip)
+        else:
+            LOGGER.info('Unhandled status (%s) of gossiper' % self.status)
+
+    def send(self, kind, dest_ip, seq=0, target=None, rumor=None):
+        """ Send a message with a rumor piggybacked """
+        if rumor is None:
+            rumor = self.member_list.gen_rumor(dest_ip)
+        for datagram in encode_message(kind, rumor, self.conf['rumor']['max_datagram'], seq, target):
+            self.transport.send(dest_ip, datagram)
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xffffffff
+        return self.seq
+
+    def probe(self):
+        """ Failure detector of SWIM, probing a member each period in a round robin of random order
+            PING it, then PING_REQ others to ping it after ping_timeout, then suspect it after the period
+        """
+        period = float(self.conf['swim']['period'])
+        self.schedule(period, self.probe)
+        if self.status != 'JOINED':
+            return
+
+        # Skip those no longer joined, and start a new round in a new order once all are probed
+        joined = self.member_list.by_status['JOINED']
+        while self.to_probe and self.to_probe[-1] not in joined:
+            self.to_probe.pop()
+        if not self.to_probe:
+            self.to_probe = list(joined)
+            random.shuffle(self.to_probe)
+        if not self.to_probe:
+            return
+        id = self.to_probe.pop()
+        seq = self.next_seq()
+        self.acks[seq] = id
+        self.send(PING, parse_id(id)[0], seq, id)
+        self.schedule(float(self.conf['swim']['ping_timeout']), self.probe_indirectly, seq)
+
+    def probe_indirectly(self, seq):
+        if seq not in self.acks:
+            return
+        target = self.acks[seq]
+        target_ip = parse_id(target)[0]
+        indirect = self.conf['swim']['indirect']
+        helpers = [ip for ip in self.member_list.get_to_gossip_to(indirect + 1, ('JOINED',)) if ip != target_ip][:indirect]
+        for helper_ip in helpers:
+            self.send(PING_REQ, helper_ip, seq, target)
+        self.schedule(float(self.conf['swim']['period']) - float(self.conf['swim']['ping_timeout']), self.probe_timeout, seq)
+
+    def probe_timeout(self, seq):
+        if seq in self.acks:
+            self.member_list.suspect(self.acks.pop(seq))
+
+    def receive(self, datagram, src_ip):
+        try:
+            kind, seq, target, rumor = decode_message(datagram)
+        except ValueError, e:
+            LOGGER.info('Dropped a datagram from %s: %s' % (src_ip, e))
+            return
+        if rumor:
+            self.member_list.merge(rumor, src_ip)
+
+        if kind == PULL:
+            self.send(RUMOR, src_ip)
+        elif kind == PING:
+            # Only the incarnation probed answers, not one started since on the same ip
+            if target == self.id:
+                self.send(ACK, src_ip, seq, target)
+        elif kind == PING_REQ and target:
+            relay_seq = self.next_seq()
+            self.relays[relay_seq] = (src_ip, seq, target)
+            self.schedule(float(self.conf['swim']['period']), self.relays.pop, relay_seq, None)
+            self.send(PING, parse_id(target)[0], relay_seq, target)
+        elif kind == ACK:
+            # An ACK counts only from the member probed
+            if seq in self.relays:
+                requester_ip, requester_seq, probed = self.relays[seq]
+                if target == probed:
+                    del self.relays[seq]
+                    self.send(ACK, requester_ip, requester_seq, target)
+            elif target is not None and self.acks.get(seq) == target:
+                del self.acks[seq]
 
     def reading(self):
-        while True:
-            counter = 3 - self.member_list.count_member(['JOINED', 'SUSPECTED'])
-            print time.strftime('%Y-%m-%d %H:%M:%S'), "The number of failed member is:", counter
+        counter = 3 - self.member_list.count_member(['JOINED', 'SUSPECTED'])
+        print time.strftime('%Y-%m-%d %H:%M:%S'), "The number of failed member is:", counter
+
+        self.schedule(float(self.conf['interval']['reading']), self.reading)
 
-            time.sleep(float(self.conf['interval']['reading']))
+    def leave(self):
+        # Inform the loop to send last word, and wait until it has
+        self.status = 'TO_LEAVE'
+        LOGGER.info('Leaving...')
+        self.left.wait()
+        LOGGER.info('Left completely.')
 
     def run(self):
-        thread.start_new_thread(self.gossip,  ())
-        thread.start_new_thread(self.listen,  ())
-        #thread.start_new_thread(self.reading, ())
-        while True:
-            cmd = raw_input('list (list members)\nself (my id)\nleave\n')
-            if cmd == 'list':
-                print self.member_list
-            elif cmd == 'self':
-                print self.id
-            elif cmd == 'leave':
-                # Inform gossip() to send last word
-                self.status = 'TO_LEAVE'
-                LOGGER.info('Leaving...')
-                # Wait until gossip() finishes sending last word
-                while self.status != 'AFTER_LEFT':
-                    pass
-                LOGGER.info('Left completely.')
-                break
-            else:
-                print 'Wrong command.'
+        # One thread runs the transport, and everything else of the gossiper
+        self.open()
+        loop = threading.Thread(target=self.loop, name='Gossiper')
+        loop.daemon = True
+        loop.start()
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG, 
+        format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s',
+        # Seperate logs by each instance starting
+        filename='Gossiper.log.' + str(int(time.time())),
+        filemode='w',
+    )
+
     gossiper = Gossiper()
     gossiper.run()
-
-
-
-
-        
\ No newline at end of file
+    while True:
+        cmd = raw_input('list (list members)\nself (my id)\nleave\n')
+        if cmd == 'list':
+            print gossiper.member_list
+        elif cmd == 'self':
+            print gossiper.id
+        elif cmd == 'leave':
+            gossiper.leave()
+            break
+        else:
+            print 'Wrong command.'
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import socket
+import struct
+
+# Message layout -- header, then one packed entry per member of the rumor it carries
+#   A rumor too large for a datagram is cut into several, each of which makes sense alone
+MESSAGE_HEADER = struct.Struct('!cBcI4sIH') # magic, version, kind, probe sequence, probe target ip and join time, number of entries
+RUMOR_ENTRY = struct.Struct('!4sIIB')       # ip, join time, heartbeat, status
+# A member is named by its ip and join time, 8 bytes which make its id, rather than by an index into
+#   a member table, as gossipers have no table in common to index, each learns of members in its own order
+MESSAGE_MAGIC = 'G'
+MESSAGE_VERSION = 3
+STATUS_CODES = {'JOINED': 1, 'LEFT': 2, 'SUSPECTED': 3}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.iteritems()}
+
+# Message kinds, PING, PING_REQ and ACK only sent by the SWIM detector, SYNC only to a seed
+RUMOR = 'R'     # just a rumor
+PULL = 'L'      # asks for a rumor back, by the pull and push-pull modes of gossip
+PING = 'P'      # asks for an ACK of the same sequence
+PING_REQ = 'Q'  # asks to ping the target, and pass its ACK on
+ACK = 'A'       # answers a PING
+SYNC = 'S'      # tells a seed of a joining node, which answers with the whole member list
+
+def parse_id(id):
+    """ Split a member id into (ip, join time), which is 0 for seeds added locally """
+    ip, _, join_time = id.partition('_')
+    return ip, int(join_time or 0)
+
+def encode_message(kind, rumor, max_datagram, seq=0, target=None):
+    """ Pack a rumor {id : {'heartbeat' : heartbeat, 'status' : status}} into datagrams,
+        the first of the given kind and the rest just rumors
+    """
+    # The id of the member probed, so another incarnation on its ip does not answer for it
+    target_ip, target_time = parse_id(target) if target else ('0.0.0.0', 0)
+    entries = []
+    for id, info in rumor.iteritems():
+        ip, join_time = parse_id(id)
+        entries.append(RUMOR_ENTRY.pack(socket.inet_aton(ip), join_time, info['heartbeat'], STATUS_CODES[info['status']]))
+    per_datagram = (max_datagram - MESSAGE_HEADER.size) / RUMOR_ENTRY.size
+    datagrams = []
+    for i in xrange(0, max(len(entries), 1), per_datagram):
+        header = MESSAGE_HEADER.pack(MESSAGE_MAGIC, MESSAGE_VERSION, kind if i == 0 else RUMOR,
+                                     seq, socket.inet_aton(target_ip), target_time, len(entries[i:i + per_datagram]))
+        datagrams.append(header + ''.join(entries[i:i + per_datagram]))
+    return datagrams
+
+def decode_message(datagram):
+    """ Unpack a datagram into (kind, probe sequence, id of the probe target or None, rumor),
+        or raise ValueError if it is not one
+    """
+    if len(datagram) < MESSAGE_HEADER.size:
+        raise ValueError('Datagram too short')
+    magic, version, kind, seq, target_ip, target_time, count = MESSAGE_HEADER.unpack_from(datagram)
+    if magic != MESSAGE_MAGIC or version != MESSAGE_VERSION or len(datagram) != MESSAGE_HEADER.size + count * RUMOR_ENTRY.size:
+        raise ValueError('Not a message')
+    if kind not in (RUMOR, PULL, PING, PING_REQ, ACK, SYNC):
+        raise ValueError('Unknown kind (%s) of message' % kind)
+    rumor = {}
+    for i in xrange(count):
+        ip, join_time, heartbeat, status = RUMOR_ENTRY.unpack_from(datagram, MESSAGE_HEADER.size + i * RUMOR_ENTRY.size)
+        if status not in STATUS_NAMES:
+            raise ValueError('Unknown status (%d) in rumor' % status)
+        rumor['%s_%d' % (socket.inet_ntoa(ip), join_time)] = {'heartbeat': heartbeat, 'status': STATUS_NAMES[status]}
+    target = '%s_%d' % (socket.inet_ntoa(target_ip), target_time) if target_ip != '\0' * 4 else None
+    return kind, seq, target, rumor
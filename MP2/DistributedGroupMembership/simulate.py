@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import time
+import random
+import logging
+import argparse
+import yaml
+import gossiper
+import transport
+
+class Simulation(object):
+    """ Gossipers in one process, on a network that loses and delays datagrams, in simulated time """
+
+    def __init__(self, conf, node_num, loss, latency, jitter, seed_num=1, sync=True):
+        super(Simulation, self).__init__()
+        self.network = transport.MemoryNetwork(loss, latency, jitter)
+
+        self.ips = ['10.%d.%d.%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff) for i in xrange(1, node_num + 1)]
+        conf = dict(conf, seeds=self.ips[:seed_num])
+        self.nodes = {}
+        # (time, observer id, event, member id) of each membership change seen
+        self.changes = []
+        for ip in self.ips:
+            node = gossiper.Gossiper(conf, self.network.transport(ip))
+            node.member_list.notify = self.recorder(node)
+            if not sync:
+                node.sync = lambda: False
+            self.nodes[ip] = node
+        # Gossipers to be started, and those started so far
+        self.pending = set()
+        self.started = set()
+        self.crashed = set()
+
+    def recorder(self, node):
+        def notify(event, id):
+            self.changes.append((self.network.now, node.id, event, id))
+        return notify
+
+    def crash(self, ip):
+        """ Stop a gossiper silently, as if its machine failed """
+        self.crashed.add(ip)
+        self.nodes[ip].transport.close()
+
+    def run_until(self, end, check=None, every=0.1):
+        return self.network.run_until(end, check, every)
+
+    def start(self, ips):
+        for ip in ips:
+            node = self.nodes[ip]
+            # Spread the first rounds over an interval, as real gossipers don't start in step
+            self.pending.add(ip)
+            self.network.at(self.network.now + random.random() * float(node.conf['interval']['gossip']), self.boot, ip)
+
+    def boot(self, ip):
+        self.pending.discard(ip)
+        self.started.add(ip)
+        self.nodes[ip].open()
+        self.nodes[ip].start()
+
+    def converged(self, observers=None, known=None):
+        """ Whether every gossiper is started, and every live one knows every other live one as joined,
+            or just the observers know the known ones
+        """
+        if self.pending:
+            return False
+        alive = set(self.nodes[ip].id for ip in self.started if ip not in self.crashed)
+        observers = alive if observers is None else set(self.nodes[ip].id for ip in observers)
+        known = alive if known is None else set(self.nodes[ip].id for ip in known)
+        for id in observers:
+            joined = self.nodes[id.split('_')[0]].member_list.by_status['JOINED']
+            if sum(1 for other in known if other != id and other in joined) < len(known - set([id])):
+                return False
+        return True
+
+    def warmed_up(self):
+        """ Whether every live gossiper has seen enough heartbeat intervals of every member
+            it knows as joined, to judge them by phi rather than by the fixed thresholds
+        """
+        for ip in self.started - self.crashed:
+            member_list = self.nodes[ip].member_list
+            min_samples = member_list.phi_conf['min_samples']
+            for id in member_list.by_status['JOINED']:
+                if len(member_list.arrivals.get(id, ())) < min_samples:
+                    return False
+        return True
+
+def simulate(conf, args):
+    sim = Simulation(conf, args.nodes, args.loss, args.latency, args.jitter, args.seeds, not args.no_sync)
+    sim.start(sim.ips[:args.nodes - args.join])
+
+    # Convergence -- from the first round until everyone knows everyone
+    converged = sim.run_until(args.converge_timeout, sim.converged)
+    convergence = sim.network.now if converged else None
+
+    # Joining -- start the rest at once, as when a rack is restarted,
+    #   until they know those already there, then until everyone knows everyone again
+    caught_up = rejoin = None
+    if args.join:
+        join_time = sim.network.now
+        members = sim.ips[:args.nodes - args.join]
+        joiners = sim.ips[args.nodes - args.join:]
+        sim.start(joiners)
+        if sim.run_until(join_time + args.converge_timeout, lambda: sim.converged(joiners, members), 0.01):
+            caught_up = sim.network.now - join_time
+        if sim.run_until(join_time + args.converge_timeout, sim.converged):
+            rejoin = sim.network.now - join_time
+
+    # Warm-up -- phi only judges members by their intervals once it has seen min_samples of them,
+    #   until then it falls back to the fixed thresholds
+    warmup = None
+    if conf['detector'] == 'phi':
+        warmup_start = sim.network.now
+        if sim.run_until(warmup_start + args.converge_timeout, sim.warmed_up):
+            warmup = sim.network.now - warmup_start
+
+    # Detection -- crash some, then watch everyone else fail them, and fail nobody else
+    crash_time = sim.network.now
+    crashed_ids = set()
+    for ip in random.sample(sim.ips[args.seeds:], args.crash):
+        crashed_ids.add(sim.nodes[ip].id)
+        sim.crash(ip)
+    sent_before = sum(sim.network.sent_bytes.values())
+    sim.run_until(crash_time + args.duration)
+
+    detections = {}
+    false_failures = set()
+    for t, observer, event, id in sim.changes:
+        if event != 'failed' or t < crash_time:
+            continue
+        if id in crashed_ids:
+            detections.setdefault((observer, id), t - crash_time)
+        elif id.split('_')[0] not in sim.crashed:
+            false_failures.add((observer, id))
+    live = args.nodes - args.crash
+    latencies = sorted(detections.values())
+
+    return {
+        'convergence': convergence,
+        'caught_up': caught_up,
+        'rejoin': rejoin,
+        'warmup': warmup,
+        'detected': float(len(detections)) / (live * args.crash) if args.crash else 1.0,
+        'p50': latencies[len(latencies) / 2] if latencies else None,
+        'max': latencies[-1] if latencies else None,
+        'false_positive': float(len(false_failures)) / (live * (live - 1)),
+        'bytes_per_node_sec': (sum(sim.network.sent_bytes.values()) - sent_before) / float(args.nodes) / args.duration,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulation of gossipers on a lossy network')
+    parser.add_argument('--nodes', type=int, default=100, help='number of gossipers')
+    parser.add_argument('--fanout', type=int, help='members gossiped to each round')
+    parser.add_argument('--mode', choices=['push', 'pull', 'push-pull'], help='how to gossip')
+    parser.add_argument('--interval', type=float, help='seconds between rounds of gossip')
+    parser.add_argument('--detector', choices=['heartbeat', 'phi', 'swim'], help='failure detector')
+    parser.add_argument('--seeds', type=int, default=1, help='number of seeds, the first gossipers')
+    parser.add_argument('--no-sync', action='store_true', help='join by gossip alone, without syncing from a seed')
+    parser.add_argument('--join', type=int, default=0, help='gossipers to start once the others converged')
+    parser.add_argument('--loss', type=float, default=0.01, help='chance of losing a datagram')
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds to deliver a datagram at least')
+    parser.add_argument('--jitter', type=float, default=0.004, help='seconds to deliver a datagram at most on top')
+    parser.add_argument('--crash', type=int, default=1, help='gossipers to crash once converged')
+    parser.add_argument('--duration', type=float, default=20, help='simulated seconds to run after the crash')
+    parser.add_argument('--converge-timeout', type=float, default=60, help='simulated seconds to wait for convergence')
+    parser.add_argument('--seed', type=int, help='random seed, to repeat a run')
+    args = parser.parse_args()
+
+    # Only the results of the simulation are of interest
+    logging.getLogger('Gossiper').setLevel(logging.WARNING)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    with open('gossiper_conf.yaml') as f:
+        conf = yaml.safe_load(f)
+    if args.fanout is not None:
+        conf['gossip'] = dict(conf['gossip'], fanout=args.fanout)
+    if args.mode is not None:
+        conf['gossip'] = dict(conf['gossip'], mode=args.mode)
+    if args.interval is not None:
+        conf['interval'] = dict(conf['interval'], gossip=args.interval)
+    if args.detector is not None:
+        conf['detector'] = args.detector
+
+    tick = time.time()
+    stats = simulate(conf, args)
+    print '%d nodes, %s detector, fanout %d, %s, every %.2fs, %.1f%% loss, simulated in %.1fs' % (
+        args.nodes, conf['detector'], conf['gossip']['fanout'], conf['gossip']['mode'],
+        float(conf['interval']['gossip']), args.loss * 100, time.time() - tick)
+    print 'convergence      %s' % ('%.2fs' % stats['convergence'] if stats['convergence'] is not None else 'none')
+    print 'joiners caught up %s' % ('%.2fs' % stats['caught_up'] if stats['caught_up'] is not None else '-')
+    print 'rejoin           %s' % ('%.2fs' % stats['rejoin'] if stats['rejoin'] is not None else '-')
+    if conf['detector'] == 'phi':
+        print 'phi warm-up      %s' % ('%.2fs' % stats['warmup'] if stats['warmup'] is not None else 'none')
+    print 'detected         %.1f%% of crashes by every live node' % (stats['detected'] * 100)
+    print 'detection p50    %s' % ('%.2fs' % stats['p50'] if stats['p50'] is not None else '-')
+    print 'detection max    %s' % ('%.2fs' % stats['max'] if stats['max'] is not None else '-')
+    print 'false positives  %.4f%% of live pairs' % (stats['false_positive'] * 100)
+    print 'bandwidth        %.0f bytes/node/s' % stats['bytes_per_node_sec']
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+import math
+import time
+import socket
+import logging
+import unittest
+import yaml
+import gossiper
+import transport
+from message import RUMOR, PULL, PING, ACK, SYNC, STATUS_CODES, MESSAGE_HEADER, RUMOR_ENTRY, encode_message, decode_message
+
+class MessageTestCase(unittest.TestCase):
+    """ Unit test for packing rumors into datagrams """
+
+    def test_round_trip(self):
+        statuses = sorted(STATUS_CODES)
+        rumor = {'10.0.%d.%d_%d' % (i >> 8, i & 0xff, 1444000000 + i): {'heartbeat': i * 7, 'status': statuses[i % len(statuses)]}
+                 for i in xrange(500)}
+        # Room for 30 entries a datagram, so the rumor is cut into several
+        max_datagram = MESSAGE_HEADER.size + 30 * RUMOR_ENTRY.size
+        datagrams = encode_message(PULL, rumor, max_datagram, 42, '10.0.0.9_1444000123')
+        self.assertEqual(len(datagrams), 17)
+        self.assertTrue(all(len(datagram) <= max_datagram for datagram in datagrams))
+
+        decoded = {}
+        for i, datagram in enumerate(datagrams):
+            kind, seq, target, part = decode_message(datagram)
+            # Only the first is of the kind asked, the rest are just rumors
+            self.assertEqual(kind, PULL if i == 0 else RUMOR)
+            decoded.update(part)
+        self.assertDictEqual(decoded, rumor)
+        self.assertEqual(decode_message(datagrams[0])[1:3], (42, '10.0.0.9_1444000123'))
+
+        # An empty rumor is still a message
+        self.assertEqual(decode_message(encode_message(RUMOR, {}, max_datagram)[0]), (RUMOR, 0, None, {}))
+        self.assertRaises(ValueError, decode_message, datagrams[0][:-1])
+
+class DetectorTestCase(unittest.TestCase):
+    """ Unit test for when members are suspected and failed, by each detector """
+
+    def setUp(self):
+        with open('gossiper_conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+        self.conf['seeds'] = []
+        self.conf['threshold'] = dict(self.conf['threshold'], suspect=2, fail=4)
+        self.conf['phi'] = dict(self.conf['phi'], suspect=5, fail=10, min_samples=10)
+        self.conf['swim'] = dict(self.conf['swim'], suspicion=3)
+        self.network = transport.MemoryNetwork()
+
+    def member_list(self, detector):
+        return gossiper.Gossiper(dict(self.conf, detector=detector), self.network.transport('10.0.0.1')).member_list
+
+    def hear(self, member_list, id, intervals):
+        """ Hear the heartbeats of a member, the first now and then each after the given seconds """
+        member_list.merge({id: {'heartbeat': 1, 'status': 'JOINED'}})
+        for heartbeat, interval in enumerate(intervals, 2):
+            self.network.now += interval
+            member_list.merge({id: {'heartbeat': heartbeat, 'status': 'JOINED'}})
+        return member_list.members[id]
+
+    def overdue_after(self, member_list, member, elapsed):
+        """ Levels a member is overdue for, once unheard for elapsed seconds """
+        self.network.now = member.timestamp + elapsed
+        return [level for level in ('suspect', 'fail') if member_list.overdue(member, level)]
+
+    def test_phi(self):
+        member_list = self.member_list('phi')
+        # Intervals averaging 1s
+        member = self.hear(member_list, '10.0.0.2_1', [0.5, 1.5] * 5)
+        self.assertEqual(len(member_list.arrivals[member.id]), 10)
+        self.assertAlmostEqual(member_list.phi(member.id, 1.0), math.log10(math.e))
+        self.assertAlmostEqual(member_list.phi(member.id, 3.0), 3 * math.log10(math.e))
+
+        # phi passes 5 after 11.5 mean intervals, and 10 after 23
+        self.assertEqual(self.overdue_after(member_list, member, 11.0), [])
+        self.assertEqual(self.overdue_after(member_list, member, 12.0), ['suspect'])
+        self.assertEqual(self.overdue_after(member_list, member, 23.0), ['suspect'])
+        self.assertEqual(self.overdue_after(member_list, member, 24.0), ['suspect', 'fail'])
+
+        # Twice as slow a member is given twice the time
+        slow = self.hear(member_list, '10.0.0.3_1', [2.0] * 10)
+        self.assertEqual(self.overdue_after(member_list, slow, 22.0), [])
+        self.assertEqual(self.overdue_after(member_list, slow, 24.0), ['suspect'])
+
+    def test_phi_warm_up(self):
+        member_list = self.member_list('phi')
+        # Too few intervals to judge by, the fixed thresholds apply
+        member = self.hear(member_list, '10.0.0.2_1', [0.1] * 9)
+        self.assertEqual(self.overdue_after(member_list, member, 1.5), [])
+        self.assertEqual(self.overdue_after(member_list, member, 2.5), ['suspect'])
+        self.assertEqual(self.overdue_after(member_list, member, 4.5), ['suspect', 'fail'])
+
+    def test_heartbeat(self):
+        member_list = self.member_list('heartbeat')
+        member = self.hear(member_list, '10.0.0.2_1', [0.1] * 20)
+        self.assertNotIn(member.id, member_list.arrivals)
+        self.assertEqual(self.overdue_after(member_list, member, 1.5), [])
+        self.assertEqual(self.overdue_after(member_list, member, 2.5), ['suspect'])
+        self.assertEqual(self.overdue_after(member_list, member, 4.5), ['suspect', 'fail'])
+
+    def test_swim(self):
+        member_list = self.member_list('swim')
+        member = self.hear(member_list, '10.0.0.2_1', [])
+        # Only probes suspect, and suspicion fails after its time
+        self.assertEqual(self.overdue_after(member_list, member, 100.0), ['fail'])
+        self.assertEqual(self.overdue_after(member_list, member, 2.0), [])
+
+class TransportTestCase(unittest.TestCase):
+    """ Unit test for the UDP transport """
+
+    def test_loop_survives_errors(self):
+        # A port free for now
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        received = []
+        def on_datagram(datagram, src_ip):
+            if datagram == 'bad':
+                raise KeyError(datagram)
+            received.append(datagram)
+        def fail():
+            raise ValueError('timer')
+
+        udp = transport.UdpTransport('127.0.0.1', port, port, 1.0)
+        udp.open(on_datagram)
+        udp.schedule(0, fail)
+        udp.schedule(0.01, udp.send, '127.0.0.1', 'bad')
+        udp.schedule(0.02, udp.send, '127.0.0.1', 'good')
+        deadline = time.time() + 5
+        udp.loop(lambda: received or time.time() > deadline)
+        udp.close()
+        self.assertListEqual(received, ['good'])
+
+class LeaveTestCase(unittest.TestCase):
+    """ Unit test for a gossiper leaving, on a network in one process """
+
+    def setUp(self):
+        with open('gossiper_conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+        self.conf['seeds'] = ['10.0.0.1']
+        self.network = transport.MemoryNetwork()
+        self.nodes = [gossiper.Gossiper(self.conf, self.network.transport('10.0.0.%d' % i)) for i in (1, 2)]
+        for node in self.nodes:
+            node.open()
+            node.start()
+        self.network.run_until(2)
+
+    def test_leave(self):
+        seed, node = self.nodes
+        self.assertIn(node.id, seed.member_list.by_status['JOINED'])
+        node.status = 'TO_LEAVE'
+        # Asked for its rumor, or to sync, before its last word, it is still joined
+        seed.send(PULL, node.ip)
+        self.network.run_until(self.network.now + 0.01)
+        self.assertIn(node.id, seed.member_list.by_status['JOINED'])
+        self.assertEqual(decode_message(node.answer_sync('10.0.0.3', encode_message(SYNC, {}, 1400))[0])[0], RUMOR)
+
+        self.network.run_until(self.network.now + 1)
+        self.assertEqual(node.status, 'AFTER_LEFT')
+        self.assertIn(node.id, seed.member_list.by_status['LEFT'])
+
+    def test_left_after_error(self):
+        node = gossiper.Gossiper(self.conf, self.network.transport('10.0.0.3'))
+        def fail():
+            raise KeyError('refresh')
+        node.member_list.refresh = fail
+        node.open()
+        # However the loop ends, leave() is not left waiting
+        self.assertRaises(KeyError, node.loop)
+        self.assertTrue(node.left.is_set())
+
+class RestartTestCase(unittest.TestCase):
+    """ Unit test for a gossiper restarted on the same ip, on a network in one process """
+
+    def setUp(self):
+        with open('gossiper_conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+        self.conf['seeds'] = ['10.0.0.1']
+        self.network = transport.MemoryNetwork()
+        # Membership changes told to each gossiper -- ip : [(event, id)]
+        self.events = {}
+        self.nodes = [self.boot('10.0.0.%d' % i) for i in (1, 2, 3)]
+
+    def boot(self, ip):
+        node = gossiper.Gossiper(self.conf, self.network.transport(ip))
+        node.member_list.notify = lambda event, id: self.events.setdefault(ip, []).append((event, id))
+        node.open()
+        node.start()
+        return node
+
+    def test_restart(self):
+        self.network.run_until(3)
+        seed, node, restarted = self.nodes
+        old_id = restarted.id
+        restarted.transport.close()
+        # Back after missing some heartbeats, but before failing
+        self.network.run_until(6)
+        restarted = self.boot(restarted.ip)
+        self.assertNotEqual(restarted.id, old_id)
+
+        self.network.run_until(20)
+        for observer in (seed, node):
+            # The old incarnation is forgotten without failing, so the ip is never gone
+            self.assertListEqual([(event, id) for event, id in self.events[observer.ip] if id.startswith(restarted.ip + '_')],
+                                 [('joined', old_id), ('joined', restarted.id)])
+            self.assertNotIn(old_id, observer.member_list.members)
+            self.assertIn(restarted.id, observer.member_list.by_status['JOINED'])
+
+        # Nor does it come back, whatever is still told of it
+        seed.member_list.merge({old_id: {'heartbeat': 1000, 'status': 'JOINED'}})
+        seed.member_list.merge({old_id: {'heartbeat': 1000, 'status': 'LEFT'}})
+        self.assertNotIn(old_id, seed.member_list.members)
+        self.assertEqual(self.events[seed.ip][-1], ('joined', restarted.id))
+
+class ProbeTestCase(unittest.TestCase):
+    """ Unit test for the probes of SWIM, on a network in one process """
+
+    def setUp(self):
+        with open('gossiper_conf.yaml') as f:
+            self.conf = yaml.safe_load(f)
+        self.conf['seeds'] = ['10.0.0.1']
+        self.conf['detector'] = 'swim'
+        self.network = transport.MemoryNetwork()
+        self.nodes = [gossiper.Gossiper(self.conf, self.network.transport('10.0.0.%d' % i)) for i in (1, 2, 3)]
+        for node in self.nodes:
+            node.open()
+            node.start()
+        self.network.run_until(2)
+
+    def test_ack_by_id(self):
+        seed, node = self.nodes[:2]
+        # Only a PING naming the incarnation running is answered
+        for target, acked in [(node.id, True), ('%s_%d' % (node.ip, 12345), False)]:
+            seq = seed.next_seq()
+            seed.acks[seq] = target
+            seed.send(PING, node.ip, seq, target)
+            self.network.run_until(self.network.now + 0.01)
+            self.assertEqual(seq not in seed.acks, acked)
+            seed.acks.pop(seq, None)
+
+        # Nor does an ACK for another member count
+        seq = seed.next_seq()
+        seed.acks[seq] = self.nodes[2].id
+        node.send(ACK, seed.ip, seq, node.id)
+        self.network.run_until(self.network.now + 0.01)
+        self.assertIn(seq, seed.acks)
+
+    def test_restart(self):
+        seed, node, restarted = self.nodes
+        old_id = restarted.id
+        # Back before it is missed
+        restarted.transport.close()
+        self.network.run_until(self.network.now + 0.2)
+        restarted = gossiper.Gossiper(self.conf, self.network.transport(restarted.ip))
+        restarted.open()
+        restarted.start()
+
+        # The old incarnation is given up though the new one answers on its ip
+        self.network.run_until(20)
+        for observer in (seed, node):
+            self.assertNotIn(old_id, observer.member_list.by_status['JOINED'])
+            self.assertIn(restarted.id, observer.member_list.by_status['JOINED'])
+
+if __name__ == '__main__':
+    # Only the results of the tests are of interest
+    logging.getLogger('Gossiper').setLevel(logging.WARNING)
+    unittest.main()
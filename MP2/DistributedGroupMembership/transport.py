@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import time
+import heapq
+import random
+import select
+import socket
+import struct
+import logging
+import collections
+
+LOGGER = logging.getLogger('Gossiper')
+
+# Frame layout of a sync over TCP -- datagram length (4 bytes, big endian), datagram
+FRAME_HEADER = struct.Struct('!I')
+MAX_DATAGRAM = 65535
+# Bytes UDP and IP add to each datagram on the wire
+UDP_OVERHEAD = 28
+
+def send_frames(conn, datagrams):
+    conn.sendall(''.join(FRAME_HEADER.pack(len(datagram)) + datagram for datagram in datagrams))
+
+def recv_frames(conn):
+    """ Receive the datagrams framed on a connection, until the peer closes its end """
+    stream = conn.makefile('rb')
+    datagrams = []
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return datagrams
+        size = FRAME_HEADER.unpack(header)[0] if len(header) == FRAME_HEADER.size else None
+        if size is None or size > MAX_DATAGRAM:
+            raise ValueError('Not a frame')
+        datagram = stream.read(size)
+        if len(datagram) < size:
+            raise ValueError('Frame cut short')
+        datagrams.append(datagram)
+
+class UdpTransport(object):
+    """ Gossip over UDP, and syncs over TCP, with timers called back between on one select loop """
+    def __init__(self, ip, port, sync_port, sync_timeout):
+        super(UdpTransport, self).__init__()
+        self.ip = ip
+        self.port = port
+        self.sync_port = sync_port
+        self.sync_timeout = sync_timeout
+        # Heap of (due time, sequence, callback, args), called back from the loop
+        self.timers = []
+        self.timer_seq = 0
+        self.sock = None
+        # Listened on for nodes joining, by seeds only
+        self.sync_sock = None
+
+    def time(self):
+        return time.time()
+
+    def schedule(self, delay, callback, *args):
+        """ Call back from the loop after delay seconds """
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_seq, callback, args))
+
+    def open(self, on_datagram, on_sync=None):
+        """ Pass datagrams received to on_datagram(datagram, src_ip), and if on_sync is given,
+            answer the syncs of nodes joining with the datagrams on_sync(src_ip, datagrams) returns
+        """
+        self.on_datagram = on_datagram
+        self.on_sync = on_sync
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.ip, self.port))
+        if on_sync is not None:
+            self.sync_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sync_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sync_sock.bind((self.ip, self.sync_port))
+            self.sync_sock.listen(16)
+
+    def loop(self, until):
+        """ Receive on the sockets and call back timers between, until until() is true """
+        while not until():
+            timeout = max(0, self.timers[0][0] - time.time()) if self.timers else None
+            readable, _, _ = select.select([s for s in (self.sock, self.sync_sock) if s], [], [], timeout)
+            if self.sock in readable:
+                self.call(self.receive)
+            if self.sync_sock in readable:
+                self.call(self.serve_sync)
+            while self.timers and self.timers[0][0] <= time.time():
+                due, seq, callback, args = heapq.heappop(self.timers)
+                self.call(callback, *args)
+
+    def call(self, callback, *args):
+        """ Call back, logging what it raises, so a bad datagram or timer never stops the loop """
+        try:
+            callback(*args)
+        except Exception:
+            LOGGER.exception('Failed in %s' % getattr(callback, '__name__', callback))
+
+    def close(self):
+        self.sock.close()
+        if self.sync_sock:
+            self.sync_sock.close()
+
+    def send(self, dest_ip, datagram):
+        try:
+            self.sock.sendto(datagram, (dest_ip, self.port))
+        except socket.error, e:
+            LOGGER.info('Failed to send to %s: %s' % (dest_ip, e))
+
+    def receive(self):
+        try:
+            datagram, address = self.sock.recvfrom(MAX_DATAGRAM)
+        except socket.error, e:
+            LOGGER.info('Failed to receive: %s' % e)
+            return
+        self.on_datagram(datagram, address[0])
+
+    def sync(self, seed_ip, datagrams):
+        """ Send datagrams to a seed, and return the datagrams it answers with,
+            or raise socket.error if it can't be reached
+        """
+        conn = socket.create_connection((seed_ip, self.sync_port), self.sync_timeout, (self.ip, 0))
+        try:
+            send_frames(conn, datagrams)
+            conn.shutdown(socket.SHUT_WR)
+            return recv_frames(conn)
+        finally:
+            conn.close()
+
+    def serve_sync(self):
+        try:
+            conn, address = self.sync_sock.accept()
+        except socket.error, e:
+            LOGGER.info('Failed to accept: %s' % e)
+            return
+        # A slow joiner holds up the loop, but no longer than the timeout
+        try:
+            conn.settimeout(self.sync_timeout)
+            send_frames(conn, self.on_sync(address[0], recv_frames(conn)))
+        except (socket.error, ValueError), e:
+            LOGGER.info('Failed to sync %s: %s' % (address[0], e))
+        except Exception:
+            LOGGER.exception('Failed to sync %s' % address[0])
+        finally:
+            conn.close()
+
+class MemoryNetwork(object):
+    """ Transports in one process on simulated time, over a network that loses and delays datagrams at random """
+    def __init__(self, loss=0.0, latency=0.0, jitter=0.0):
+        super(MemoryNetwork, self).__init__()
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.now = 0.0
+        # Heap of (due time, sequence, callback, args)
+        self.events = []
+        self.event_seq = 0
+        # Entry format -- ip : MemoryTransport
+        self.transports = {}
+        self.sent_bytes = collections.Counter()
+
+    def transport(self, ip):
+        self.transports[ip] = MemoryTransport(self, ip)
+        return self.transports[ip]
+
+    def at(self, due, callback, *args):
+        self.event_seq += 1
+        heapq.heappush(self.events, (due, self.event_seq, callback, args))
+
+    def deliver(self, src_ip, dest_ip, datagram):
+        self.sent_bytes[src_ip] += len(datagram) + UDP_OVERHEAD
+        dest = self.transports.get(dest_ip)
+        if dest is None or not dest.up or random.random() < self.loss:
+            return
+        self.at(self.now + self.latency + random.random() * self.jitter, dest.receive, datagram, src_ip)
+
+    def run_until(self, end, check=None, every=0.1):
+        """ Run the network to end, or until check() is true, tested every that often """
+        next_check = self.now
+        while self.events and self.events[0][0] <= end:
+            if check and self.events[0][0] >= next_check:
+                self.now = next_check
+                if check():
+                    return True
+                next_check += every
+            due, seq, callback, args = heapq.heappop(self.events)
+            self.now = due
+            callback(*args)
+        if end != float('inf'):
+            self.now = end
+        return False
+
+class MemoryTransport(object):
+    """ A transport on a MemoryNetwork, which is up from open() until close(), like a machine """
+    def __init__(self, network, ip):
+        super(MemoryTransport, self).__init__()
+        self.network = network
+        self.ip = ip
+        self.up = False
+        self.on_datagram = None
+        self.on_sync = None
+
+    def time(self):
+        return self.network.now
+
+    def schedule(self, delay, callback, *args):
+        if self.up:
+            self.network.at(self.network.now + delay, self.fire, callback, args)
+
+    def fire(self, callback, args):
+        # Timers die along with the transport
+        if self.up:
+            callback(*args)
+
+    def open(self, on_datagram, on_sync=None):
+        self.on_datagram = on_datagram
+        self.on_sync = on_sync
+        self.up = True
+
+    def loop(self, until):
+        """ Run the whole network until until() is true """
+        self.network.run_until(float('inf'), until, 0)
+
+    def close(self):
+        self.up = False
+
+    def send(self, dest_ip, datagram):
+        if self.up:
+            self.network.deliver(self.ip, dest_ip, datagram)
+
+    def receive(self, datagram, src_ip):
+        if self.up:
+            self.on_datagram(datagram, src_ip)
+
+    def sync(self, seed_ip, datagrams):
+        """ Syncs reach the seed at once, in no simulated time """
+        seed = self.network.transports.get(seed_ip)
+        if seed is None or not seed.up or seed.on_sync is None:
+            raise socket.error('Connection refused')
+        self.network.sent_bytes[self.ip] += sum(len(datagram) for datagram in datagrams)
+        answer = seed.on_sync(self.ip, datagrams)
+        self.network.sent_bytes[seed_ip] += sum(len(datagram) for datagram in answer)
+        return answer
@@ -1,41 +1,91 @@
 #!/usr/bin/env python
 
-from sortedcontainers import SortedDict
+import bisect
 import hashlib
-import gossiper
 import socket
 import thread
+import threading
 import yaml
 import os
+import sys
 import logging
 import time
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 import xmlrpclib
 import random
 import time
-
-logging.basicConfig(
-    level=logging.DEBUG, 
-    format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s',
-    # Seperate logs by each instance starting
-    filename='SDFS.log.' + str(int(time.time())),
-    filemode='w',
-)
+# The gossiper is shared with the other MPs, from the group membership of MP2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'MP2', 'DistributedGroupMembership'))
+import gossiper
 
 SDFS_LOGGER = logging.getLogger('SDFS')
 
+# Copies kept of each file
+REPLICAS = 3
+
 def find_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(('8.8.8.8', 0))
     return s.getsockname()[0]
 
+class Ring(object):
+    """ Snapshot of the points of servers on the ring, never changed once made,
+        so lookups need no lock while the file table makes a new one
+    """
+    def __init__(self, points):
+        super(Ring, self).__init__()
+        # points -- [(hash, ip)] in the order of hash
+        self.hashes = [hash for hash, ip in points]
+        self.ips = [ip for hash, ip in points]
+        # Replicas of the keys falling on each point, the first REPLICAS servers from it on
+        replica_num = min(REPLICAS, len(set(self.ips)))
+        self.replicas = []
+        for idx in xrange(len(self.ips)):
+            replicas = []
+            while len(replicas) < replica_num:
+                ip = self.ips[idx % len(self.ips)]
+                if ip not in replicas:
+                    replicas.append(ip)
+                idx += 1
+            self.replicas.append(replicas)
+
+    def point(self, hash):
+        """ Index of the point a key falls on, the first at or after its hash """
+        idx = bisect.bisect_left(self.hashes, hash)
+        return idx if idx < len(self.hashes) else 0
+
+    def lookup(self, hash):
+        return list(self.replicas[self.point(hash)]) if self.ips else []
+
+    def successors(self, hash):
+        """ Servers in the order of their first points from a key on """
+        start = self.point(hash)
+        seen = set()
+        for i in xrange(len(self.ips)):
+            ip = self.ips[(start + i) % len(self.ips)]
+            if ip not in seen:
+                seen.add(ip)
+                yield ip
+
 class FileTable(object):
     """docstring for FileTable"""
-    def __init__(self, myip, server):
+    def __init__(self, myip, server, vnodes=1, weights=None):
         super(FileTable, self).__init__()
-        self.ring = SortedDict()
         self.hasher = hashlib.sha224
-        self.myhash = self.hash(myip)
+        self.myip = myip
+        # Each server is vnodes points on the ring, times its weight, 1 unless given
+        self.vnodes = vnodes
+        self.weights = weights or {}
+        # Entry format -- ip : {'ip' : ip, 'files' : set([sdfs filename])}
+        self.nodes = {}
+        # Entry format -- sdfs filename : set([ip]), the replicas of each file, kept in step with the files of nodes
+        self.files = {}
+        # Entry format -- hash : ip
+        self.points = {}
+        self.ring = Ring([])
+        # Guards the tables above, changed by membership changes and by RPCs at once,
+        #   while lookups only take the ring as it is
+        self.lock = threading.RLock()
         self.add_node(myip)
 
         self.server = server
@@ -43,120 +93,152 @@ class FileTable(object):
     def hash(self, key):
         return self.hasher(key).hexdigest()[:-10]
 
-    def hash_at(self, idx):
-        idx %= len(self.ring)
-        hash = self.ring.iloc[idx]
-        return hash
+    def point_num(self, ip):
+        return max(1, int(round(self.vnodes * float(self.weights.get(ip, 1)))))
 
     def add_node(self, ip):
-        hash = self.hash(ip)
-        self.ring[hash] = {'ip': ip, 'files': []}
+        with self.lock:
+            if ip in self.nodes:
+                return
+            self.nodes[ip] = {'ip': ip, 'files': set()}
+            for i in xrange(self.point_num(ip)):
+                self.points[self.hash('%s#%d' % (ip, i))] = ip
+            self.ring = Ring(sorted(self.points.iteritems()))
 
-        SDFS_LOGGER.info('After adding %s - %s' % (ip, repr(self.ring)))
+            SDFS_LOGGER.info('After adding %s - %s' % (ip, repr(sorted(self.nodes))))
 
     def remove_node(self, failed_list):
         start_time = time.time()
-        # this is for debug
-        flag  = False
-            
-        # deep copy failed list because it will be reset soon
-        ip_list = list(failed_list)
-
-        # change the order of failed node
-        # make sure the smaller id node be handled first
-        if len(ip_list) == 2:
-            if self.hash(ip_list[0]) == 0 and self.hash(ip_list[1]) == len(self.ring) - 1:
-                ip_list[0], ip_list[1] = ip_list[1], ip_list[0]
-            elif self.ring.index(self.hash(ip_list[0])) == self.ring.index(self.hash(ip_list[1])) + 1:
-                ip_list[0], ip_list[1] = ip_list[1], ip_list[0]
-
-        for ip in ip_list:
-            hash = self.hash(ip)
-            idx = self.ring.index(hash)
-
-            # if the node is not the direct successor of the failed node, do nothing
-            if len(ip_list) == 2 and ip == ip_list[1] and self.hash_at((idx + 2) % len(self.ring)) == self.myhash:
-                continue
+        with self.lock:
+            failed = set(ip for ip in failed_list if ip in self.nodes)
+            if not failed:
+                return
+
+            # Files which lost a replica along with the failed nodes
+            heritage = set()
+            for ip in failed:
+                for sdfs_filename in self.nodes.pop(ip)['files']:
+                    self.files[sdfs_filename].discard(ip)
+                    heritage.add(sdfs_filename)
+            self.points = {hash: ip for hash, ip in self.points.iteritems() if ip not in failed}
+            self.ring = Ring(sorted(self.points.iteritems()))
+
+            # The new replicas of a file are the next servers on the ring not holding one yet,
+            #   which the first holder left copies it to, and has everyone record once there
+            to_push = []
+            for sdfs_filename in heritage:
+                holders = sorted(self.files[sdfs_filename])
+                if not holders:
+                    del self.files[sdfs_filename]
+                    SDFS_LOGGER.info('Lost all replicas of %s' % sdfs_filename)
+                    continue
+                if holders[0] != self.myip:
+                    continue
+                for ip in self.ring.successors(self.hash(sdfs_filename)):
+                    if len(holders) >= REPLICAS:
+                        break
+                    if ip not in holders:
+                        holders.append(ip)
+                        to_push.append((sdfs_filename, ip))
 
-            if self.hash_at((idx + 1) % len(self.ring)) == self.myhash or (self.hash_at((idx + 2) % len(self.ring)) == self.myhash and len(ip_list) == 2):
-                # this is for debug
-                flag = True
-
-                heritage = set(self.ring[hash]['files'])
-                my_files = set(self.ring[self.myhash]['files'])
-                next_files = set(self.ring[self.hash_at(idx + 2)]['files'])
-
-                # determine the 
-                to_me = heritage - my_files
-                to_next = (heritage & my_files) - next_files
-                to_next_next = heritage & my_files & next_files
-                replica_list = [list(to_me), list(to_next), list(to_next_next)]
-                
-                self.ring[self.myhash]['files'].extend(to_me)
-
-                # handle replica
-                dest_ip_to_me = self.ring[self.hash_at(self.ring.index(hash) - 1)]['ip']
-                dest_ip_to_next = self.ring[self.hash_at(self.ring.index(self.myhash) + 1)]['ip']
-                dest_ip_to_next_next = self.ring[self.hash_at(self.ring.index(self.myhash) + 2)]['ip']
-                dest_ip_list = [dest_ip_to_me, dest_ip_to_next, dest_ip_to_next_next]
-                
-                del self.ring[hash]
-
-                self.server.handle_replica(replica_list, dest_ip_list, ip_list)
-            
-            else:
-                del self.ring[hash]
-            
+        # Copied without holding the lock, as files may be put and deleted meanwhile
+        if to_push:
+            self.server.push_replicas(to_push)
             elapsed_time = time.time() - start_time
-            if flag:
-                print "It takes", elapsed_time, "to handle replica"
+            print "It takes", elapsed_time, "to handle replica"
+
+    def update_members(self, events):
+        # Membership changes come in batches from the gossiper,
+        #   so nodes failing together are removed in one pass
+        gone = []
+        for event, id in events:
+            if event == 'joined':
+                if gone:
+                    self.remove_node(gone)
+                    gone = []
+                self.add_node(id.split('_')[0])
+            else:
+                gone.append(id.split('_')[0])
+        if gone:
+            self.remove_node(gone)
 
     def lookup(self, sdfs_filename):
-        hash = self.hash(sdfs_filename)
-        idx = self.ring.bisect_left(hash) if self.ring.bisect_left(hash) < len(self.ring) else 0
-        ip_list = [self.ring[self.hash_at(idx + i)]['ip'] for i in xrange(3)]
-        return ip_list
+        """ Where a file is to be put """
+        return self.ring.lookup(self.hash(sdfs_filename))
+
+    def locate(self, sdfs_filename):
+        """ Where the replicas of a file are, which is not where the ring says once some were made again """
+        with self.lock:
+            return sorted(self.files.get(sdfs_filename, ()))
+
+    def add_replica(self, sdfs_filename, ip):
+        """ Record a replica made again of a file, unless the file was deleted or the node is gone since """
+        with self.lock:
+            if sdfs_filename not in self.files or ip not in self.nodes:
+                return False
+            self.files[sdfs_filename].add(ip)
+            self.nodes[ip]['files'].add(sdfs_filename)
+            return True
 
     def insert(self, sdfs_filename):
-        hash = self.hash(sdfs_filename)
-        idx = self.ring.bisect_left(hash) if self.ring.bisect_left(hash) < len(self.ring) else 0
-        for i in xrange(3):
-            node_hash = self.hash_at(idx + i)
-            self.ring[node_hash]['files'].append(sdfs_filename)
-            
-            SDFS_LOGGER.info('Inserted %s to %s' % (sdfs_filename, self.ring[node_hash]['ip']))
-
-    def delete(self, sdfs_filename):
-        hash = self.hash(sdfs_filename)
-        idx = self.ring.bisect_left(hash) if self.ring.bisect_left(hash) < len(self.ring) else 0
-        for i in xrange(3):
-            node_hash = self.hash_at(idx + i)
-            self.ring[node_hash]['files'].remove(sdfs_filename)
-            
-            SDFS_LOGGER.info('Deleted %s to %s' % (sdfs_filename, self.ring[node_hash]['ip']))
+        with self.lock:
+            for ip in self.lookup(sdfs_filename):
+                self.files.setdefault(sdfs_filename, set()).add(ip)
+                self.nodes[ip]['files'].add(sdfs_filename)
 
-    def update_replica(self, replica_list, dest_ip_list):
-        for i in xrange(3):
-            self.ring[self.hash(dest_ip_list[i])]['files'] = list(set(self.ring[self.hash(dest_ip_list[i])]['files'] + replica_list[i]))
+                SDFS_LOGGER.info('Inserted %s to %s' % (sdfs_filename, ip))
 
+    def delete(self, sdfs_filename):
+        with self.lock:
+            for ip in self.files.pop(sdfs_filename, ()):
+                self.nodes[ip]['files'].discard(sdfs_filename)
+
+                SDFS_LOGGER.info('Deleted %s to %s' % (sdfs_filename, ip))
+
+    def load_report(self):
+        """ Share of the hash space each server is a replica for, against its share of the weights,
+            and the files it stores
+        """
+        with self.lock:
+            ring = self.ring
+            nodes = {ip: {'ip': ip, 'files': set(node['files'])} for ip, node in self.nodes.iteritems()}
+        space = 16 ** len(self.hash(''))
+        primary = dict.fromkeys(nodes, 0)
+        replica = dict.fromkeys(nodes, 0)
+        # Keys falling on a point are those after the point before it
+        for idx in xrange(len(ring.hashes)):
+            arc = (int(ring.hashes[idx], 16) - int(ring.hashes[idx - 1], 16)) % space or space
+            primary[ring.ips[idx]] += arc
+            for ip in ring.replicas[idx]:
+                replica[ip] += arc
+
+        total_points = sum(self.point_num(ip) for ip in nodes)
+        print '%-16s %7s %8s %8s %9s %6s' % ('server', 'points', 'primary', 'replica', 'expected', 'files')
+        for ip in sorted(nodes):
+            expected = min(1.0, float(min(REPLICAS, len(nodes))) * self.point_num(ip) / total_points)
+            print '%-16s %7d %7.1f%% %7.1f%% %8.1f%% %6d' % (
+                ip, self.point_num(ip), 100.0 * primary[ip] / space, 100.0 * replica[ip] / space,
+                100.0 * expected, len(nodes[ip]['files']))
+        # Load of each server per point it was given, which is even if the ring is balanced
+        loads = [float(replica[ip]) / self.point_num(ip) for ip in nodes]
+        print 'max/mean load per point %.2f' % (max(loads) / (sum(loads) / len(loads)))
 
     def list_my_store(self):
+        with self.lock:
+            files = sorted(self.nodes[self.myip]['files'])
         print '-' * 5 + 'my files are:'
-        for f in self.ring[self.myhash]['files']:
+        for f in files:
             print f,
         print
         print '-' * 5 + 'that is all'
 
     def list_file_location(self):
-        all_files = set()
-        for value in self.ring.values():
-            all_files.update(set(value['files']))
-
-        for f in all_files:
+        with self.lock:
+            locations = [(f, sorted(ips)) for f, ips in sorted(self.files.iteritems())]
+        for f, ips in locations:
             print f + ' is stored at ',
-            for value in self.ring.values():
-                if f in value['files']:
-                    print value['ip'],
+            for ip in ips:
+                print ip,
             print 
 
 
@@ -170,8 +252,9 @@ class SDFSServer(object):
 
         self.block_size = 20000000
 
-        self.filetable = FileTable(self.ip, self)
-        self.gossiper = gossiper.Gossiper(self.filetable)
+        self.filetable = FileTable(self.ip, self, self.conf['vnodes'], self.conf['weights'])
+        self.gossiper = gossiper.Gossiper()
+        self.gossiper.member_list.add_listener(self.filetable.update_members)
 
         if not os.path.exists(self.conf['path']):
             os.makedirs(self.conf['path'])
@@ -194,8 +277,11 @@ class SDFSServer(object):
 
         # Inform everyone the put file
         self.insert_entry(sdfs_filename)
-        for id in self.gossiper.member_list.members:
-            proxy = xmlrpclib.ServerProxy('http://%s:%d' % (id.split('_')[0], self.conf['rpc_port']), allow_none=True)
+        for member in self.gossiper.member_list.members.values():
+            # Seeds not heard of are only there to gossip to
+            if member.status == 'ADDED':
+                continue
+            proxy = xmlrpclib.ServerProxy('http://%s:%d' % (member.ip, self.conf['rpc_port']), allow_none=True)
             proxy.insert_entry(sdfs_filename)
 
         elapsed_time = time.time() - start_time
@@ -204,10 +290,7 @@ class SDFSServer(object):
     def get_file(self, sdfs_filename, local_filename):
         start_time = time.time()
 
-        source_ip_list = []
-        for value in self.filetable.ring.values():
-            if sdfs_filename in value['files']:
-                source_ip_list.append(value['ip'])
+        source_ip_list = self.filetable.locate(sdfs_filename)
 
         # get from any available source
         for dest_ip in source_ip_list:
@@ -231,10 +314,7 @@ class SDFSServer(object):
         print "It takes ", elapsed_time, " to get file."
         
     def delete_file(self, sdfs_filename):
-        source_ip_list = []
-        for value in self.filetable.ring.values():
-            if sdfs_filename in value['files']:
-                source_ip_list.append(value['ip'])
+        source_ip_list = self.filetable.locate(sdfs_filename)
 
         # delete all the replicas
         for dest_ip in source_ip_list:
@@ -244,43 +324,35 @@ class SDFSServer(object):
 
         # Inform everyone the put file
         self.delete_entry(sdfs_filename)
-        for id in self.gossiper.member_list.members:
-            proxy = xmlrpclib.ServerProxy('http://%s:%d' % (id.split('_')[0], self.conf['rpc_port']), allow_none=True)
+        for member in self.gossiper.member_list.members.values():
+            # Seeds not heard of are only there to gossip to
+            if member.status == 'ADDED':
+                continue
+            proxy = xmlrpclib.ServerProxy('http://%s:%d' % (member.ip, self.conf['rpc_port']), allow_none=True)
             proxy.delete_entry(sdfs_filename)
 
-    def handle_replica(self, replica_list, dest_ip_list, failed_list):
-        # for to_me
-        dest_ip = dest_ip_list[0]
-        proxy = xmlrpclib.ServerProxy('http://%s:%d' % (dest_ip, self.conf['rpc_port']), allow_none=True)
-        for replica_to_get in replica_list[0]:
-            binary = proxy.handle_get_replica(replica_to_get, self.ip)
-            with open(self.conf['path'] + replica_to_get, 'wb') as f:
-                f.write(binary.data)
-        
-        # for to_next
-        dest_ip = dest_ip_list[1]
-        proxy = xmlrpclib.ServerProxy('http://%s:%d' % (dest_ip, self.conf['rpc_port']), allow_none=True)
-        for replica_to_put in replica_list[1]:
-            with open(self.conf['path'] + replica_to_put, 'rb') as f:
-                f.seek(0)
-                proxy.handle_put_replica(replica_to_put, xmlrpclib.Binary(f.read()))
-
-        # for to_next_next
-        dest_ip = dest_ip_list[2]
-        proxy = xmlrpclib.ServerProxy('http://%s:%d' % (dest_ip, self.conf['rpc_port']), allow_none=True)
-        for replica_to_put in replica_list[2]:
-            with open(self.conf['path'] + replica_to_put, 'rb') as f:
-                f.seek(0)
-                proxy.handle_put_replica(replica_to_put, xmlrpclib.Binary(f.read()))
-
-        dest_ip_list[0] = self.ip
-        for value in self.filetable.ring.values():
-            dest_ip = value['ip']
-            if dest_ip in failed_list:
-                continue
-            else:
+    def push_replicas(self, replicas):
+        # Copy files which lost a replica to their new holders, given as [(sdfs filename, dest ip)],
+        #   and only once a copy is there, inform everyone of it
+        for sdfs_filename, dest_ip in replicas:
+            try:
                 proxy = xmlrpclib.ServerProxy('http://%s:%d' % (dest_ip, self.conf['rpc_port']), allow_none=True)
-                proxy.handle_filetable_update(replica_list, dest_ip_list)
+                with open(self.conf['path'] + sdfs_filename, 'rb') as f:
+                    proxy.handle_put_replica(sdfs_filename, xmlrpclib.Binary(f.read()))
+            except Exception, e:
+                SDFS_LOGGER.info('Failed to replicate %s to %s: %s' % (sdfs_filename, dest_ip, e))
+                continue
+
+            self.add_replica_entry(sdfs_filename, dest_ip)
+            for member in self.gossiper.member_list.members.values():
+                # Seeds not heard of are only there to gossip to
+                if member.status == 'ADDED':
+                    continue
+                try:
+                    proxy = xmlrpclib.ServerProxy('http://%s:%d' % (member.ip, self.conf['rpc_port']), allow_none=True)
+                    proxy.add_replica_entry(sdfs_filename, dest_ip)
+                except Exception, e:
+                    SDFS_LOGGER.info('Failed to inform %s of the replica of %s: %s' % (member.ip, sdfs_filename, e))
 
     def handle_get_file_len(self, sdfs_filename):
         # with open(self.conf['path'] + sdfs_filename, 'rb') as f:
@@ -313,15 +385,15 @@ class SDFSServer(object):
     def handle_delete_file(self, sdfs_filename):
         os.remove(self.conf['path'] + sdfs_filename)
 
-    def handle_filetable_update(self, replica_list, dest_ip_list):
-        self.filetable.update_replica(replica_list, dest_ip_list)
-
     def insert_entry(self, sdfs_filename):
         self.filetable.insert(sdfs_filename)
 
     def delete_entry(self, sdfs_filename):
         self.filetable.delete(sdfs_filename)
 
+    def add_replica_entry(self, sdfs_filename, ip):
+        self.filetable.add_replica(sdfs_filename, ip)
+
     def run(self):
         self.gossiper.run()
         while True:
@@ -342,11 +414,21 @@ class SDFSServer(object):
             elif head == 'LEAVE':
                 self.gossiper.leave()
             elif head == 'FILE':
-                print self.filetable.ring
+                print self.filetable.nodes
+            elif head == 'LOAD':
+                self.filetable.load_report()
             else:
                 pass
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG, 
+        format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s',
+        # Seperate logs by each instance starting
+        filename='SDFS.log.' + str(int(time.time())),
+        filemode='w',
+    )
+
     sdfs_server = SDFSServer()
 
     rpc_server = SimpleXMLRPCServer((find_local_ip(), 2335), logRequests=True, allow_none=True)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import logging
+import unittest
+import yaml
+from SDFSServer import REPLICAS, Ring, FileTable
+# Found by SDFSServer along with the gossiper
+import gossiper
+import transport
+
+IPS = ['10.0.0.%d' % i for i in xrange(1, 6)]
+
+class StubServer(object):
+    """ Stands in for the server of each file table, copying replicas by recording them
+        on every table of the cluster, as the RPCs would
+    """
+    def __init__(self, cluster):
+        super(StubServer, self).__init__()
+        # cluster -- {ip : FileTable}, shared by the servers
+        self.cluster = cluster
+        self.unreachable = set()
+        self.pushed = []
+        # Called with each replica before it is copied
+        self.before_push = None
+
+    def push_replicas(self, replicas):
+        for sdfs_filename, dest_ip in replicas:
+            if self.before_push:
+                self.before_push(sdfs_filename, dest_ip)
+            if dest_ip in self.unreachable:
+                continue
+            self.pushed.append((sdfs_filename, dest_ip))
+            for table in self.cluster.values():
+                table.add_replica(sdfs_filename, dest_ip)
+
+def make_cluster(ips, vnodes=16):
+    cluster = {}
+    server = StubServer(cluster)
+    for ip in ips:
+        cluster[ip] = FileTable(ip, server, vnodes)
+    for table in cluster.values():
+        for ip in ips:
+            table.add_node(ip)
+    return cluster, server
+
+class RingTestCase(unittest.TestCase):
+    """ Unit test for where keys fall on the ring """
+
+    def test_wraparound(self):
+        ring = Ring([('10', 'a'), ('20', 'b'), ('30', 'c'), ('40', 'a')])
+        # A key falls on the first point at or after it, past the last back to the first
+        self.assertEqual(ring.lookup('15'), ['b', 'c', 'a'])
+        self.assertEqual(ring.lookup('20'), ['b', 'c', 'a'])
+        self.assertEqual(ring.lookup('35'), ['a', 'b', 'c'])
+        self.assertEqual(ring.lookup('45'), ['a', 'b', 'c'])
+        # The next points of a server already in are skipped
+        self.assertEqual(ring.lookup('31'), ['a', 'b', 'c'])
+        self.assertEqual(list(ring.successors('25')), ['c', 'a', 'b'])
+
+    def test_few_servers(self):
+        self.assertEqual(Ring([]).lookup('10'), [])
+        self.assertEqual(list(Ring([]).successors('10')), [])
+
+        table = FileTable(IPS[0], None, 16)
+        self.assertEqual(table.lookup('a'), [IPS[0]])
+        table.add_node(IPS[1])
+        for i in xrange(100):
+            self.assertEqual(sorted(table.lookup('file%d' % i)), IPS[:2])
+        table.add_node(IPS[2])
+        table.add_node(IPS[3])
+        for i in xrange(100):
+            replicas = table.lookup('file%d' % i)
+            self.assertEqual(len(set(replicas)), REPLICAS)
+
+    def test_weights(self):
+        table = FileTable(IPS[0], None, 64, {IPS[1]: 2, IPS[2]: 0.5})
+        for ip in IPS[1:]:
+            table.add_node(ip)
+        self.assertEqual(table.ring.ips.count(IPS[0]), 64)
+        self.assertEqual(table.ring.ips.count(IPS[1]), 128)
+        self.assertEqual(table.ring.ips.count(IPS[2]), 32)
+
+        # Files are first put on each server about as often as it has points
+        primary = dict.fromkeys(IPS, 0)
+        for i in xrange(6000):
+            primary[table.lookup('file%d' % i)[0]] += 1
+        total_points = len(table.ring.ips)
+        for ip in IPS:
+            expected = 6000.0 * table.point_num(ip) / total_points
+            self.assertTrue(0.7 * expected < primary[ip] < 1.3 * expected, (ip, primary[ip], expected))
+
+class IndexTestCase(unittest.TestCase):
+    """ Unit test for the replicas kept by file and by node """
+
+    def assertInStep(self, table):
+        for sdfs_filename, ips in table.files.iteritems():
+            self.assertTrue(ips)
+            for ip in ips:
+                self.assertIn(sdfs_filename, table.nodes[ip]['files'])
+        for ip, node in table.nodes.iteritems():
+            for sdfs_filename in node['files']:
+                self.assertIn(ip, table.files[sdfs_filename])
+
+    def test_in_step(self):
+        cluster, server = make_cluster(IPS)
+        table = cluster[IPS[0]]
+        for i in xrange(50):
+            table.insert('file%d' % i)
+        self.assertInStep(table)
+        self.assertEqual(sum(len(node['files']) for node in table.nodes.values()), 50 * REPLICAS)
+
+        # Putting a file again does not add it twice
+        table.insert('file0')
+        self.assertEqual(table.locate('file0'), sorted(table.lookup('file0')))
+        self.assertEqual(sum(len(node['files']) for node in table.nodes.values()), 50 * REPLICAS)
+        self.assertInStep(table)
+
+        holders = table.locate('file1')
+        table.delete('file1')
+        self.assertEqual(table.locate('file1'), [])
+        self.assertFalse(any('file1' in table.nodes[ip]['files'] for ip in holders))
+        # Deleting a file not there is nothing
+        table.delete('file1')
+        self.assertInStep(table)
+
+        table.remove_node([IPS[1], IPS[2]])
+        self.assertInStep(table)
+        self.assertEqual(sorted(table.nodes), [IPS[0]] + IPS[3:])
+        self.assertFalse(any(set(ips) & set(IPS[1:3]) for ips in table.files.values()))
+        self.assertEqual(len(table.files), 49)
+
+        # The same file put again after the failures goes to the servers left
+        table.insert('file1')
+        self.assertEqual(table.locate('file1'), sorted(table.lookup('file1')))
+        self.assertInStep(table)
+
+class ReplicationTestCase(unittest.TestCase):
+    """ Unit test for making replicas again when servers fail """
+
+    def assertConsistent(self, cluster):
+        tables = cluster.values()
+        for table in tables:
+            self.assertEqual(table.files, tables[0].files)
+            self.assertEqual(sorted(table.nodes), sorted(cluster))
+            for ip, node in table.nodes.iteritems():
+                self.assertEqual(node['files'], set(f for f, ips in table.files.iteritems() if ip in ips))
+
+    def test_failures(self):
+        cluster, server = make_cluster(IPS)
+        filenames = ['file%d' % i for i in xrange(300)]
+        for table in cluster.values():
+            for sdfs_filename in filenames:
+                table.insert(sdfs_filename)
+        lost = sum(len(set(cluster[IPS[0]].locate(f)) & set(IPS[1::2])) for f in filenames)
+
+        failed = IPS[1::2]
+        for ip in failed:
+            del cluster[ip]
+        for table in cluster.values():
+            table.remove_node(failed)
+
+        self.assertConsistent(cluster)
+        for sdfs_filename in filenames:
+            holders = cluster[IPS[0]].locate(sdfs_filename)
+            self.assertEqual(len(holders), REPLICAS)
+            self.assertFalse(set(holders) & set(failed))
+        # Each lost replica is made again once
+        self.assertEqual(len(server.pushed), lost)
+        self.assertEqual(len(set(server.pushed)), lost)
+
+    def test_failed_push(self):
+        cluster, server = make_cluster(IPS[:4])
+        for table in cluster.values():
+            table.insert('a')
+        holders = cluster[IPS[0]].locate('a')
+        failed = holders[-1]
+        dest_ip = (set(IPS[:4]) - set(holders)).pop()
+        server.unreachable.add(dest_ip)
+
+        del cluster[failed]
+        for table in cluster.values():
+            table.remove_node([failed])
+        # A replica not copied is not in any table
+        self.assertConsistent(cluster)
+        for table in cluster.values():
+            self.assertEqual(table.locate('a'), holders[:-1])
+            self.assertNotIn('a', table.nodes[dest_ip]['files'])
+
+    def test_delete_while_replicating(self):
+        cluster, server = make_cluster(IPS[:4])
+        for table in cluster.values():
+            table.insert('a')
+            table.insert('b')
+        failed = cluster[IPS[0]].locate('a')[-1]
+
+        # The file is deleted everywhere just as its replica is copied
+        def delete(sdfs_filename, dest_ip):
+            if sdfs_filename == 'a':
+                for table in cluster.values():
+                    table.delete(sdfs_filename)
+        server.before_push = delete
+        del cluster[failed]
+        for table in cluster.values():
+            table.remove_node([failed])
+
+        self.assertConsistent(cluster)
+        for table in cluster.values():
+            self.assertEqual(table.locate('a'), [])
+            # Nor is a replica recorded on a server gone
+            self.assertFalse(table.add_replica('b', failed))
+
+class RestartTestCase(unittest.TestCase):
+    """ Unit test for the ring as gossipers on a network in one process tell of members """
+
+    def test_restart(self):
+        with open('gossiper_conf.yaml') as f:
+            conf = yaml.safe_load(f)
+        conf['seeds'] = [IPS[0]]
+        network = transport.MemoryNetwork()
+        cluster = {}
+        server = StubServer(cluster)
+        def boot(ip):
+            node = gossiper.Gossiper(conf, network.transport(ip))
+            cluster[ip] = table = FileTable(ip, server, 16)
+            # Told at once rather than batched by a listener thread
+            node.member_list.notify = lambda event, id: table.update_members([(event, id)])
+            node.open()
+            node.start()
+            return node
+        nodes = [boot(ip) for ip in IPS[:4]]
+        network.run_until(3)
+        for table in cluster.values():
+            self.assertListEqual(sorted(table.nodes), IPS[:4])
+            for i in xrange(50):
+                table.insert('file%d' % i)
+        holders = {f: cluster[IPS[0]].locate(f) for f in cluster[IPS[0]].files}
+
+        # Back after missing some heartbeats, but before failing
+        restarted = nodes[3]
+        restarted.transport.close()
+        network.run_until(6)
+        del cluster[restarted.ip]
+        boot(restarted.ip)
+        network.run_until(20)
+
+        # The others neither drop it from the ring, nor make its replicas again elsewhere
+        for ip in IPS[:3]:
+            self.assertListEqual(sorted(cluster[ip].nodes), IPS[:4])
+            self.assertEqual(cluster[ip].ring.ips.count(restarted.ip), 16)
+            self.assertDictEqual({f: cluster[ip].locate(f) for f in cluster[ip].files}, holders)
+        self.assertListEqual(server.pushed, [])
+
+if __name__ == '__main__':
+    # Only the results of the tests are of interest
+    logging.getLogger('SDFS').setLevel(logging.WARNING)
+    unittest.main()
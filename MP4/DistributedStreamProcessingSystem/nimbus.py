@@ -1,8 +1,12 @@
+import os
+import sys
 import socket
 import yaml
-import gossiper
 import xmlrpclib
 import logging
+# The gossiper is shared with the other MPs, from the group membership of MP2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'MP2', 'DistributedGroupMembership'))
+import gossiper
 
 LOGGER = logging.getLogger('Nimbus')
 
@@ -15,10 +19,6 @@ class Nimbus(object):
     def __init__(self):
         super(Nimbus, self).__init__()
 
-        # nimbus need to know the global membership to manage the cluster
-        self.gossiper = gossiper.Gossiper(self)
-        self.gossiper.run()
-
         # Configuration for the system
         with open('crane_conf.yaml') as f:
             self.crane_conf = yaml.load(f)
@@ -33,6 +33,19 @@ class Nimbus(object):
         ## focus on logical
         self.topo = None
 
+        # nimbus need to know the global membership to manage the cluster
+        self.gossiper = gossiper.Gossiper()
+        self.gossiper.member_list.add_listener(self.update_members)
+        self.gossiper.run()
+
+    def update_members(self, events):
+        # Membership changes come in batches from the gossiper
+        for event, id in events:
+            if event == 'joined':
+                self.add_machine(id.split('_')[0])
+            else:
+                self.remove_machine(id.split('_')[0])
+
     def add_machine(self, ip):
         if ip in self.all_machines and self.all_machines[ip]['alive']:
             return
@@ -197,6 +210,8 @@ class Nimbus(object):
                 pass
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s')
+
     nimbus = Nimbus()
 
     nimbus.run()
\ No newline at end of file
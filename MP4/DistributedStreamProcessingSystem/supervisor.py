@@ -1,3 +1,5 @@
+import os
+import sys
 import socket
 import json
 import csv
@@ -8,9 +10,11 @@ from SimpleXMLRPCServer import SimpleXMLRPCServer
 import xmlrpclib
 import operator
 import yaml
+import logging
+# The gossiper is shared with the other MPs, from the group membership of MP2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'MP2', 'DistributedGroupMembership'))
 import gossiper
-# import logging
-#
+
 # LOGGER = logging.getLogger('Supervisor')
 
 def find_local_ip():
@@ -288,6 +292,8 @@ class Bolt(Node):
         self.output.write(str(tuple) + '\n')
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(threadName)-10s %(message)s')
+
     with open('crane_conf.yaml') as f:
         crane_conf = yaml.load(f)
 
@@ -295,7 +301,5 @@ if __name__ == '__main__':
 
     rpc_server = SimpleXMLRPCServer((find_local_ip(), crane_conf['supervisor']['rpc_port']), logRequests=True, allow_none=True)
     rpc_server.register_instance(supervisor)
-    thread.start_new_thread(rpc_server.serve_forever, ())
-
-    while True:
-        pass
+    # Serve in the main thread, rather than spinning it while another one serves
+    rpc_server.serve_forever()